@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""A stand-in for the `packer` executable used by the benchmarks
+
+Its behaviour is configured through environment variables:
+
+  FAKE_PACKER_LINES      Lines of machine-readable output `build` emits
+                         per builder (default: 10)
+  FAKE_PACKER_LINE_SIZE  Length of each emitted ui message (default: 80)
+  FAKE_PACKER_RATE       Lines emitted per second, 0 for unlimited
+                         (default: 0)
+  FAKE_PACKER_SLEEP      Seconds every command takes before exiting
+                         (default: 0)
+  FAKE_PACKER_EXIT_CODE  Exit code of every command except `version`
+                         (default: 0)
+"""
+import os
+import sys
+import json
+import time
+
+
+def _env(name, default, cast=int):
+    return cast(os.environ.get('FAKE_PACKER_' + name, default))
+
+
+def _template(args):
+    with open(args[-1]) as f:
+        return json.load(f)
+
+
+def _builder_names(template):
+    return [builder.get('name') or builder['type']
+            for builder in template.get('builders', [])]
+
+
+def build(args, out):
+    lines = _env('LINES', 10)
+    message = 'x' * _env('LINE_SIZE', 80)
+    rate = _env('RATE', 0, float)
+    for name in _builder_names(_template(args)):
+        for index in range(lines):
+            out.write('{0},{1},ui,say,{2}\n'.format(
+                int(time.time()), name, message))
+            if rate:
+                out.flush()
+                time.sleep(1.0 / rate)
+        out.write('{0},{1},artifact-count,1\n'.format(int(time.time()), name))
+        out.write('{0},{1},artifact,0,id,{1}-artifact\n'.format(
+            int(time.time()), name))
+        out.write("{0},,ui,say,Build '{1}' finished.\n".format(
+            int(time.time()), name))
+
+
+def inspect(args, out):
+    template = _template(args)
+    now = int(time.time())
+    for name, value in sorted(template.get('variables', {}).items()):
+        out.write('{0},,template-variable,{1},{2},0\n'.format(
+            now, name, str(value or '').replace(',', '%!(PACKER_COMMA)')))
+    for builder in template.get('builders', []):
+        out.write('{0},,template-builder,{1},{2}\n'.format(
+            now, builder.get('name') or builder['type'], builder['type']))
+    for provisioner in template.get('provisioners', []):
+        out.write('{0},,template-provisioner,{1}\n'.format(
+            now, provisioner['type']))
+
+
+def fix(args, out):
+    out.write(json.dumps(_template(args), indent=2) + '\n')
+
+
+def validate(args, out):
+    _template(args)
+    out.write('Template validated successfully.\n')
+
+
+COMMANDS = {
+    'build': build,
+    'fix': fix,
+    'inspect': inspect,
+    'validate': validate,
+}
+
+
+def main(args):
+    if not args:
+        sys.stderr.write('usage: packer <command> [args]\n')
+        return 1
+    if args[0] == 'version':
+        sys.stdout.write('Packer v0.0.0\n')
+        return 0
+    time.sleep(_env('SLEEP', 0, float))
+    command = COMMANDS.get(args[0])
+    if command is None:
+        sys.stderr.write('unknown command: {0}\n'.format(args[0]))
+        return 1
+    command(args[1:], sys.stdout)
+    return _env('EXIT_CODE', 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,319 @@
+"""Measures the overhead python-packer adds on top of Packer itself
+
+Run from the repository's root:
+
+    python -m benchmarks.run [--output results.json] [--compare base.json]
+
+Packer is replaced by `benchmarks/fake_packer.py`, so that results reflect
+the wrapper rather than Packer. Results are printed (or written to
+`--output`) as JSON. Passing a previous run to `--compare` reports metrics
+which regressed by more than `--tolerance` and exits with a non-zero code
+if any did.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+
+import packer
+
+FAKE_PACKER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'fake_packer.py')
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def metric(value, unit, better='lower'):
+    return {'value': value, 'unit': unit, 'better': better}
+
+
+def median_time(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return sorted(timings)[len(timings) // 2]
+
+
+@contextlib.contextmanager
+def fake_packer_env(**settings):
+    previous = dict(os.environ)
+    os.environ.update(
+        ('FAKE_PACKER_' + key.upper(), str(value))
+        for key, value in settings.items())
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(previous)
+
+
+def write_template(directory, builders=1):
+    path = os.path.join(directory, 'template-{0}.json'.format(builders))
+    with open(path, 'w') as f:
+        json.dump({
+            'variables': {'region': 'eu-west-1'},
+            'builders': [{'type': 'null', 'name': 'null-{0}'.format(index)}
+                         for index in range(builders)],
+            'provisioners': [{'type': 'shell', 'inline': ['true']}],
+        }, f)
+    return path
+
+
+@benchmark
+def spawn(context):
+    """Latency of running `packer version` through each client
+
+    `version()` itself is memoized, so the command is run directly.
+    """
+    template, repeat = context['template'], context['repeat']
+    results = {
+        'spawn.raw_subprocess': metric(median_time(
+            lambda: subprocess.run([FAKE_PACKER, 'version'],
+                                   stdout=subprocess.PIPE),
+            repeat), 's'),
+    }
+    client = packer.Packer(template, exec_path=FAKE_PACKER)
+    results['spawn.subprocess_backend'] = metric(
+        median_time(lambda: client._execute(('version',)), repeat), 's')
+    results['spawn.subprocess_backend_overhead'] = metric(
+        results['spawn.subprocess_backend']['value'] -
+        results['spawn.raw_subprocess']['value'], 's')
+    try:
+        import sh  # NOQA
+    except ImportError:
+        pass
+    else:
+        client = packer.Packer(template, exec_path=FAKE_PACKER,
+                               backend=packer.ShBackend())
+        results['spawn.sh_backend'] = metric(
+            median_time(lambda: client._execute(('version',)), repeat), 's')
+    client = packer.AsyncPacker(template, exec_path=FAKE_PACKER)
+    results['spawn.async'] = metric(median_time(
+        lambda: asyncio.run(client._run('version')), repeat), 's')
+    results['spawn.version_memoized'] = metric(median_time(
+        packer.Packer(template, exec_path=FAKE_PACKER).version, repeat), 's')
+    return results
+
+
+@benchmark
+def arguments(context):
+    """Cost of building a command's arguments for growing `vars`"""
+    results = {}
+    for count in (0, 100, 1000):
+        vars = dict(('var{0}'.format(index), 'value{0}'.format(index))
+                    for index in range(count))
+        for threshold, name in ((None, 'var'), (0, 'var_file')):
+            client = packer.Packer(context['template'], vars=vars,
+                                   exec_path=FAKE_PACKER,
+                                   var_file_threshold=threshold)
+            calls = 1000
+            started = time.perf_counter()
+            for _ in range(calls):
+                client._build_arguments(True, False, False, True)
+            results['arguments.{0}.vars_{1}'.format(name, count)] = metric(
+                (time.perf_counter() - started) / calls, 's')
+    return results
+
+
+@benchmark
+def parsing(context):
+    """Throughput of parsing machine-readable output"""
+    count = context['lines']
+    lines = ['1500000000,amazon,ui,say,{0}%!(PACKER_COMMA) {1}\n'.format(
+        'x' * 80, index) for index in range(count)]
+    size = sum(len(line) for line in lines)
+    started = time.perf_counter()
+    for _ in packer.parse_machine_readable(lines):
+        pass
+    duration = time.perf_counter() - started
+    return {
+        'parsing.lines_per_second': metric(count / duration, 'lines/s',
+                                           better='higher'),
+        'parsing.bytes_per_second': metric(size / duration, 'B/s',
+                                           better='higher'),
+    }
+
+
+@benchmark
+def event_log(context):
+    """Latency of querying a stored build log for one builder's errors"""
+    count = context['lines']
+    path = os.path.join(context['directory'], 'events')
+    with packer.EventLog(path) as log:
+        for index in range(count):
+            log.write('{0},{1},ui,{2},{3}\n'.format(
+                1500000000 + index, 'builder-{0}'.format(index % 100),
+                'error' if index % 1000 == 0 else 'say', 'x' * 80))
+    log = packer.EventLog(path)
+    return {
+        'event_log.query_target_type': metric(median_time(
+            lambda: list(log.events(target='builder-0', type='ui')),
+            context['repeat']), 's'),
+        'event_log.query_time_range': metric(median_time(
+            lambda: list(log.events(since=1500000000 + count // 2,
+                                    until=1500000000 + count // 2 + 100)),
+            context['repeat']), 's'),
+    }
+
+
+@benchmark
+def validation_server(context):
+    """Latency of validating a template with a new client per validation,
+    as a pre-merge hook would, and through a `ValidationServer`
+    """
+    template, repeat = context['template'], context['repeat']
+    path = os.path.join(context['directory'], 'packer.sock')
+    results = {
+        'validation_server.new_client': metric(median_time(
+            lambda: packer.Packer(template, exec_path=FAKE_PACKER).validate(),
+            repeat), 's'),
+    }
+    with packer.ValidationServer(path, exec_path=FAKE_PACKER):
+        client = packer.ValidationClient(path)
+        results['validation_server.client'] = metric(median_time(
+            lambda: client.validate(template), repeat), 's')
+    return results
+
+
+@benchmark
+def memory(context):
+    """Peak Python memory of building with a large output"""
+    results = {}
+    with fake_packer_env(lines=context['lines'], line_size=200):
+        for name, output_log in (
+                ('buffered', lambda: None),
+                ('output_log', lambda: packer.OutputLog(
+                    os.path.join(context['directory'], 'build.log')))):
+            client = packer.Packer(context['template'], exec_path=FAKE_PACKER)
+            tracemalloc.start()
+            client.build(machine_readable=True, output_log=output_log())
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results['memory.build_{0}_peak'.format(name)] = metric(peak, 'B')
+        client = packer.Packer(context['template'], exec_path=FAKE_PACKER)
+        tracemalloc.start()
+        for _ in client.build_events():
+            pass
+        results['memory.build_events_peak'] = metric(
+            tracemalloc.get_traced_memory()[1], 'B')
+        tracemalloc.stop()
+    return results
+
+
+@benchmark
+def concurrency(context):
+    """Wall time of running many slow builds with growing concurrency"""
+    jobs = [packer.PackerJob(context['template'], name=str(index))
+            for index in range(context['jobs'])]
+    results = {}
+    with fake_packer_env(sleep=context['sleep']):
+        for workers in (1, 4, len(jobs)):
+            batch = packer.Packer.build_many(
+                jobs, max_workers=workers, exec_path=FAKE_PACKER)
+            results['concurrency.build_many.workers_{0}'.format(workers)] = \
+                metric(batch.duration, 's')
+
+        async def build_all():
+            clients = [packer.AsyncPacker(context['template'],
+                                          exec_path=FAKE_PACKER)
+                       for _ in jobs]
+            await asyncio.gather(*[client.build() for client in clients])
+
+        started = time.perf_counter()
+        asyncio.run(build_all())
+        results['concurrency.async.jobs_{0}'.format(len(jobs))] = metric(
+            time.perf_counter() - started, 's')
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns the metrics which regressed by more than `tolerance`"""
+    regressions = []
+    for name, current in sorted(results['metrics'].items()):
+        previous = baseline['metrics'].get(name)
+        # relative changes are meaningless around zero (e.g. overheads
+        # within measurement noise)
+        if not previous or previous['value'] <= 0:
+            continue
+        ratio = current['value'] / previous['value']
+        regressed = ratio > 1 + tolerance if current['better'] == 'lower' \
+            else ratio < 1 - tolerance
+        if regressed:
+            regressions.append((name, previous['value'], current['value']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help='File to write results to')
+    parser.add_argument('--compare', help='Results of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative change considered a regression')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Repetitions of latency measurements')
+    parser.add_argument('--lines', type=int, default=200000,
+                        help='Lines of output to parse and build')
+    parser.add_argument('--jobs', type=int, default=16,
+                        help='Concurrent builds to run')
+    parser.add_argument('--sleep', type=float, default=0.2,
+                        help='Seconds each concurrent build takes')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='Benchmarks to run (default: all)')
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    context = {
+        'directory': directory,
+        'template': write_template(directory),
+        'repeat': args.repeat,
+        'lines': args.lines,
+        'jobs': args.jobs,
+        'sleep': args.sleep,
+    }
+    metrics = {}
+    try:
+        for func in BENCHMARKS:
+            if not args.benchmarks or func.__name__ in args.benchmarks:
+                metrics.update(func(context))
+    finally:
+        shutil.rmtree(directory)
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'metrics': metrics,
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, previous, current in regressions:
+            sys.stderr.write('REGRESSION {0}: {1:.6g} -> {2:.6g}\n'.format(
+                name, previous, current))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
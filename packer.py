@@ -1,26 +1,124 @@
-import sh
 import os
+import re
+import sys
+import signal
+import atexit
+import time
+import gzip
 import json
-import zipfile
+import mmap
+import pickle
+import struct
+import shutil
+import hashlib
+import contextlib
+import tempfile
+import threading
+import subprocess
+import collections
+
+# `sh`, `asyncio`, `zipfile`, `sqlite3`, `multiprocessing`, `urllib`,
+# `socketserver` and `concurrent.futures` are imported where they're used
+# so that importing this module stays fast.
 
 DEFAULT_PACKER_PATH = 'packer'
+# The longest line read from Packer's output by the asyncio client
+STREAM_LINE_LIMIT = 1024 * 1024
+# Lines buffered between Packer and the consumer of streamed events
+STREAM_QUEUE_SIZE = 1024
+# Defaults for `OutputLog`
+DEFAULT_TAIL_LINES = 1000
+DEFAULT_LOG_MAX_BYTES = 100 * 1024 * 1024
+DEFAULT_LOG_BACKUP_COUNT = 5
+# Above this many `vars`, they're passed to Packer in a var-file
+DEFAULT_VAR_FILE_THRESHOLD = 20
+# Defaults for `ResultCache`
+DEFAULT_CACHE_ENTRIES = 1024
+DEFAULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Seconds before failed builders are first retried, doubled on every retry
+DEFAULT_RETRY_BACKOFF = 5
+# Host resources taken by a builder, as (CPUs, MiB of memory), when
+# templates are built one builder per process (see `build_per_builder`).
+# Builders running remotely (e.g. in the cloud) take none.
+BUILDER_WEIGHTS = {
+    'qemu': (2, 2048),
+    'virtualbox-iso': (2, 2048),
+    'virtualbox-ovf': (2, 2048),
+    'vmware-iso': (2, 2048),
+    'vmware-vmx': (2, 2048),
+    'parallels-iso': (2, 2048),
+    'parallels-pvm': (2, 2048),
+    'hyperv-iso': (2, 2048),
+    'hyperv-vmcx': (2, 2048),
+    'docker': (1, 512),
+    'lxc': (1, 512),
+    'lxd': (1, 512),
+}
+DEFAULT_BUILDER_WEIGHT = (0, 0)
+# Defaults for `IsoCache`
+DEFAULT_ISO_CACHE_MAX_BYTES = 50 * 1024 * 1024 * 1024
+DEFAULT_DOWNLOAD_WORKERS = 4
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# `iso_checksum` types the ISO cache can verify
+ISO_CHECKSUM_TYPES = ('md5', 'sha1', 'sha256', 'sha512')
+# URLs the ISO cache downloads; Packer handles any other (e.g. local paths)
+ISO_URL_REGEX = re.compile(r'^(https?|ftp)://', re.IGNORECASE)
+CHECKSUM_REGEX = re.compile(r'^[0-9a-f]+$')
+# Names of Packer's release archives, e.g. packer_1.2.3_linux_amd64.zip
+RELEASE_ARCHIVE_REGEX = re.compile(
+    r'^packer_(?P<version>[^_]+)_(?P<platform>[^.]+)\.zip$')
+# Seconds Packer is given to clean up after being interrupted by a timeout
+# or a cancellation, before being killed
+DEFAULT_KILL_TIMEOUT = 60
+# Defaults for `BuildQueue` and `BuildWorker`
+DEFAULT_LEASE_SECONDS = 60
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_POLL_INTERVAL = 5
 
+DEFAULT_ADMISSION_POLL_INTERVAL = 1
+# Attributes set by the clients on top of the execution's output
+RESULT_ATTRIBUTES = ('parsed_output', 'fixed', 'succeeded', 'failed', 'error',
+                     'tail', 'log_path', 'timings', 'artifacts', 'skipped',
+                     'attempts', 'terminated', 'changed', 'changes')
 
-class Packer(object):
-    """A packer client
+# An `EventLog` index record: an event's timestamp, the offset and length
+# of its data and the ids of its target and type
+EVENT_INDEX_RECORD = struct.Struct('<qQIII')
+# An `EventLog` posting: the position of an event's index record
+EVENT_POSTING = struct.Struct('<Q')
+
+# Packer escapes commas and newlines within machine-readable data fields
+MACHINE_READABLE_ESCAPES = (
+    ('%!(PACKER_COMMA)', ','),
+    ('\\n', '\n'),
+    ('\\r', '\r'),
+)
+BUILD_RESULT_REGEX = re.compile(
+    r"^Build '(?P<builder>[^']+)' (?P<state>finished|errored)")
+VERSION_REGEX = re.compile(r'v?(?P<version>\d+\.\d+\.\d+\S*)')
+# `packer -help` lists commands, and `packer <command> -h` flags, indented
+HELP_COMMAND_REGEX = re.compile(r'^\s+(?P<command>[a-z][\w-]*)\s', re.M)
+HELP_FLAG_REGEX = re.compile(r'^\s+(?P<flag>-[\w-]+)', re.M)
+USER_VARIABLE_REGEX = re.compile(r"{{\s*user\s+`(?P<name>[^`]+)`\s*}}")
+TEMPLATE_DIR_REGEX = re.compile(r"{{\s*template_dir\s*}}")
+# Top-level keys Packer accepts in a template, aside from `_` prefixed ones
+TEMPLATE_KEYS = ('description', 'min_packer_version', 'variables',
+                 'sensitive-variables', 'builders', 'provisioners',
+                 'post-processors', 'push')
+
+
+class _PackerBase(object):
+    """Template and argument handling shared by the packer clients
     """
 
     def __init__(self, packerfile, exc=None, only=None, vars=None,
-                 var_file=None, exec_path=DEFAULT_PACKER_PATH, out_iter=None,
-                 err_iter=None):
-        """
-        :param string packerfile: Path to Packer template file
-        :param list exc: List of builders to exclude
-        :param list only: List of builders to include
-        :param dict vars: key=value pairs of template variables
-        :param string var_file: Path to variables file
-        :param string exec_path: Path to Packer executable
-        """
+                 var_file=None, in_process=False,
+                 var_file_threshold=DEFAULT_VAR_FILE_THRESHOLD, hooks=None):
+        self.hooks = self._validate_argtype(hooks or [], list)
+        self.in_process = in_process
+        self.var_file_threshold = var_file_threshold
+        self._template = None
+        self._template_stat = None
         self.packerfile = self._validate_argtype(packerfile, str)
         self.var_file = var_file
         if not os.path.isfile(self.packerfile):
@@ -30,50 +128,699 @@ class Packer(object):
         self.only = self._validate_argtype(only or [], list)
         self.vars = self._validate_argtype(vars or {}, dict)
 
-        kwargs = dict()
-        if out_iter is not None:
-            kwargs["_out"] = out_iter
-            kwargs["_out_bufsize"] = 1
-        if err_iter is not None:
-            kwargs["_err"] = err_iter
-            kwargs["_out_bufsize"] = 1
+    def _validate_argtype(self, arg, argtype):
+        if not isinstance(arg, argtype):
+            raise PackerException('{0} argument must be of type {1}'.format(
+                arg, argtype))
+        return arg
+
+    def _arguments(self, command, *options, base=False, only=None,
+                   packerfile=None):
+        """Returns the arguments of a Packer command as a tuple
+
+        Falsy options are dropped and the template's path (or
+        `packerfile`) is appended. If `base` is set, the -except, -only,
+        -var and -var-file arguments are added as well, `only` overriding
+        the client's builder selection. The arguments are computed once per
+        call and nothing is stored on the client, so that a single client
+        may run several commands concurrently.
+        """
+        args = [command]
+        args.extend(option for option in options if option)
+        if base:
+            args.extend(self._base_arguments(only))
+        args.append(packerfile or self.packerfile)
+        return tuple(args)
+
+    def _build_arguments(self, parallel, debug, force, machine_readable,
+                         only=None, packerfile=None):
+        return self._arguments(
+            'build',
+            '-parallel=true' if parallel else None,
+            '-debug' if debug else None,
+            '-force' if force else None,
+            '-machine-readable' if machine_readable else None,
+            base=True, only=only, packerfile=packerfile)
+
+    def _fix_arguments(self):
+        return self._arguments('fix')
+
+    def _inspect_arguments(self, mrf):
+        return self._arguments('inspect', '-machine-readable' if mrf else None)
+
+    def _push_arguments(self, create, token):
+        return self._arguments(
+            'push',
+            '-create=true' if create else None,
+            '-token={0}'.format(token) if token else None)
+
+    def _validate_arguments(self, syntax_only):
+        return self._arguments(
+            'validate', '-syntax-only' if syntax_only else None, base=True)
+
+    def _base_arguments(self, only=None):
+        """Returns the -except, -only, -var and -var-file arguments as a list
+
+        -except, -only, -var and -var-file are appeneded to almost
+        all subcommands in packer.
+
+        If there are more `vars` than `var_file_threshold`, they're written
+        to a var-file rather than passed as -var arguments. This keeps the
+        command line short and values out of the process list.
+
+        :param list only: Builders to include instead of `only`/`exc`
+        """
+        args = []
+        if only:
+            args.append('-only={0}'.format(self._join_comma(only)))
+        elif self.exc and self.only:
+            raise PackerException('Cannot provide both "except" and "only"')
+        elif self.exc:
+            args.append('-except={0}'.format(self._join_comma(self.exc)))
+        elif self.only:
+            args.append('-only={0}'.format(self._join_comma(self.only)))
+        if self.var_file_threshold is not None and \
+                len(self.vars) > self.var_file_threshold:
+            args.append('-var-file={0}'.format(_spill_vars(self.vars)))
+        else:
+            for var, value in self.vars.items():
+                args.append("-var")
+                args.append("{0}={1}".format(var, value))
+        if self.var_file:
+            args.append('-var-file={0}'.format(self.var_file))
+        return args
+
+    def _join_comma(self, lst):
+        """Returns a comma delimited string from a list"""
+        return str(','.join(lst))
+
+    def _load_template(self):
+        """Returns the parsed template, or None if it can't be analyzed
+        in-process (e.g. it isn't JSON).
+
+        The template is parsed again only if the file changed.
+        """
+        stat = os.stat(self.packerfile)
+        stat = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if stat != self._template_stat:
+            try:
+                self._template = Template.load(self.packerfile)
+            except ValueError:
+                self._template = None
+            self._template_stat = stat
+        return self._template
+
+    def _inspect_in_process(self):
+        template = self._load_template()
+        if template is None:
+            return None
+        result = CommandResult(None, b'', b'', 0)
+        result.parsed_output = template.inspect()
+        return result
+
+    def _validate_in_process(self):
+        template = self._load_template()
+        if template is None:
+            return None
+        errors = template.syntax_errors()
+        if errors:
+            validation = ValidationObject()
+            validation.succeeded = False
+            validation.failed = True
+            validation.error = 'Template validation failed. Errors are ' \
+                'shown below.\n\n{0}'.format(
+                    '\n'.join('* {0}'.format(error) for error in errors))
+        else:
+            validation = CommandResult(None, b'', b'', 0)
+            validation.succeeded = True
+            validation.error = None
+        return validation
+
+    def _attach_log(self, target, output_log):
+        """Sets an `OutputLog`'s tail and path on a result or exception"""
+        for obj in (target, getattr(target, 'result', None)):
+            if obj is not None:
+                obj.tail = output_log.tail
+                obj.log_path = output_log.path
+
+    def _chain(self, first, callback):
+        """Returns an output callback calling `first` and then `callback`,
+        if provided.
+        """
+        def write(line):
+            first(line)
+            if callback is not None:
+                return callback(line)
+        return write
 
-        self.packer = sh.Command(exec_path)
-        self.packer = self.packer.bake(**kwargs)
+    def _set_artifacts(self, result, timer):
+        result.artifacts = timer.artifacts if timer is not None else None
+        result.skipped = False
+        return result
+
+    def _write_fixed(self, result, to_file, in_place):
+        """Sets the result's `changes` (see `_json_changes`) and `changed`
+        by comparing the fixed template to the original one, and writes it
+        to `to_file` and, if it changed and `in_place` is set, atomically
+        over the template
+        """
+        try:
+            with open(self.packerfile) as f:
+                original = json.load(f)
+        except ValueError:
+            original = None
+        result.changes = _json_changes(original, result.fixed)
+        result.changed = bool(result.changes)
+        if to_file:
+            with open(to_file, 'w') as f:
+                f.write(result.stdout.decode())
+        if in_place and result.changed:
+            _atomic_write(self.packerfile, result.stdout,
+                          mode=os.stat(self.packerfile).st_mode & 0o7777)
+
+    def _selected_builders(self, only=None):
+        """Returns the definitions of the template's builders selected by
+        `only` (defaulting to the client's) and `exc`, or an empty list if
+        the template can't be analyzed
+        """
+        try:
+            template = self._load_template()
+        except (IOError, OSError):
+            template = None
+        if template is None:
+            return []
+        only = only or self.only
+        return [builder for builder in template.builders
+                if (not only or template.builder_name(builder) in only) and
+                template.builder_name(builder) not in self.exc]
+
+    def _fingerprint(self):
+        """Returns a hash of the template, `vars`, `var_file`, `only`/`exc`
+        and the local files referenced by provisioners, or None if a
+        referenced path can't be resolved without Packer.
+        """
+        try:
+            template = self._load_template()
+        except (IOError, OSError, ValueError):
+            return None
+        expand = self._expander(template)
+        if expand is None:
+            return None
+
+        digest = hashlib.sha256()
+        digest.update(json.dumps(
+            [self.exc, self.only, self.vars, self.var_file],
+            sort_keys=True, default=str).encode())
+        for path in (self.packerfile, self.var_file):
+            if path:
+                _hash_path(digest, path)
+        for path in template.local_files():
+            path = expand(path)
+            if path is None:
+                return None
+            # relative paths are resolved against the working directory,
+            # like Packer does
+            _hash_path(digest, path)
+        return digest.hexdigest()
+
+    def _expander(self, template):
+        """Returns a function expanding ``{{user `name`}}`` and
+        `{{template_dir}}` in the template's strings like Packer does, or
+        None if the template or the `var_file` can't be read. The function
+        returns None for strings using any other template function.
+        """
+        if template is None:
+            return None
+        variables = dict(template.variables)
+        if self.var_file:
+            try:
+                with open(self.var_file) as f:
+                    variables.update(json.load(f))
+            except (IOError, OSError, ValueError):
+                return None
+        variables.update(self.vars)
+        return _template_expander(self.packerfile, variables)
+
+    def _effective_input_key(self, job):
+        """Returns a key identifying what `job` validates to with the
+        client's template: its `only`/`exc`, `var_file` and the `vars` the
+        template references (all of them if it can't be analyzed).
+        """
+        vars = job.vars or {}
+        try:
+            template = self._load_template()
+        except (IOError, OSError, ValueError):
+            template = None
+        if template is not None:
+            referenced = template.user_variable_references()
+            vars = dict((name, value) for name, value in vars.items()
+                        if name in referenced or name not in
+                        template.variables)
+        return json.dumps([job.exc or [], job.only or [], job.var_file, vars],
+                          sort_keys=True, default=str)
+
+    def _record_timings(self, command, started, clock, timer, result, error):
+        """Completes the `Timings` of a command's result (or of the result
+        of the exception it raised) and passes them to the hooks.
+        """
+        target = result
+        if error is not None:
+            result = getattr(error, 'result', None)
+            target = error if result is None else result
+        timings = getattr(target, 'timings', None) or Timings()
+        timings.command = command
+        timings.started = started
+        timings.wall_time = time.perf_counter() - clock
+        if timer is not None:
+            timings.builders = timer.builders
+        try:
+            target.timings = timings
+        except AttributeError:
+            pass
+        for hook in self.hooks:
+            hook(timings, result, error)
+
+    def _parse_inspection_output(self, output):
+        """Parses the machine-readable output `packer inspect` provides.
+
+        See the inspect method for more info.
+        This has been tested vs. Packer v0.7.5
+        """
+        parts = {'variables': [], 'builders': [], 'provisioners': []}
+        for event in parse_machine_readable(output.splitlines()):
+            data = event.data
+            if event.type == 'template-variable':
+                variable = {"name": data[0], "value": data[1]}
+                parts['variables'].append(variable)
+            elif event.type == 'template-builder':
+                builder = {"name": data[0], "type": data[1]}
+                parts['builders'].append(builder)
+            elif event.type == 'template-provisioner':
+                provisioner = {"type": data[0]}
+                parts['provisioners'].append(provisioner)
+        return parts
+
+
+_spilled_var_files = {}
+_spilled_var_files_lock = threading.Lock()
+_spilled_var_files_dir = None
+
+
+def _spill_vars(vars):
+    """Returns the path of a var-file holding `vars`
+
+    Var-files are written to a private temporary directory, which is
+    removed when the interpreter exits, and are named after a hash of
+    their content so that repeated calls with the same values reuse them.
+    A var-file removed since (e.g. by a temporary files cleaner, in a
+    long-lived process) is written again.
+    """
+    global _spilled_var_files_dir
+
+    # Packer receives -var values as strings, so the var-file holds the
+    # same strings -var arguments would have
+    content = json.dumps(
+        dict((str(var), '{0}'.format(value)) for var, value in vars.items()),
+        sort_keys=True).encode()
+    digest = hashlib.sha256(content).hexdigest()
+    with _spilled_var_files_lock:
+        path = _spilled_var_files.get(digest)
+        if path is not None and os.path.isfile(path):
+            return path
+        if _spilled_var_files_dir is None:
+            _spilled_var_files_dir = tempfile.mkdtemp(prefix='python-packer-')
+            atexit.register(shutil.rmtree, _spilled_var_files_dir, True)
+        else:
+            os.makedirs(_spilled_var_files_dir, mode=0o700, exist_ok=True)
+        path = os.path.join(_spilled_var_files_dir, digest + '.json')
+        _atomic_write(path, content)
+        _spilled_var_files[digest] = path
+        return path
+
+
+def _json_changes(old, new, path=''):
+    """Returns a summary of the differences between two JSON values, a
+    line per added (`+`), removed (`-`) or changed (`~`) value, e.g.
+    `+ builders[0].ssh_timeout`
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = []
+        for key in sorted(set(old) | set(new)):
+            key_path = '{0}.{1}'.format(path, key) if path else key
+            if key not in new:
+                changes.append('- ' + key_path)
+            elif key not in old:
+                changes.append('+ ' + key_path)
+            else:
+                changes.extend(_json_changes(old[key], new[key], key_path))
+        return changes
+    if isinstance(old, list) and isinstance(new, list):
+        changes = []
+        for index in range(max(len(old), len(new))):
+            item_path = '{0}[{1}]'.format(path, index)
+            if index >= len(new):
+                changes.append('- ' + item_path)
+            elif index >= len(old):
+                changes.append('+ ' + item_path)
+            else:
+                changes.extend(_json_changes(old[index], new[index],
+                                             item_path))
+        return changes
+    return [] if old == new and type(old) is type(new) \
+        else ['~ ' + (path or '.')]
+
+
+def _find_templates(paths, pattern):
+    """Returns `paths`, replacing directories by the templates found in
+    them (see `Packer.fix_many`)
+    """
+    import fnmatch
+
+    templates = []
+    for path in paths:
+        if not os.path.isdir(path):
+            templates.append(path)
+            continue
+        for directory, directories, files in os.walk(path):
+            directories[:] = sorted(name for name in directories
+                                    if not name.startswith('.'))
+            for name in sorted(fnmatch.filter(files, pattern)):
+                template = os.path.join(directory, name)
+                try:
+                    with open(template) as f:
+                        data = json.load(f)
+                except ValueError:
+                    # let Packer report invalid templates
+                    templates.append(template)
+                    continue
+                if isinstance(data, dict) and 'builders' in data:
+                    templates.append(template)
+    return templates
+
+
+def _template_expander(packerfile, variables):
+    """Returns a function expanding ``{{user `name`}}`` with `variables`
+    and `{{template_dir}}` with the directory of `packerfile`, or
+    returning None for strings using any other template function
+    """
+    template_dir = os.path.dirname(os.path.abspath(packerfile))
+
+    def expand(value):
+        value = TEMPLATE_DIR_REGEX.sub(lambda match: template_dir, value)
+        value = USER_VARIABLE_REGEX.sub(
+            lambda match: str(variables.get(match.group('name'), '')),
+            value)
+        return None if '{{' in value else value
+    return expand
+
+
+def _hash_path(digest, path):
+    """Updates `digest` with `path` and the contents of the file or the
+    directory tree at `path`
+    """
+    digest.update(path.encode() + b'\0')
+    if os.path.isdir(path):
+        for root, directories, files in os.walk(path):
+            directories.sort()
+            for name in sorted(files):
+                _hash_path(digest, os.path.join(root, name))
+    elif os.path.isfile(path):
+        file_digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                file_digest.update(chunk)
+        digest.update(file_digest.digest())
+    else:
+        digest.update(b'\0missing')
+
+
+class Packer(_PackerBase):
+    """A packer client
+    """
+
+    def __init__(self, packerfile, exc=None, only=None, vars=None,
+                 var_file=None, exec_path=DEFAULT_PACKER_PATH, out_iter=None,
+                 err_iter=None, cache=None, in_process=False, backend=None,
+                 var_file_threshold=DEFAULT_VAR_FILE_THRESHOLD, hooks=None,
+                 manifest=None, iso_cache=None, cancellable=False):
+        """
+        :param string packerfile: Path to Packer template file
+        :param list exc: List of builders to exclude
+        :param list only: List of builders to include
+        :param dict vars: key=value pairs of template variables
+        :param string var_file: Path to variables file
+        :param string exec_path: Path to Packer executable
+        :param ResultCache cache: Cache for `inspect`, `validate` and `fix`
+         results. May be shared between clients.
+        :param bool in_process: Answer `inspect(mrf=True)` and
+         `validate(syntax_only=True)` by analyzing JSON templates in-process
+         rather than by executing Packer.
+        :param Backend backend: Executes Packer. Defaults to a
+         `SubprocessBackend`.
+        :param int var_file_threshold: Number of `vars` above which they're
+         passed to Packer in a temporary var-file rather than as -var
+         arguments. 0 always uses a var-file and None never does.
+        :param list hooks: Callables called with the `Timings`, the result
+         and the raised exception (if any) of every `build`, `fix`,
+         `inspect`, `push` and `validate`, e.g. to export metrics. Hooks
+         mustn't raise.
+        :param BuildManifest manifest: Skip builds whose inputs haven't
+         changed since they last succeeded. See `build`.
+        :param IsoCache iso_cache: Download the builders' ISOs to this
+         cache before building. See `build`.
+        :param bool cancellable: Run every `build` and `validate` in its
+         own process group, so that `cancel` can interrupt it. Otherwise,
+         only commands given a timeout are.
+        """
+        super(Packer, self).__init__(packerfile, exc=exc, only=only,
+                                     vars=vars, var_file=var_file,
+                                     in_process=in_process,
+                                     var_file_threshold=var_file_threshold,
+                                     hooks=hooks)
+        self.exec_path = exec_path
+        self.cache = cache
+        self.manifest = manifest
+        self.iso_cache = iso_cache
+        self.cancellable = cancellable
+        self.backend = backend or SubprocessBackend()
+        self._watchdogs = set()
+        self._watchdogs_lock = threading.Lock()
+        self.out_iter = out_iter
+        self.err_iter = err_iter
 
     def build(self, parallel=True, debug=False, force=False,
-              machine_readable=False):
+              machine_readable=False, output_log=None, retries=0,
+              retry_backoff=DEFAULT_RETRY_BACKOFF, timeout=None,
+              inactivity_timeout=None, kill_timeout=DEFAULT_KILL_TIMEOUT,
+              rate_limiter=None):
         """Executes a `packer build`
 
+        If `output_log` is provided, the build's output is written to it
+        instead of being accumulated in memory. The tail of the output
+        and the log's path are then available as `tail` and `log_path` on
+        the returned object or on the raised exception.
+
+        With `machine_readable`, the start, finish and duration of every
+        builder are recorded in the result's `timings.builders` and the
+        artifacts Packer reports in `artifacts`.
+
+        If the client has a `manifest`, the template, `vars`, `var_file`
+        and the local files referenced by provisioners are fingerprinted.
+        When the fingerprint matches that of the last successful build,
+        Packer isn't executed and a result with `skipped` set and the
+        previous build's `artifacts` is returned. `force` always builds.
+        The output is then machine-readable, so that the artifacts of the
+        build are known.
+
+        With `retries`, builders which fail are built again with `-only`,
+        up to `retries` times, waiting `retry_backoff` seconds before the
+        first retry and twice as long before every following one. The
+        output is then machine-readable, as it tells which builders
+        failed. The returned result (or the raised exception's) holds the
+        artifacts of all attempts and their number in `attempts`.
+
+        If the client has an `iso_cache`, the `iso_url`/`iso_urls` of the
+        builders with an `iso_checksum` are first downloaded to it, in
+        parallel, and Packer is given a copy of the template which uses
+        the cached files instead.
+
+        Packer runs in its own process group. If the build takes more than
+        `timeout` seconds, goes `inactivity_timeout` seconds without any
+        output or is cancelled with `cancel`, Packer is interrupted with
+        SIGINT so that it cleans up what it created, then killed if it's
+        still running `kill_timeout` seconds later. A `PackerCommandError`
+        is then raised whose result's `terminated` is `timeout`,
+        `inactivity` or `cancelled`. Builds which were terminated aren't
+        retried.
+
+        With a `rate_limiter`, Packer only starts (and every retry only
+        restarts) once the limiter admits the builders being built.
+        `timeout` runs from when Packer first starts, so waiting for the
+        first admission doesn't count towards it.
+
         :param bool parallel: Run builders in parallel
         :param bool debug: Run in debug mode
         :param bool force: Force artifact output even if exists
         :param bool machine_readable: Make output machine-readable
+        :param OutputLog output_log: Log to stream the output to
+        :param int retries: Times to retry the builders which failed
+        :param float retry_backoff: Seconds to wait before the first retry
+        :param float timeout: Seconds the whole build may take from when
+         Packer starts, retries included
+        :param float inactivity_timeout: Seconds Packer may run without
+         any output
+        :param float kill_timeout: Seconds Packer is given to exit once
+         interrupted
+        :param RateLimiter rate_limiter: Limits the rate and concurrency of
+         builds sharing cloud API quotas
+        """
+        # the manifest records artifacts, which are only machine-readable
+        machine_readable = machine_readable or retries > 0 or \
+            self.manifest is not None
+        options = (parallel, debug, force, machine_readable)
+        timer = BuilderTimer() if machine_readable else None
+        with self._watchdog(timeout, inactivity_timeout,
+                            kill_timeout) as watchdog:
+            return self._instrumented(
+                'build', self._build, options, timer, output_log, retries,
+                retry_backoff, watchdog, rate_limiter, timer=timer)
+
+    def _build(self, options, timer, output_log, retries=0,
+               retry_backoff=DEFAULT_RETRY_BACKOFF, watchdog=None,
+               rate_limiter=None):
+        if self.manifest is None:
+            return self._retry_build(options, timer, output_log, retries,
+                                     retry_backoff, watchdog, rate_limiter)
+        key = self.manifest.key(self.packerfile, self.only, self.exc)
+        fingerprint = self._fingerprint()
+        entry = self.manifest.get(key)
+        force = options[2]
+        if not force and fingerprint is not None and entry is not None \
+                and entry['fingerprint'] == fingerprint:
+            result = CommandResult(
+                [self.exec_path] + list(self._build_arguments(*options)),
+                b'', b'', 0)
+            result.artifacts = entry['artifacts']
+            result.skipped = True
+            result.attempts = 0
+            return result
+        result = self._retry_build(options, timer, output_log, retries,
+                                   retry_backoff, watchdog, rate_limiter)
+        if fingerprint is not None:
+            self.manifest.record(key, fingerprint, result.artifacts or [])
+        return result
+
+    def _retry_build(self, options, timer, output_log, retries,
+                     retry_backoff, watchdog, rate_limiter=None):
+        """Runs a build, then re-runs only the builders which failed, up to
+        `retries` times
         """
-        self.packer_cmd = self.packer.build
+        packerfile = None
+        if self.iso_cache is not None:
+            packerfile = self._cache_isos()
+        try:
+            return self._retry_builders(options, timer, output_log, retries,
+                                        retry_backoff, packerfile, watchdog,
+                                        rate_limiter)
+        finally:
+            if packerfile is not None:
+                os.remove(packerfile)
+
+    def _retry_builders(self, options, timer, output_log, retries,
+                        retry_backoff, packerfile, watchdog,
+                        rate_limiter=None):
+        only = error = None
+        for attempt in range(retries + 1):
+            if attempt:
+                backoff = retry_backoff * 2 ** (attempt - 1)
+                if watchdog is None:
+                    time.sleep(backoff)
+                elif watchdog.wait(backoff) is not None:
+                    # cancelled or timed out while backing off, so the
+                    # builders aren't retried
+                    error.result.terminated = watchdog.reason
+                    self._set_artifacts(error.result, timer)
+                    error.result.attempts = attempt
+                    raise error
+                timer.restart()
+            admission = contextlib.nullcontext() if rate_limiter is None \
+                else rate_limiter.admit(self._selected_builders(only))
+            try:
+                with admission:
+                    result = self._run_build(
+                        self._build_arguments(*options, only=only,
+                                              packerfile=packerfile),
+                        timer, output_log, watchdog)
+            except PackerCommandError as ex:
+                only = timer.errored_builders() if timer is not None else []
+                if attempt == retries or not only or \
+                        getattr(ex.result, 'terminated', None):
+                    self._set_artifacts(ex.result, timer)
+                    ex.result.attempts = attempt + 1
+                    raise
+                error = ex
+            else:
+                result.attempts = attempt + 1
+                return result
+
+    def _run_build(self, args, timer, output_log, watchdog=None):
+        out_iter = self.out_iter
+        if timer is not None:
+            out_iter = self._chain(timer.feed, out_iter)
+        if output_log is None:
+            result = self._execute(args, out_iter=out_iter,
+                                   watchdog=watchdog)
+            return self._set_artifacts(result, timer)
+
+        try:
+            result = self.backend.run(
+                self.exec_path, args,
+                out_iter=self._chain(output_log.write, out_iter),
+                err_iter=self._chain(output_log.write, self.err_iter),
+                keep_output=False, watchdog=watchdog)
+        except Exception as ex:
+            self._attach_log(ex, output_log)
+            raise
+        finally:
+            output_log.close()
+        self._attach_log(result, output_log)
+        return self._set_artifacts(result, timer)
 
-        self._add_opt('-parallel=true' if parallel else None)
-        self._add_opt('-debug' if debug else None)
-        self._add_opt('-force' if force else None)
-        self._add_opt('-machine-readable' if machine_readable else None)
-        self._append_base_arguments()
-        self._add_opt(self.packerfile)
+    def build_events(self, parallel=True, debug=False, force=False):
+        """Executes a `packer build -machine-readable`, yielding its output
+        as `MachineReadableEvent`s while the build runs.
 
-        return self.packer_cmd()
+        Output is parsed line by line as it is produced and is not kept in
+        memory. An exception is raised once the output is exhausted if
+        the build failed. `out_iter` isn't called.
+
+        :param bool parallel: Run builders in parallel
+        :param bool debug: Run in debug mode
+        :param bool force: Force artifact output even if exists
+        """
+        return parse_machine_readable(self.backend.iter_lines(
+            self.exec_path,
+            self._build_arguments(
+                parallel, debug, force, machine_readable=True),
+            err_iter=self.err_iter))
 
-    def fix(self, to_file=None):
+    def fix(self, to_file=None, in_place=False):
         """Implements the `packer fix` function
 
+        The result's `changed` tells whether the fixed template differs
+        from the template, and `changes` lists the differences (see
+        `_json_changes`).
+
         :param string to_file: File to output fixed template to
+        :param bool in_place: Replace the template with the fixed one if
+         it changed
         """
-        self.packer_cmd = self.packer.fix
-
-        self._add_opt(self.packerfile)
+        result = self._instrumented('fix', self._cached, 'fix', self._fix)
+        self._write_fixed(result, to_file, in_place)
+        return result
 
-        result = self.packer_cmd()
-        if to_file:
-            with open(to_file, 'w') as f:
-                f.write(result.stdout.decode())
+    def _fix(self):
+        result = self._execute(self._fix_arguments())
         result.fixed = json.loads(result.stdout.decode())
         return result
 
@@ -107,12 +854,17 @@ class Packer(object):
 
         :param bool mrf: output in machine-readable form.
         """
-        self.packer_cmd = self.packer.inspect
+        return self._instrumented('inspect', self._inspect, mrf)
 
-        self._add_opt('-machine-readable' if mrf else None)
-        self._add_opt(self.packerfile)
+    def _inspect(self, mrf):
+        if self.in_process and mrf:
+            result = self._inspect_in_process()
+            if result is not None:
+                return result
+        return self._cached('inspect', self._execute_inspect, mrf)
 
-        result = self.packer_cmd()
+    def _execute_inspect(self, mrf):
+        result = self._execute(self._inspect_arguments(mrf))
         if mrf:
             result.parsed_output = self._parse_inspection_output(
                                                         result.stdout.decode())
@@ -125,39 +877,55 @@ class Packer(object):
 
         UNTESTED! Must be used alongside an Atlas account
         """
-        self.packer_cmd = self.packer.push
-
-        self._add_opt('-create=true' if create else None)
-        self._add_opt('-tokn={0}'.format(token) if token else None)
-        self._add_opt(self.packerfile)
+        return self._instrumented(
+            'push', self._execute, self._push_arguments(create, token))
 
-        return self.packer_cmd()
-
-    def validate(self, syntax_only=False):
+    def validate(self, syntax_only=False, timeout=None,
+                 inactivity_timeout=None, kill_timeout=DEFAULT_KILL_TIMEOUT):
         """Validates a Packer Template file (`packer validate`)
 
-        If the validation failed, an `sh` exception will be raised.
+        If the validation failed, `succeeded` is False and `error` holds
+        the failure's description. If it was terminated (see `build`),
+        `terminated` tells why.
         :param bool syntax_only: Whether to validate the syntax only
         without validating the configuration itself.
+        :param float timeout: See `build`
+        :param float inactivity_timeout: See `build`
+        :param float kill_timeout: See `build`
         """
-        self.packer_cmd = self.packer.validate
+        with self._watchdog(timeout, inactivity_timeout,
+                            kill_timeout) as watchdog:
+            return self._instrumented('validate', self._validate,
+                                      syntax_only, watchdog)
+
+    def _validate(self, syntax_only, watchdog=None):
+        if self.in_process and syntax_only:
+            validation = self._validate_in_process()
+            if validation is not None:
+                return validation
+        return self._cached(
+            'validate',
+            lambda syntax_only: self._execute_validate(syntax_only, watchdog),
+            syntax_only)
 
-        self._add_opt('-syntax-only' if syntax_only else None)
-        self._append_base_arguments()
-        self._add_opt(self.packerfile)
+    def _execute_validate(self, syntax_only, watchdog=None):
+        args = self._validate_arguments(syntax_only)
 
-        # as sh raises an exception rather than return a value when execution
-        # fails we create an object to return the exception and the validation
-        # state
+        # as backends raise an exception rather than return a value when
+        # execution fails we create an object to return the exception and the
+        # validation state
         try:
-            validation = self.packer_cmd()
+            validation = self._execute(args, watchdog=watchdog)
             validation.succeeded = validation.exit_code == 0
             validation.error = None
         except Exception as ex:
             validation = ValidationObject()
             validation.succeeded = False
             validation.failed = True
-            validation.error = ex.message
+            validation.error = str(ex)
+            result = getattr(ex, 'result', None)
+            validation.timings = getattr(result, 'timings', None)
+            validation.terminated = getattr(result, 'terminated', None)
         return validation
 
     def version(self):
@@ -167,91 +935,3721 @@ class Packer(object):
         is: Packer vX.Y.Z. This method will only returns the number, without
         the `packer v` prefix so that you don't have to parse the version
         yourself.
+
+        The version is probed once per executable and process, and probed
+        again if the executable changes (e.g. is upgraded).
         """
-        return self.packer.version().split('v')[1].rstrip('\n')
+        return ExecutableInfo.get(self.exec_path, self.backend) \
+            .probe_version(self._execute)
 
-    def _add_opt(self, option):
-        if option:
-            self.packer_cmd = self.packer_cmd.bake(option)
+    def supports(self, command, flag=None):
+        """Returns whether Packer supports `command` (e.g. `build`) and, if
+        given, one of its flags (e.g. `-parallel-builds`)
 
-    def _validate_argtype(self, arg, argtype):
-        if not isinstance(arg, argtype):
-            raise PackerException('{0} argument must be of type {1}'.format(
-                arg, argtype))
-        return arg
+        Supported commands and flags are probed from Packer's help once
+        per executable and process. See `version`.
+        """
+        info = ExecutableInfo.get(self.exec_path, self.backend)
+        with info.lock:
+            if info.commands is None:
+                info.commands = set(HELP_COMMAND_REGEX.findall(
+                    self._help(('-help',))))
+            if command not in info.commands:
+                return False
+            if flag is None:
+                return True
+            if command not in info.flags:
+                info.flags[command] = set(HELP_FLAG_REGEX.findall(
+                    self._help((command, '-h'))))
+            return flag.split('=')[0] in info.flags[command]
 
-    def _append_base_arguments(self):
-        """Appends base arguments to packer commands.
+    @classmethod
+    def build_many(cls, jobs, max_workers=None, fail_fast=False,
+                   processes=False, exec_path=DEFAULT_PACKER_PATH,
+                   backend=None, **kwargs):
+        """Builds many templates concurrently across a pool of workers
 
-        -except, -only, -var and -var-file are appeneded to almost
-        all subcommands in packer. As such this can be called to add
-        these flags to the subcommand.
+        Returns a `BatchResult` holding a `JobResult` per job, in the order
+        the jobs were given. Additional keyword arguments are passed to
+        `build`.
+
+        :param list jobs: `PackerJob`s to build
+        :param int max_workers: Maximum number of concurrent builds.
+         Defaults to the number of CPUs.
+        :param bool fail_fast: Cancel jobs which haven't started yet once a
+         job fails. Otherwise, all jobs are run regardless of failures.
+        :param bool processes: Run jobs in a process pool instead of a
+         thread pool. Results are then always `CommandResult`s and
+         failures `PackerCommandError`s, even with an `ShBackend`.
+        :param string exec_path: Path to Packer executable
+        :param Backend backend: Executes Packer
         """
-        if self.exc and self.only:
-            raise PackerException('Cannot provide both "except" and "only"')
-        elif self.exc:
-            self._add_opt('-except={0}'.format(self._join_comma(self.exc)))
-        elif self.only:
-            self._add_opt('-only={0}'.format(self._join_comma(self.only)))
-        for var, value in self.vars.items():
-            self._add_opt("-var")
-            self._add_opt("{0}={1}".format(var, value))
-        if self.var_file:
-            self._add_opt('-var-file={0}'.format(self.var_file))
+        return _run_many('build', jobs, max_workers, fail_fast, processes,
+                         exec_path, backend, kwargs)
 
-    def _join_comma(self, lst):
-        """Returns a comma delimited string from a list"""
-        return str(','.join(lst))
+    @classmethod
+    def validate_many(cls, jobs, max_workers=None, fail_fast=False,
+                      processes=False, exec_path=DEFAULT_PACKER_PATH,
+                      backend=None, **kwargs):
+        """Validates many templates concurrently. See `build_many`."""
+        return _run_many('validate', jobs, max_workers, fail_fast,
+                         processes, exec_path, backend, kwargs)
 
-    def _parse_inspection_output(self, output):
-        """Parses the machine-readable output `packer inspect` provides.
+    @classmethod
+    def inspect_many(cls, jobs, max_workers=None, fail_fast=False,
+                     processes=False, exec_path=DEFAULT_PACKER_PATH,
+                     backend=None, **kwargs):
+        """Inspects many templates concurrently. See `build_many`."""
+        return _run_many('inspect', jobs, max_workers, fail_fast,
+                         processes, exec_path, backend, kwargs)
 
-        See the inspect method for more info.
-        This has been tested vs. Packer v0.7.5
+    @classmethod
+    def fix_many(cls, templates, max_workers=None, fail_fast=False,
+                 processes=False, exec_path=DEFAULT_PACKER_PATH,
+                 backend=None, pattern='*.json', in_place=True):
+        """Fixes many templates concurrently, rewriting only those which
+        changed (see `fix`). See `build_many`.
+
+        :param list templates: Paths of templates, or of directories
+         whose templates (JSON files matching `pattern` and defining
+         `builders`, outside of hidden directories) are fixed
+        :param string pattern: Shell pattern matching template file names
+        :param bool in_place: Replace the templates which changed
         """
-        parts = {'variables': [], 'builders': [], 'provisioners': []}
-        for line in output.splitlines():
-            line = line.split(',')
-            if line[2].startswith('template'):
-                del line[0:2]
-                component = line[0]
-                if component == 'template-variable':
-                    variable = {"name": line[1], "value": line[2]}
-                    parts['variables'].append(variable)
-                elif component == 'template-builder':
-                    builder = {"name": line[1], "type": line[2]}
-                    parts['builders'].append(builder)
-                elif component == 'template-provisioner':
-                    provisioner = {"type": line[1]}
-                    parts['provisioners'].append(provisioner)
-        return parts
+        jobs = [PackerJob(path)
+                for path in _find_templates(templates, pattern)]
+        return _run_many('fix', jobs, max_workers, fail_fast, processes,
+                         exec_path, backend, {'in_place': in_place})
 
+    @classmethod
+    def build_matrix(cls, packerfile, matrix, vars=None, exc=None,
+                     only=None, var_file=None, max_workers=None,
+                     fail_fast=False, validate=True, inspect=False,
+                     exec_path=DEFAULT_PACKER_PATH, backend=None, **kwargs):
+        """Builds a template for every combination of variable values
 
-class Installer(object):
-    def __init__(self, packer_path, installer_path):
-        self.packer_path = packer_path
-        self.installer_path = installer_path
+        `matrix` maps variable names to lists of values, e.g.
+        `{'region': ['eu-west-1', 'us-east-1'], 'os': ['20.04', '22.04']}`
+        builds the template four times. Each combination is added to
+        `vars`.
 
-    def install(self):
-        with open(self.installer_path, 'rb') as f:
-            zip = zipfile.ZipFile(f)
-            for path in zip.namelist():
-                zip.extract(path, self.packer_path)
-        exec_path = os.path.join(self.packer_path, 'packer')
-        if not self._verify_packer_installed(exec_path):
-            raise PackerException('packer installation failed. '
-                                  'Executable could not be found under: '
-                                  '{0}'.format(exec_path))
+        With `validate`, the template is validated first, once per distinct
+        effective input rather than once per combination: variables the
+        template doesn't reference don't change what it validates to.
+        Combinations which don't validate aren't built. With `inspect`, the
+        template is inspected once, as its inspection doesn't depend on
+        variables. Builds then run concurrently, like `build_many`.
+
+        Returns a `MatrixResult`. Additional keyword arguments are passed
+        to `build`.
+
+        :param string packerfile: Path to Packer template file
+        :param dict matrix: Lists of values per variable name
+        :param dict vars: Variables common to all combinations
+        :param int max_workers: Maximum number of concurrent validations
+         and builds. Defaults to the number of CPUs.
+        :param bool fail_fast: Don't build anything if a combination fails
+         validation, and cancel builds which haven't started yet once a
+         build fails
+        :param bool validate: Validate combinations before building them
+        :param bool inspect: Inspect the template before building
+        """
+        import itertools
+
+        started = time.time()
+        names = list(matrix)
+        combinations = [dict(zip(names, values)) for values
+                        in itertools.product(*(matrix[name]
+                                               for name in names))]
+        jobs = [PackerJob(packerfile, exc=exc, only=only,
+                          vars=dict(vars or {}, **combination),
+                          var_file=var_file, name=','.join(
+                              '{0}={1}'.format(name, value)
+                              for name, value in combination.items()))
+                for combination in combinations]
+        inspection = None
+        if inspect:
+            inspection = cls(packerfile, exc=exc, only=only,
+                             var_file=var_file, exec_path=exec_path,
+                             backend=backend).inspect()
+
+        validations = [None] * len(jobs)
+        if validate:
+            client = cls(packerfile, exec_path=exec_path, backend=backend)
+            distinct = collections.OrderedDict()
+            for index, job in enumerate(jobs):
+                key = client._effective_input_key(job)
+                distinct.setdefault(key, []).append(index)
+            batch = _run_many('validate', [jobs[indexes[0]] for indexes
+                                           in distinct.values()],
+                              max_workers, False, False, exec_path, backend,
+                              {})
+            for indexes, job_result in zip(distinct.values(), batch.results):
+                for index in indexes:
+                    validations[index] = job_result
+
+        buildable = [index for index, validation in enumerate(validations)
+                     if validation is None or validation.succeeded]
+        skipped = set(range(len(jobs))) - set(buildable)
+        results = [JobResult(job) for job in jobs]
+        if not fail_fast or not skipped:
+            batch = _run_many('build', [jobs[index] for index in buildable],
+                              max_workers, fail_fast, False, exec_path,
+                              backend, kwargs)
+            for index, job_result in zip(buildable, batch.results):
+                results[index] = job_result
+        for index in sorted(skipped):
+            validation = validations[index]
+            if validation.error is not None:
+                results[index].error = validation.error
+            else:
+                results[index].error = PackerException(
+                    'validation failed: {0}'.format(
+                        validation.result.error))
+        if fail_fast and skipped:
+            for index in buildable:
+                results[index].cancelled = True
+        return MatrixResult(
+            results, time.time() - started, combinations,
+            [validation.result if validation is not None else None
+             for validation in validations], inspection)
+
+    def build_per_builder(self, max_cpus=None, max_memory=None,
+                          weights=None, max_workers=None, fail_fast=False,
+                          **kwargs):
+        """Builds every builder of the template in its own Packer process
+
+        The builders are listed with `inspect` (honouring `only`/`exc`) and
+        each one is built with `-only`, so that builders running on this
+        host don't contend with each other. Every builder takes the CPUs
+        and memory its type is given in `weights` (`BUILDER_WEIGHTS` by
+        default) and only starts once they're available, so heavy local
+        builders are throttled while remote builders run wide. A builder
+        taking more than the capacity runs alone.
+
+        Returns a `BatchResult` holding a `JobResult` per builder, named
+        after it. Additional keyword arguments are passed to `build`. Each
+        builder is built by a client configured like this one (`out_iter`,
+        `hooks`, `manifest`, ...), so callbacks may be called from several
+        threads at once.
+
+        :param float max_cpus: CPUs builders may take. Defaults to the
+         number of CPUs.
+        :param int max_memory: MiB of memory builders may take. Defaults
+         to the host's physical memory.
+        :param dict weights: (CPUs, MiB of memory) per builder type,
+         overriding `BUILDER_WEIGHTS`
+        :param int max_workers: Maximum number of concurrent builds.
+         Defaults to one per builder.
+        :param bool fail_fast: See `build_many`
+        """
+        builders = self.inspect().parsed_output['builders']
+        if self.only:
+            builders = [b for b in builders if b['name'] in self.only]
+        builders = [b for b in builders if b['name'] not in self.exc]
+        if not builders:
+            return BatchResult([], 0.0)
+        weights = dict(BUILDER_WEIGHTS, **(weights or {}))
+        jobs = [PackerJob(self.packerfile, only=[builder['name']],
+                          vars=self.vars, var_file=self.var_file,
+                          name=builder['name'])
+                for builder in builders]
+        slots = _SlotPool((max_cpus or os.cpu_count(),
+                           max_memory or _physical_memory()))
+        job_weights = [weights.get(builder['type'], DEFAULT_BUILDER_WEIGHT)
+                       for builder in builders]
+        return _run_many('build', jobs, max_workers or len(jobs), fail_fast,
+                         False, self.exec_path, self.backend, kwargs,
+                         slots=slots, weights=job_weights,
+                         options=self._options())
+
+    def _options(self):
+        """Returns the keyword arguments creating a client configured like
+        this one for another template or `only`/`exc`
+        """
+        return {
+            'out_iter': self.out_iter, 'err_iter': self.err_iter,
+            'cache': self.cache, 'in_process': self.in_process,
+            'var_file_threshold': self.var_file_threshold,
+            'hooks': self.hooks, 'manifest': self.manifest,
+            'iso_cache': self.iso_cache, 'cancellable': self.cancellable,
+        }
+
+    def _cache_isos(self):
+        """Downloads the builders' ISOs to the `iso_cache`, returning the
+        path to a copy of the template using them, or None if no builder
+        has a cacheable ISO
+
+        Only http(s) and ftp URLs are cached. Builders whose ISO can't be
+        downloaded keep their URLs, leaving Packer to report the error.
+        """
+        template = self._load_template()
+        expand = self._expander(template)
+        if expand is None:
+            return None
+        data = json.loads(json.dumps(template.data))
+        builders, downloads = [], []
+        for builder in data.get('builders') or []:
+            if not isinstance(builder, dict):
+                continue
+            urls = builder.get('iso_urls') or [builder.get('iso_url')]
+            urls = [expand(url) for url in urls if isinstance(url, str)]
+            checksum = builder.get('iso_checksum')
+            if isinstance(checksum, str):
+                checksum = expand(checksum)
+            checksum_type = builder.get('iso_checksum_type')
+            if not urls or None in urls or not isinstance(checksum, str) or \
+                    not all(ISO_URL_REGEX.match(url) for url in urls):
+                continue
+            builders.append(builder)
+            downloads.append((urls, checksum, checksum_type
+                              if isinstance(checksum_type, str) else None))
+        if not downloads:
+            return None
+        rewritten = False
+        for builder, path in zip(builders, self.iso_cache.fetch_many(
+                downloads, ignore_errors=True)):
+            if path is None:
+                continue
+            builder.pop('iso_urls', None)
+            builder['iso_url'] = 'file://' + path
+            rewritten = True
+        if not rewritten:
+            return None
+        # the copy sits next to the template so that {{template_dir}} and
+        # relative paths keep resolving to the same files
+        fd, path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.packerfile)),
+            prefix='.{0}.'.format(os.path.basename(self.packerfile)),
+            suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        return path
+
+    def _help(self, args):
+        """Returns the help Packer prints for `args`, which it usually
+        prints on stderr and exits with a non-zero code after
+        """
+        try:
+            result = self.backend.run(self.exec_path, args)
+        except Exception as ex:
+            result = getattr(ex, 'result', ex)
+        output = (getattr(result, 'stdout', None) or b'') + \
+            (getattr(result, 'stderr', None) or b'')
+        return output.decode(errors='replace')
+
+    def cancel(self):
+        """Cancels the builds and validations the client is running (see
+        `build`). Returns the number of commands cancelled.
+        """
+        with self._watchdogs_lock:
+            watchdogs = list(self._watchdogs)
+        for watchdog in watchdogs:
+            watchdog.cancel()
+        return len(watchdogs)
+
+    @contextlib.contextmanager
+    def _watchdog(self, timeout, inactivity_timeout, kill_timeout):
+        """Registers a `_Watchdog` for `cancel` while a command runs
+
+        Yields None if there's neither a timeout nor `cancellable`, so that
+        Packer stays in the caller's process group and gets its Ctrl-C.
+        """
+        if timeout is None and inactivity_timeout is None and \
+                not self.cancellable:
+            yield None
+            return
+        watchdog = _Watchdog(timeout, inactivity_timeout, kill_timeout)
+        with self._watchdogs_lock:
+            self._watchdogs.add(watchdog)
+        try:
+            yield watchdog
+        finally:
+            with self._watchdogs_lock:
+                self._watchdogs.discard(watchdog)
+
+    def _execute(self, args, out_iter=None, watchdog=None):
+        return self.backend.run(self.exec_path, args,
+                                out_iter=out_iter or self.out_iter,
+                                err_iter=self.err_iter, watchdog=watchdog)
+
+    def _instrumented(self, command, func, *args, timer=None):
+        """Calls `func(*args)`, recording the `Timings` of the call"""
+        started, clock = time.time(), time.perf_counter()
+        result = error = None
+        try:
+            result = func(*args)
+            return result
+        except Exception as ex:
+            error = ex
+            raise
+        finally:
+            self._record_timings(command, started, clock, timer, result,
+                                 error)
+
+    def _cached(self, command, func, *options):
+        """Returns `func(*options)`, going through the cache if there is one
+
+        Cached results are `CommandResult`s (or `ValidationObject`s for
+        failed validations) whatever the backend.
+        """
+        if self.cache is None:
+            return func(*options)
+        key = self._cache_key(command, options)
+        result = self.cache.get(key)
+        if result is None:
+            result = func(*options)
+            # a terminated command says nothing about the template
+            if not getattr(result, 'terminated', None):
+                self.cache.set(key, result)
         else:
-            return exec_path
+            # Packer wasn't executed, so the cached timings don't apply
+            result.timings = Timings()
+        return result
 
-    def _verify_packer_installed(self, packer_path):
-        return os.path.isfile(packer_path)
+    def _cache_key(self, command, options):
+        """Returns a hash of everything which affects a command's result
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps(
+            [command, options, self.exc, self.only, self.vars,
+             self.var_file, self.version()],
+            sort_keys=True, default=str).encode())
+        for path in (self.packerfile, self.var_file):
+            if path and os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    digest.update(hashlib.sha256(f.read()).digest())
+        return digest.hexdigest()
 
 
-class ValidationObject():
-    pass
+class AsyncPacker(_PackerBase):
+    """An asyncio packer client
+
+    Exposes the same commands as `Packer` as coroutines which run Packer
+    as an asyncio subprocess, so that a single event loop can supervise
+    many concurrent builds and validations. The returned results have
+    the same shape as those returned by `Packer`.
+    """
+
+    def __init__(self, packerfile, exc=None, only=None, vars=None,
+                 var_file=None, exec_path=DEFAULT_PACKER_PATH, out_iter=None,
+                 err_iter=None, semaphore=None, in_process=False,
+                 var_file_threshold=DEFAULT_VAR_FILE_THRESHOLD, hooks=None):
+        """
+        :param string packerfile: Path to Packer template file
+        :param list exc: List of builders to exclude
+        :param list only: List of builders to include
+        :param dict vars: key=value pairs of template variables
+        :param string var_file: Path to variables file
+        :param string exec_path: Path to Packer executable
+        :param out_iter: Called with every line of stdout as it is read.
+         May be a plain function or a coroutine function.
+        :param err_iter: Called with every line of stderr as it is read.
+         May be a plain function or a coroutine function.
+        :param semaphore: An `asyncio.Semaphore`, possibly shared between
+         several clients, capping the number of running Packer processes
+        :param bool in_process: See `Packer`
+        :param int var_file_threshold: See `Packer`
+        :param list hooks: See `Packer`. Resource usage isn't available
+         to the asyncio client.
+        """
+        super(AsyncPacker, self).__init__(
+            packerfile, exc=exc, only=only, vars=vars, var_file=var_file,
+            in_process=in_process, var_file_threshold=var_file_threshold,
+            hooks=hooks)
+        self.exec_path = exec_path
+        self.out_iter = out_iter
+        self.err_iter = err_iter
+        self.semaphore = semaphore
 
+    async def build(self, parallel=True, debug=False, force=False,
+                    machine_readable=False, output_log=None):
+        """Executes a `packer build`
 
-class PackerException(Exception):
-    pass
+        See `Packer.build` regarding `output_log`. The tail of the output
+        of a failed build is available on the `PackerCommandError`'s
+        `result`.
+
+        :param bool parallel: Run builders in parallel
+        :param bool debug: Run in debug mode
+        :param bool force: Force artifact output even if exists
+        :param bool machine_readable: Make output machine-readable
+        :param OutputLog output_log: Log to stream the output to
+        """
+        args = self._build_arguments(parallel, debug, force, machine_readable)
+        timer = BuilderTimer() if machine_readable else None
+        return await self._instrumented(
+            'build', self._build, args, timer, output_log, timer=timer)
+
+    async def _build(self, args, timer, output_log):
+        out_iter = self.out_iter
+        if timer is not None:
+            out_iter = self._chain(timer.feed, out_iter)
+        if output_log is None:
+            result = await self._run(*args, out_iter=out_iter)
+            return self._set_artifacts(result, timer)
+
+        try:
+            result = await self._run(
+                *args,
+                out_iter=self._chain(output_log.write, out_iter),
+                err_iter=self._chain(output_log.write, self.err_iter),
+                keep_stdout=False, keep_stderr=False)
+        except Exception as ex:
+            self._attach_log(ex, output_log)
+            raise
+        finally:
+            output_log.close()
+        self._attach_log(result, output_log)
+        return self._set_artifacts(result, timer)
+
+    async def build_events(self, parallel=True, debug=False, force=False):
+        """Executes a `packer build -machine-readable`, yielding its output
+        as `MachineReadableEvent`s while the build runs.
+
+        Output is parsed line by line as it is produced and is not kept in
+        memory. A `PackerCommandError` is raised once the output is
+        exhausted if the build failed.
+
+        :param bool parallel: Run builders in parallel
+        :param bool debug: Run in debug mode
+        :param bool force: Force artifact output even if exists
+        """
+        import asyncio
+
+        parser = MachineReadableParser()
+        # a bounded queue applies backpressure to the reader of Packer's
+        # stdout when the consumer of the events falls behind
+        lines = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+        async def run():
+            try:
+                return await self._run(
+                    *self._build_arguments(
+                        parallel, debug, force, machine_readable=True),
+                    out_iter=lines.put, keep_stdout=False)
+            finally:
+                await lines.put(None)
+
+        task = asyncio.ensure_future(run())
+        try:
+            while True:
+                line = await lines.get()
+                if line is None:
+                    break
+                for event in parser.feed(line):
+                    yield event
+            await task
+        finally:
+            if not task.done():
+                task.cancel()
+
+    async def fix(self, to_file=None, in_place=False):
+        """Implements the `packer fix` function. See `Packer.fix`.
+
+        :param string to_file: File to output fixed template to
+        :param bool in_place: Replace the template with the fixed one if
+         it changed
+        """
+        result = await self._instrumented(
+            'fix', self._run, *self._fix_arguments())
+        result.fixed = json.loads(result.stdout.decode())
+        self._write_fixed(result, to_file, in_place)
+        return result
+
+    async def inspect(self, mrf=True):
+        """Inspects a Packer Templates file (`packer inspect`)
+
+        See `Packer.inspect` for the format of `parsed_output`.
+
+        :param bool mrf: output in machine-readable form.
+        """
+        return await self._instrumented('inspect', self._inspect, mrf)
+
+    async def _inspect(self, mrf):
+        if self.in_process and mrf:
+            result = self._inspect_in_process()
+            if result is not None:
+                return result
+        result = await self._run(*self._inspect_arguments(mrf))
+        if mrf:
+            result.parsed_output = self._parse_inspection_output(
+                                                        result.stdout.decode())
+        else:
+            result.parsed_output = None
+        return result
+
+    async def push(self, create=True, token=False):
+        """Implmenets the `packer push` function
+
+        UNTESTED! Must be used alongside an Atlas account
+        """
+        return await self._instrumented(
+            'push', self._run, *self._push_arguments(create, token))
+
+    async def validate(self, syntax_only=False):
+        """Validates a Packer Template file (`packer validate`)
+
+        Failures do not raise. Instead, `succeeded` is set to False and
+        `error` holds the failure's description.
+
+        :param bool syntax_only: Whether to validate the syntax only
+        without validating the configuration itself.
+        """
+        return await self._instrumented('validate', self._validate,
+                                        syntax_only)
+
+    async def _validate(self, syntax_only):
+        if self.in_process and syntax_only:
+            validation = self._validate_in_process()
+            if validation is not None:
+                return validation
+        try:
+            validation = await self._run(
+                *self._validate_arguments(syntax_only))
+            validation.succeeded = validation.exit_code == 0
+            validation.error = None
+        except PackerCommandError as ex:
+            validation = ValidationObject()
+            validation.succeeded = False
+            validation.failed = True
+            validation.error = str(ex)
+            validation.timings = ex.result.timings
+        return validation
+
+    async def version(self):
+        """Returns Packer's version number (`packer version`)
+
+        See `Packer.version`.
+        """
+        info = ExecutableInfo.get(self.exec_path)
+        if info.version is None:
+            result = await self._run('version')
+            info.version = _parse_version(result.stdout.decode())
+        return info.version
+
+    async def _instrumented(self, command, func, *args, timer=None):
+        """Awaits `func(*args)`, recording the `Timings` of the call"""
+        started, clock = time.time(), time.perf_counter()
+        result = error = None
+        try:
+            result = await func(*args)
+            return result
+        except Exception as ex:
+            error = ex
+            raise
+        finally:
+            self._record_timings(command, started, clock, timer, result,
+                                 error)
+
+    async def _run(self, *args, out_iter=None, err_iter=None,
+                   keep_stdout=True, keep_stderr=True):
+        args = list(args)
+        streams = (out_iter or self.out_iter, err_iter or self.err_iter,
+                   keep_stdout, keep_stderr)
+        if self.semaphore is None:
+            return await self._execute(args, *streams)
+        async with self.semaphore:
+            return await self._execute(args, *streams)
+
+    async def _execute(self, args, out_iter, err_iter, keep_stdout,
+                       keep_stderr):
+        import asyncio
+
+        clock = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            self.exec_path, *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=STREAM_LINE_LIMIT)
+        spawn_latency = time.perf_counter() - clock
+        try:
+            stdout, stderr = await asyncio.gather(
+                self._read_stream(process.stdout, out_iter, keep_stdout),
+                self._read_stream(process.stderr, err_iter, keep_stderr))
+            exit_code = await process.wait()
+        except BaseException:
+            # don't leave an orphaned packer process behind, with nobody
+            # reading its output, when the task supervising it is cancelled
+            # or reading the output failed (e.g. a callback raised)
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        result = CommandResult(
+            [self.exec_path] + args, stdout, stderr, exit_code)
+        result.timings = Timings(spawn_latency=spawn_latency)
+        if exit_code != 0:
+            raise PackerCommandError(result)
+        return result
+
+    async def _read_stream(self, stream, callback, keep_output):
+        lines = []
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            if keep_output:
+                lines.append(line)
+            if callback is not None:
+                ret = callback(line.decode(errors='replace'))
+                if hasattr(ret, '__await__'):
+                    await ret
+        return b''.join(lines)
+
+
+class ExecutableInfo(object):
+    """The version and capabilities of a Packer executable, shared by all
+    clients of a process
+
+    Information is probed lazily by the clients and kept until the
+    executable changes. Executables are identified by their resolved path
+    along with their inode, size and modification time, so that upgrading
+    Packer in place invalidates what was probed.
+
+    :ivar string version: Packer's version, once probed
+    :ivar set commands: The commands Packer supports, once probed
+    :ivar dict flags: The flags of every command probed so far
+    """
+
+    _executables = {}
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.version = None
+        self.commands = None
+        self.flags = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls, exec_path, backend=None):
+        """Returns the `ExecutableInfo` of `exec_path` as run by `backend`
+
+        Executables which can't be resolved to a file, or run by a
+        `FakeBackend`, get a new `ExecutableInfo` every time, so nothing is
+        memoized for them.
+        """
+        if isinstance(backend, FakeBackend):
+            return cls()
+        path = shutil.which(exec_path)
+        if path is None:
+            return cls()
+        path = os.path.realpath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return cls()
+        signature = (stat.st_dev, stat.st_ino, stat.st_size,
+                     stat.st_mtime_ns)
+        with cls._lock:
+            entry = cls._executables.get(path)
+            if entry is None or entry[0] != signature:
+                entry = (signature, cls())
+                cls._executables[path] = entry
+            return entry[1]
+
+    def probe_version(self, execute):
+        """Returns the version, calling `execute(args)` to run
+        `packer version` if it wasn't probed yet
+        """
+        with self.lock:
+            if self.version is None:
+                self.version = _parse_version(
+                    execute(('version',)).stdout.decode())
+            return self.version
+
+    @classmethod
+    def clear(cls):
+        """Forgets everything probed"""
+        with cls._lock:
+            cls._executables.clear()
+
+
+def _parse_version(output):
+    """Returns the version number out of `packer version`'s output, e.g.
+    `1.2.3` out of `Packer v1.2.3`
+    """
+    match = VERSION_REGEX.search(output)
+    return match.group('version') if match else output.strip()
+
+
+class Timings(object):
+    """Timing and resource usage of a command
+
+    :ivar string command: The Packer subcommand, e.g. `build`
+    :ivar float started: Unix time at which the command was called
+    :ivar float wall_time: Seconds the call took, including the wrapper
+    :ivar float spawn_latency: Seconds it took to spawn Packer, or None if
+     Packer wasn't executed (e.g. a cached result)
+    :ivar float user_time: CPU seconds Packer spent in user mode
+    :ivar float system_time: CPU seconds Packer spent in kernel mode
+    :ivar int max_rss: Peak resident set size of Packer, in bytes
+    :ivar dict builders: For machine-readable builds, a dict per builder
+     with its `started` and `finished` timestamps, `duration` in seconds
+     and whether it `errored`, as reported by Packer
+    """
+
+    def __init__(self, spawn_latency=None):
+        self.command = None
+        self.started = None
+        self.wall_time = None
+        self.spawn_latency = spawn_latency
+        self.user_time = None
+        self.system_time = None
+        self.max_rss = None
+        self.builders = {}
+
+    def set_rusage(self, rusage):
+        """Records the resource usage returned by `os.wait4`"""
+        self.user_time = rusage.ru_utime
+        self.system_time = rusage.ru_stime
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        self.max_rss = rusage.ru_maxrss * (
+            1 if sys.platform == 'darwin' else 1024)
+
+    def __repr__(self):
+        return 'Timings(command={0!r}, wall_time={1}, spawn_latency={2})'\
+            .format(self.command, self.wall_time, self.spawn_latency)
+
+
+class BuilderTimer(object):
+    """Tracks when builders start and finish from machine-readable output
+
+    `feed` is meant to be used as an output callback. `builders` maps
+    every builder's name to its `started` and `finished` timestamps, its
+    `duration` and whether it `errored`. `artifacts` lists the artifacts
+    reported by Packer as dicts of their keys, plus the `builder` which
+    produced them.
+    """
+
+    def __init__(self):
+        self.parser = MachineReadableParser()
+        self.builders = {}
+        self.artifacts = []
+        self._artifacts = {}
+
+    def restart(self):
+        """Starts tracking the output of another execution (e.g. a retry)
+        while keeping what was tracked so far
+        """
+        self.parser = MachineReadableParser()
+
+    def errored_builders(self):
+        """Returns the names of the builders whose last run errored"""
+        return sorted(name for name, builder in self.builders.items()
+                      if builder['errored'])
+
+    def feed(self, line):
+        for event in self.parser.feed(line):
+            if isinstance(event, ArtifactEvent):
+                artifact = self._artifacts.get((event.target, event.index))
+                if artifact is None:
+                    artifact = {'builder': event.target}
+                    self._artifacts[event.target, event.index] = artifact
+                    self.artifacts.append(artifact)
+                if event.key is not None:
+                    artifact[event.key] = event.value
+            elif isinstance(event, BuilderStartEvent):
+                self.builders[event.target] = {
+                    'started': event.timestamp, 'finished': None,
+                    'duration': None, 'errored': False}
+            elif isinstance(event, BuilderFinishEvent):
+                builder = self.builders.setdefault(event.target, {
+                    'started': event.timestamp, 'errored': False})
+                builder['finished'] = event.timestamp
+                builder['duration'] = event.timestamp - builder['started']
+                builder['errored'] = event.errored
+
+
+class Template(object):
+    """A parsed Packer JSON template
+
+    Answers what `packer inspect` and `packer validate -syntax-only` do
+    without executing Packer.
+    """
+
+    def __init__(self, data, path=None):
+        """
+        :param dict data: The template's parsed JSON
+        :param string path: Path the template was loaded from
+        """
+        self.data = data
+        self.path = path
+
+    @classmethod
+    def load(cls, path):
+        """Loads a template from a file
+
+        Raises `ValueError` if the file isn't a JSON object.
+        """
+        with open(path) as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError('template must be a JSON object')
+        return cls(data, path)
+
+    @property
+    def variables(self):
+        """A dict of the template's variables and their default values.
+        Required variables have a None value.
+        """
+        variables = self.data.get('variables')
+        return variables if isinstance(variables, dict) else {}
+
+    @property
+    def builders(self):
+        """The template's builder definitions"""
+        return self._components('builders')
+
+    @property
+    def provisioners(self):
+        """The template's provisioner definitions"""
+        return self._components('provisioners')
+
+    @property
+    def post_processors(self):
+        """The template's post-processor definitions, flattened
+
+        Packer accepts a post-processor as a type name, a definition or a
+        list of either (a sequence). All are returned as definitions.
+        """
+        post_processors = []
+        for post_processor in self.data.get('post-processors') or []:
+            sequence = post_processor \
+                if isinstance(post_processor, list) else [post_processor]
+            for item in sequence:
+                if not isinstance(item, dict):
+                    item = {'type': item}
+                post_processors.append(item)
+        return post_processors
+
+    @property
+    def builder_names(self):
+        """The builders' names, which default to their type"""
+        return [self.builder_name(builder) for builder in self.builders]
+
+    @staticmethod
+    def builder_name(builder):
+        return builder.get('name') or builder.get('type')
+
+    def user_variable_references(self):
+        """Returns the names of all user variables referenced through
+        ``{{user `name`}}`` by the template's components
+        """
+        references = set()
+        for component in self.builders + self.provisioners + \
+                self.post_processors:
+            references.update(
+                USER_VARIABLE_REGEX.findall(json.dumps(component)))
+        return references
+
+    def undeclared_variables(self):
+        """Returns referenced user variables missing from `variables`"""
+        return self.user_variable_references() - set(self.variables)
+
+    def inspect(self):
+        """Returns what `Packer.inspect` parses from `packer inspect`
+
+        Like Packer, required variables come first, variables and
+        builders are sorted by name and provisioners keep their order.
+        """
+        variables = self.variables
+        names = sorted(variables)
+        required = [name for name in names if variables[name] is None]
+        optional = [name for name in names if variables[name] is not None]
+        return {
+            'variables': [
+                {'name': name, 'value': self._variable_value(
+                    variables[name])}
+                for name in required + optional],
+            'builders': sorted(
+                [{'name': self.builder_name(builder),
+                  'type': builder.get('type')}
+                 for builder in self.builders],
+                key=lambda builder: builder['name']),
+            'provisioners': [
+                {'type': provisioner.get('type')}
+                for provisioner in self.provisioners],
+        }
+
+    def syntax_errors(self):
+        """Returns the errors `packer validate -syntax-only` would report
+        """
+        errors = []
+        for key in self.data:
+            if key not in TEMPLATE_KEYS and not key.startswith('_'):
+                errors.append('Unknown root level key in template: '
+                              '{0!r}'.format(key))
+        if 'variables' in self.data and \
+                not isinstance(self.data['variables'], dict):
+            errors.append('variables must be an object')
+        if not self.builders:
+            errors.append('at least one builder must be defined')
+        names = set()
+        for index, builder in enumerate(self.builders):
+            name = self.builder_name(builder)
+            if not builder.get('type'):
+                errors.append('builder {0}: missing \'type\''.format(index))
+            elif name in names:
+                errors.append('builder {0}: builder with name {1!r} already '
+                              'exists'.format(index, name))
+            names.add(name)
+        for kind, components in (('provisioner', self.provisioners),
+                                 ('post-processor', self.post_processors)):
+            for index, component in enumerate(components):
+                if not component.get('type'):
+                    errors.append('{0} {1}: missing \'type\''.format(
+                        kind, index + 1))
+                for key in ('only', 'except'):
+                    for builder in component.get(key) or []:
+                        if builder not in names:
+                            errors.append(
+                                '{0} {1}: {2!r} specified builder {3!r} not '
+                                'found'.format(kind, index + 1, key, builder))
+        return errors
+
+    def local_files(self):
+        """Returns the local files the template's provisioners upload or
+        execute: `script` and `scripts` of any provisioner and `source` of
+        `file` provisioners, as written in the template.
+        """
+        paths = []
+        for provisioner in self.provisioners:
+            keys = ['script', 'scripts']
+            if provisioner.get('type') == 'file' and \
+                    provisioner.get('direction', 'upload') == 'upload':
+                keys.append('source')
+            for key in keys:
+                value = provisioner.get(key)
+                if isinstance(value, str):
+                    paths.append(value)
+                elif isinstance(value, list):
+                    paths.extend(path for path in value
+                                 if isinstance(path, str))
+        return paths
+
+    def _components(self, key):
+        components = self.data.get(key) or []
+        if not isinstance(components, list):
+            return []
+        return [component for component in components
+                if isinstance(component, dict)]
+
+    @staticmethod
+    def _variable_value(value):
+        if value is None:
+            return ''
+        return value if isinstance(value, str) else json.dumps(value)
+
+
+class PackerJob(object):
+    """A template to run as part of a batch (see `Packer.build_many`)
+
+    Accepts the same template arguments `Packer` does. `name` identifies
+    the job and defaults to `packerfile`.
+    """
+
+    def __init__(self, packerfile, exc=None, only=None, vars=None,
+                 var_file=None, name=None):
+        self.packerfile = packerfile
+        self.exc = exc
+        self.only = only
+        self.vars = vars
+        self.var_file = var_file
+        self.name = name or packerfile
+
+    def __repr__(self):
+        return 'PackerJob({0!r})'.format(self.name)
+
+
+class JobResult(object):
+    """The outcome of a single job of a batch
+
+    :ivar PackerJob job: The job
+    :ivar result: The command's result, if it completed
+    :ivar Exception error: The error raised by the command, if it failed
+    :ivar bool cancelled: Whether the job was cancelled before it started
+    :ivar float duration: Seconds the job ran for
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.duration = 0.0
+
+    @property
+    def succeeded(self):
+        if self.cancelled or self.error is not None:
+            return False
+        return getattr(self.result, 'succeeded', True)
+
+    def __repr__(self):
+        return 'JobResult({0!r}, succeeded={1})'.format(
+            self.job.name, self.succeeded)
+
+
+class BatchResult(object):
+    """The outcome of a batch of jobs
+
+    :ivar list results: A `JobResult` per job, in the order of the jobs
+    :ivar float duration: Wall-clock seconds the batch ran for
+    """
+
+    def __init__(self, results, duration):
+        self.results = results
+        self.duration = duration
+
+    @property
+    def succeeded(self):
+        return all(result.succeeded for result in self.results)
+
+    @property
+    def failed(self):
+        """Results of jobs which failed or were cancelled"""
+        return [result for result in self.results if not result.succeeded]
+
+    @property
+    def total_duration(self):
+        """Cumulative seconds spent running jobs"""
+        return sum(result.duration for result in self.results)
+
+
+class MatrixResult(BatchResult):
+    """The outcome of a matrix build (see `Packer.build_matrix`)
+
+    :ivar list results: A `JobResult` per combination, in order
+    :ivar float duration: Wall-clock seconds the matrix ran for
+    :ivar list combinations: The combinations of variable values
+    :ivar list validations: The validation of every combination, shared
+     by combinations with the same effective input, or None if they
+     weren't validated
+    :ivar inspection: The template's inspection, if it was inspected
+    """
+
+    def __init__(self, results, duration, combinations, validations,
+                 inspection):
+        super(MatrixResult, self).__init__(results, duration)
+        self.combinations = combinations
+        self.validations = validations
+        self.inspection = inspection
+
+    def get(self, combination):
+        """Returns the `JobResult` of `combination`, a dict of variable
+        values
+        """
+        return self.results[self.combinations.index(combination)]
+
+    def items(self):
+        """Returns `(combination, JobResult)` pairs"""
+        return list(zip(self.combinations, self.results))
+
+
+def _run_many(command, jobs, max_workers, fail_fast, processes, exec_path,
+              backend, kwargs, slots=None, weights=None, options=None):
+    """Runs `jobs` in a pool, each job taking its weight in `slots` (a
+    `_SlotPool`, thread pools only) while it runs if given. `options` are
+    additional keyword arguments of the jobs' clients.
+    """
+    import concurrent.futures
+
+    executor_class = concurrent.futures.ProcessPoolExecutor if processes \
+        else concurrent.futures.ThreadPoolExecutor
+    results = [JobResult(job) for job in jobs]
+    started = time.time()
+    with executor_class(max_workers=max_workers or os.cpu_count()) \
+            as executor:
+        if slots is None:
+            futures = dict(
+                (executor.submit(_run_job, command, job, exec_path, backend,
+                                 kwargs, processes, options), result)
+                for job, result in zip(jobs, results))
+        else:
+            futures = dict(
+                (executor.submit(slots.run, weight, _run_job, command, job,
+                                 exec_path, backend, kwargs, processes,
+                                 options),
+                 result)
+                for job, weight, result in zip(jobs, weights, results))
+        for future in concurrent.futures.as_completed(futures):
+            job_result = futures[future]
+            if future.cancelled():
+                job_result.cancelled = True
+                continue
+            try:
+                job_result.result, job_result.duration = future.result()
+            except Exception as ex:
+                job_result.error = ex
+            if fail_fast and not job_result.succeeded:
+                for pending in futures:
+                    pending.cancel()
+    for future, job_result in futures.items():
+        if future.cancelled():
+            job_result.cancelled = True
+    return BatchResult(results, time.time() - started)
+
+
+def _run_job(command, job, exec_path, backend, kwargs, portable,
+             options=None):
+    """Runs a single job, returning its result and duration
+
+    If `portable` is set, the result is converted to a picklable
+    `CommandResult` so that it can be passed between processes.
+    """
+    started = time.time()
+    client = Packer(job.packerfile, exc=job.exc, only=job.only,
+                    vars=job.vars, var_file=job.var_file,
+                    exec_path=exec_path, backend=backend, **(options or {}))
+    try:
+        result = getattr(client, command)(**kwargs)
+    except Exception as ex:
+        # `sh` exceptions can't be pickled
+        if not portable or isinstance(ex, PackerCommandError) or \
+                not hasattr(ex, 'full_cmd'):
+            raise
+        raise PackerCommandError(CommandResult(
+            ex.full_cmd.split(' '), ex.stdout, ex.stderr, ex.exit_code))
+    if portable and not isinstance(result, (ValidationObject,
+                                            CommandResult)):
+        result = CommandResult.from_sh(result)
+    return result, time.time() - started
+
+
+class _SlotPool(object):
+    """Host resources (e.g. CPUs and memory) shared by concurrent jobs
+
+    A job waits until its weight fits in what's left of `capacity`, or
+    until nothing else runs if it's heavier than `capacity`. Waiting jobs
+    which fit start first, so light jobs aren't held up by heavy ones.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.used = tuple(0 for _ in capacity)
+        self.running = 0
+        self._condition = threading.Condition()
+
+    def run(self, weight, func, *args):
+        with self._condition:
+            self._condition.wait_for(lambda: self._fits(weight))
+            self._take(weight, 1)
+        try:
+            return func(*args)
+        finally:
+            with self._condition:
+                self._take(tuple(-amount for amount in weight), -1)
+                self._condition.notify_all()
+
+    def _fits(self, weight):
+        return self.running == 0 or all(
+            used + amount <= capacity for used, amount, capacity
+            in zip(self.used, weight, self.capacity))
+
+    def _take(self, weight, jobs):
+        self.used = tuple(used + amount
+                          for used, amount in zip(self.used, weight))
+        self.running += jobs
+
+
+def _physical_memory():
+    """Returns the host's physical memory in MiB, or infinity if unknown"""
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') \
+            // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return float('inf')
+
+
+class QueuedJob(object):
+    """A job stored in a `BuildQueue`
+
+    :ivar int id: The job's id in the queue
+    :ivar PackerJob job: The template to build
+    :ivar dict options: Keyword arguments passed to `Packer.build`
+    :ivar string state: `pending`, `running`, `succeeded` or `failed`
+    :ivar int attempts: Number of times the job was leased
+    :ivar string worker: Name of the worker which last leased the job
+    :ivar float created: Unix time at which the job was queued
+    :ivar float started: Unix time at which the job was last leased
+    :ivar float finished: Unix time at which the job completed
+    :ivar int exit_code: Packer's exit code, if it ran
+    :ivar string error: Description of the failure, if any
+    :ivar list artifacts: The artifacts of a machine-readable build
+    :ivar string log_path: Path to the build's log on the worker's host
+    """
+
+    def __init__(self, id, job, options, state, attempts, worker, created,
+                 started, finished, exit_code, error, artifacts, log_path):
+        self.id = id
+        self.job = job
+        self.options = options
+        self.state = state
+        self.attempts = attempts
+        self.worker = worker
+        self.created = created
+        self.started = started
+        self.finished = finished
+        self.exit_code = exit_code
+        self.error = error
+        self.artifacts = artifacts
+        self.log_path = log_path
+
+    def __repr__(self):
+        return 'QueuedJob({0}, {1!r}, state={2!r})'.format(
+            self.id, self.job.name, self.state)
+
+
+class BuildQueue(object):
+    """A persistent queue of builds, stored in an SQLite database
+
+    Jobs are leased by `BuildWorker`s, which may run in several processes
+    or on several hosts sharing the database (which then requires a
+    filesystem with working locks and hosts with synchronized clocks).
+    A lease expires after `lease_seconds` unless the worker renews it
+    with `heartbeat`, after which the job is leased again by another
+    worker. Jobs leased `max_attempts` times without completing (e.g.
+    because their workers kept crashing) are failed.
+    """
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            packerfile TEXT NOT NULL,
+            exc TEXT NOT NULL,
+            only TEXT NOT NULL,
+            vars TEXT NOT NULL,
+            var_file TEXT,
+            options TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            lease_expires REAL,
+            created REAL NOT NULL,
+            started REAL,
+            finished REAL,
+            exit_code INTEGER,
+            error TEXT,
+            artifacts TEXT,
+            log_path TEXT)""",
+        'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)',
+    )
+    COLUMNS = ('id', 'name', 'packerfile', 'exc', 'only', 'vars', 'var_file',
+               'options', 'state', 'attempts', 'worker', 'created',
+               'started', 'finished', 'exit_code', 'error', 'artifacts',
+               'log_path')
+
+    def __init__(self, path, lease_seconds=DEFAULT_LEASE_SECONDS,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        :param string path: Path to the SQLite database, created if needed
+        :param float lease_seconds: Seconds a leased job is reserved for
+         without a heartbeat
+        :param int max_attempts: Times a job is leased before being failed
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        with self._transaction() as db:
+            for statement in self.SCHEMA:
+                db.execute(statement)
+
+    def put(self, job, **options):
+        """Queues `job`, returning its id
+
+        :param PackerJob job: The template to build
+        :param options: Keyword arguments passed to `Packer.build`, which
+         must be JSON-serializable
+        """
+        with self._transaction() as db:
+            return db.execute(
+                'INSERT INTO jobs (name, packerfile, exc, only, vars, '
+                'var_file, options, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (job.name, job.packerfile, json.dumps(job.exc or []),
+                 json.dumps(job.only or []), json.dumps(job.vars or {}),
+                 job.var_file, json.dumps(options), time.time())).lastrowid
+
+    def get(self, job_id):
+        """Returns the `QueuedJob` with `job_id`, or None"""
+        rows = self._select('WHERE id = ?', (job_id,))
+        return rows[0] if rows else None
+
+    def jobs(self, state=None):
+        """Returns the `QueuedJob`s in `state`, or all of them"""
+        if state is None:
+            return self._select('ORDER BY id', ())
+        return self._select('WHERE state = ? ORDER BY id', (state,))
+
+    def counts(self):
+        """Returns the number of jobs in each state"""
+        db = self._connect()
+        return dict(db.execute(
+            'SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def lease(self, worker):
+        """Leases the oldest pending job (or one whose lease expired) to
+        `worker`, returning it as a `QueuedJob`, or None if there's none
+        """
+        now = time.time()
+        with self._transaction() as db:
+            while True:
+                row = db.execute(
+                    "SELECT id, attempts FROM jobs WHERE state = 'pending' "
+                    "OR (state = 'running' AND lease_expires < ?) "
+                    "ORDER BY id LIMIT 1", (now,)).fetchone()
+                if row is None:
+                    return None
+                job_id, attempts = row
+                if attempts < self.max_attempts:
+                    break
+                db.execute(
+                    "UPDATE jobs SET state = 'failed', finished = ?, "
+                    "error = ? WHERE id = ?",
+                    (now, 'lease expired {0} times'.format(attempts),
+                     job_id))
+            db.execute(
+                "UPDATE jobs SET state = 'running', worker = ?, "
+                "lease_expires = ?, started = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                (worker, now + self.lease_seconds, now, job_id))
+        return self.get(job_id)
+
+    def heartbeat(self, job_id, worker):
+        """Renews `worker`'s lease of a job. Returns False if the lease
+        was lost, in which case another worker may be running the job.
+        """
+        with self._transaction() as db:
+            return db.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND "
+                "worker = ? AND state = 'running'",
+                (time.time() + self.lease_seconds, job_id,
+                 worker)).rowcount == 1
+
+    def complete(self, job_id, worker, result=None, error=None):
+        """Records the outcome of a job leased by `worker`. Returns False
+        if the lease was lost, in which case nothing is recorded.
+
+        :param result: The build's result, if it succeeded
+        :param Exception error: The exception raised by the build
+        """
+        outcome = result if error is None else getattr(error, 'result', None)
+        with self._transaction() as db:
+            return db.execute(
+                "UPDATE jobs SET state = ?, finished = ?, exit_code = ?, "
+                "error = ?, artifacts = ?, log_path = ? WHERE id = ? AND "
+                "worker = ? AND state = 'running'",
+                ('succeeded' if error is None else 'failed', time.time(),
+                 getattr(outcome, 'exit_code', None),
+                 None if error is None else str(error),
+                 json.dumps(getattr(outcome, 'artifacts', None)),
+                 getattr(outcome, 'log_path', None), job_id,
+                 worker)).rowcount == 1
+
+    def requeue(self, job_id):
+        """Queues a completed job again, e.g. to retry a failed build"""
+        with self._transaction() as db:
+            return db.execute(
+                "UPDATE jobs SET state = 'pending', attempts = 0, "
+                "worker = NULL, lease_expires = NULL WHERE id = ? AND "
+                "state IN ('succeeded', 'failed')", (job_id,)).rowcount == 1
+
+    def _connect(self):
+        """Returns this thread's connection to the database"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            import sqlite3
+
+            # transactions are managed explicitly by `_transaction`
+            db = sqlite3.connect(self.path, timeout=60,
+                                 isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return db
+
+    def _transaction(self):
+        return _Transaction(self._connect())
+
+    def _select(self, clause, parameters):
+        db = self._connect()
+        rows = db.execute('SELECT {0} FROM jobs {1}'.format(
+            ', '.join(self.COLUMNS), clause), parameters).fetchall()
+        jobs = []
+        for row in rows:
+            row = dict(zip(self.COLUMNS, row))
+            job = PackerJob(row['packerfile'], exc=json.loads(row['exc']),
+                            only=json.loads(row['only']),
+                            vars=json.loads(row['vars']),
+                            var_file=row['var_file'], name=row['name'])
+            jobs.append(QueuedJob(
+                row['id'], job, json.loads(row['options']), row['state'],
+                row['attempts'], row['worker'], row['created'],
+                row['started'], row['finished'], row['exit_code'],
+                row['error'], json.loads(row['artifacts'] or 'null'),
+                row['log_path']))
+        return jobs
+
+
+class _Transaction(object):
+    """Runs a block in an SQLite transaction which takes the database's
+    write lock upfront, so that concurrent leases can't deadlock
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+class BuildWorker(object):
+    """Builds the jobs of a `BuildQueue`
+
+    While a job builds, its lease is renewed in the background. If the
+    lease is lost anyway (e.g. the worker stalled for longer than the
+    queue's `lease_seconds`), the build is cancelled, since another worker
+    may then lease the job. Every build's output is written to
+    `<log_dir>/<job id>.log` if `log_dir` is given.
+    """
+
+    def __init__(self, queue, name=None, exec_path=DEFAULT_PACKER_PATH,
+                 backend=None, log_dir=None,
+                 poll_interval=DEFAULT_POLL_INTERVAL):
+        """
+        :param BuildQueue queue: The queue to take jobs from
+        :param string name: Identifies the worker in leases. Defaults to
+         the host's name and the process' id.
+        :param string exec_path: Path to Packer executable
+        :param Backend backend: Executes Packer
+        :param string log_dir: Directory to write the builds' logs to
+        :param float poll_interval: Seconds to wait for jobs when the queue
+         is empty
+        """
+        import platform
+
+        self.queue = queue
+        self.name = name or '{0}:{1}'.format(platform.node(), os.getpid())
+        self.exec_path = exec_path
+        self.backend = backend
+        self.log_dir = log_dir
+        self.poll_interval = poll_interval
+        if log_dir and not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+
+    def run(self, max_jobs=None, wait=True):
+        """Builds jobs until `max_jobs` were built, returning how many were
+
+        :param int max_jobs: Number of jobs to build. Unlimited by default.
+        :param bool wait: Wait for more jobs when the queue is empty.
+         Otherwise, return once it is.
+        """
+        count = 0
+        while max_jobs is None or count < max_jobs:
+            queued = self.queue.lease(self.name)
+            if queued is None:
+                if not wait:
+                    break
+                time.sleep(self.poll_interval)
+                continue
+            self.build(queued)
+            count += 1
+        return count
+
+    def build(self, queued):
+        """Builds a leased `QueuedJob`, recording its outcome in the queue
+        """
+        stopped = threading.Event()
+        heartbeat = None
+        result = error = None
+        try:
+            job = queued.job
+            client = Packer(job.packerfile, exc=job.exc, only=job.only,
+                            vars=job.vars, var_file=job.var_file,
+                            exec_path=self.exec_path, backend=self.backend,
+                            cancellable=True)
+            heartbeat = threading.Thread(target=self._heartbeat,
+                                         args=(queued.id, client, stopped))
+            heartbeat.daemon = True
+            heartbeat.start()
+            options = dict(queued.options)
+            if self.log_dir:
+                options['output_log'] = OutputLog(os.path.join(
+                    self.log_dir, '{0}.log'.format(queued.id)))
+            result = client.build(**options)
+        except Exception as ex:
+            error = ex
+        finally:
+            stopped.set()
+            if heartbeat is not None:
+                heartbeat.join()
+        self.queue.complete(queued.id, self.name, result=result, error=error)
+
+    def _heartbeat(self, job_id, client, stopped):
+        lost = False
+        while not stopped.wait(self.queue.lease_seconds / 3.0):
+            lost = lost or not self.queue.heartbeat(job_id, self.name)
+            if lost:
+                # keep cancelling until the build stops, as it may not
+                # have started Packer yet
+                client.cancel()
+
+
+def run_workers(path, processes=None, wait=False,
+                lease_seconds=DEFAULT_LEASE_SECONDS,
+                max_attempts=DEFAULT_MAX_ATTEMPTS, **kwargs):
+    """Drains the `BuildQueue` at `path` with `BuildWorker`s running in
+    `processes` worker processes (one per CPU by default), returning once
+    they exit.
+
+    :param bool wait: Keep waiting for jobs once the queue is empty
+    :param float lease_seconds: See `BuildQueue`
+    :param int max_attempts: See `BuildQueue`
+    :param kwargs: Passed to `BuildWorker`
+    """
+    import multiprocessing
+
+    workers = [multiprocessing.Process(
+        target=_work, args=(path, lease_seconds, max_attempts, wait, kwargs))
+        for _ in range(processes or os.cpu_count())]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def _work(path, lease_seconds, max_attempts, wait, kwargs):
+    queue = BuildQueue(path, lease_seconds=lease_seconds,
+                       max_attempts=max_attempts)
+    BuildWorker(queue, **kwargs).run(wait=wait)
+
+
+class ValidationServer(object):
+    """A long-lived server running `validate` and `inspect` for
+    `ValidationClient`s over a Unix socket
+
+    The server probes Packer once when it starts and keeps a client per
+    template (and its parsed JSON), as well as a `ResultCache`, warm
+    between requests, so that many short-lived callers (e.g. a pre-merge
+    hook) don't pay for them every time. Each request may hold a batch of
+    commands, which are run concurrently on a pool shared by all
+    connections.
+
+    Requests and responses are lines of JSON. The socket is only
+    accessible to the server's user.
+    """
+
+    def __init__(self, path, exec_path=DEFAULT_PACKER_PATH, backend=None,
+                 cache=None, max_workers=None, in_process=False,
+                 max_clients=DEFAULT_CACHE_ENTRIES):
+        """
+        :param string path: Path of the Unix socket to listen on
+        :param string exec_path: Path to Packer executable
+        :param Backend backend: Executes Packer
+        :param ResultCache cache: Cache of results. Defaults to an
+         in-memory cache.
+        :param int max_workers: Maximum number of commands run at once.
+         Defaults to the number of CPUs.
+        :param bool in_process: See `Packer`
+        :param int max_clients: Number of templates to keep clients for
+        """
+        import concurrent.futures
+
+        self.path = path
+        self.exec_path = exec_path
+        self.backend = backend or SubprocessBackend()
+        self.cache = cache if cache is not None else ResultCache()
+        self.in_process = in_process
+        self.max_clients = max_clients
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers or os.cpu_count())
+        self._clients = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """Starts serving in a background thread"""
+        self._listen()
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """Serves until `close` is called from another thread"""
+        self._listen()
+        self._server.serve_forever()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            os.remove(self.path)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._executor.shutdown()
+
+    def run(self, requests):
+        """Runs a batch of requests (see `ValidationClient`), returning a
+        response per request
+        """
+        return list(self._executor.map(self._run, requests))
+
+    def _listen(self):
+        import socketserver
+
+        import stat
+
+        # probe Packer before the first request
+        ExecutableInfo.get(self.exec_path, self.backend).probe_version(
+            lambda args: self.backend.run(self.exec_path, args))
+        # a socket left behind by a server which died is replaced
+        if os.path.exists(self.path):
+            if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+                raise OSError('{0} exists and is not a socket'.format(
+                    self.path))
+            try:
+                ValidationClient(self.path)._request([])
+            except (IOError, OSError):
+                os.remove(self.path)
+            else:
+                raise OSError('a server is already listening on {0}'.format(
+                    self.path))
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                for line in self.rfile:
+                    requests = json.loads(line.decode())['requests']
+                    self.wfile.write(json.dumps(
+                        {'responses': server.run(requests)}).encode() +
+                        b'\n')
+                    self.wfile.flush()
+
+        previous = os.umask(0o077)
+        try:
+            self._server = socketserver.ThreadingUnixStreamServer(
+                self.path, Handler)
+        finally:
+            os.umask(previous)
+        self._server.daemon_threads = True
+
+    def _run(self, request):
+        started = time.time()
+        try:
+            client = self._client(request)
+            if request['command'] == 'validate':
+                result = client.validate(
+                    syntax_only=request.get('syntax_only', False))
+            elif request['command'] == 'inspect':
+                result = client.inspect(mrf=request.get('mrf', True))
+            else:
+                raise ValueError('unsupported command: {0}'.format(
+                    request['command']))
+            # a result which can't be serialized fails its request only
+            return {'result': _result_data(result),
+                    'duration': time.time() - started}
+        except Exception as ex:
+            error = {'message': str(ex)}
+            if isinstance(ex, PackerCommandError):
+                try:
+                    error['result'] = _result_data(ex.result)
+                except Exception:
+                    pass
+            return {'error': error, 'duration': time.time() - started}
+
+    def _client(self, request):
+        """Returns the client for the request's template and arguments,
+        keeping the most recently used ones
+        """
+        key = json.dumps([request.get(name) for name in (
+            'packerfile', 'exc', 'only', 'vars', 'var_file')],
+            sort_keys=True)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                return client
+        client = Packer(request['packerfile'], exc=request.get('exc'),
+                        only=request.get('only'), vars=request.get('vars'),
+                        var_file=request.get('var_file'),
+                        exec_path=self.exec_path, backend=self.backend,
+                        cache=self.cache, in_process=self.in_process)
+        with self._lock:
+            self._clients[key] = client
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        return client
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ValidationClient(object):
+    """A client of a `ValidationServer`
+
+    Results are `CommandResult`s (or `ValidationObject`s for validations
+    which failed to run), like the ones `Packer` returns. Relative paths
+    are resolved against the client's working directory.
+    """
+
+    def __init__(self, path, timeout=None):
+        """
+        :param string path: Path of the server's Unix socket
+        :param float timeout: Seconds to wait for the server's response
+        """
+        self.path = path
+        self.timeout = timeout
+
+    def validate(self, packerfile, syntax_only=False, **kwargs):
+        """Validates a template. See `Packer.validate`.
+
+        Additional keyword arguments are the template arguments `Packer`
+        accepts (`exc`, `only`, `vars` and `var_file`).
+        """
+        return self._single(self._validate_request(
+            PackerJob(packerfile, **kwargs), syntax_only))
+
+    def inspect(self, packerfile, mrf=True, **kwargs):
+        """Inspects a template. See `Packer.inspect` and `validate`."""
+        return self._single(self._inspect_request(
+            PackerJob(packerfile, **kwargs), mrf))
+
+    def validate_many(self, jobs, syntax_only=False):
+        """Validates many templates in a single request. See
+        `Packer.validate_many`.
+        """
+        return self._many(jobs, [self._validate_request(job, syntax_only)
+                                 for job in jobs])
+
+    def inspect_many(self, jobs, mrf=True):
+        """Inspects many templates in a single request. See
+        `Packer.inspect_many`.
+        """
+        return self._many(jobs, [self._inspect_request(job, mrf)
+                                 for job in jobs])
+
+    def _single(self, request):
+        result, error, _ = self._response(self._request([request])[0])
+        if error is not None:
+            raise error
+        return result
+
+    def _many(self, jobs, requests):
+        started = time.time()
+        results = [JobResult(job) for job in jobs]
+        for job_result, response in zip(results, self._request(requests)):
+            job_result.result, job_result.error, job_result.duration = \
+                self._response(response)
+        return BatchResult(results, time.time() - started)
+
+    def _request(self, requests):
+        import socket
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            with sock.makefile('rwb') as f:
+                f.write(json.dumps({'requests': requests}).encode() + b'\n')
+                f.flush()
+                line = f.readline()
+        if not line:
+            raise PackerException('the validation server closed the '
+                                  'connection')
+        return json.loads(line.decode())['responses']
+
+    @staticmethod
+    def _request_for(job, command):
+        return {
+            'command': command,
+            'packerfile': os.path.abspath(job.packerfile),
+            'exc': job.exc, 'only': job.only, 'vars': job.vars,
+            'var_file': os.path.abspath(job.var_file) if job.var_file
+            else None,
+        }
+
+    def _validate_request(self, job, syntax_only):
+        return dict(self._request_for(job, 'validate'),
+                    syntax_only=syntax_only)
+
+    def _inspect_request(self, job, mrf):
+        return dict(self._request_for(job, 'inspect'), mrf=mrf)
+
+    @staticmethod
+    def _response(response):
+        """Returns the result, the error and the duration of a response"""
+        error = response.get('error')
+        if error is None:
+            return _result_object(response['result']), None, \
+                response['duration']
+        if 'result' in error:
+            error = PackerCommandError(_result_object(error['result']))
+        else:
+            error = PackerException(error['message'])
+        return None, error, response['duration']
+
+
+def _result_data(result):
+    """Returns the JSON serializable data of a command's result"""
+    data = {}
+    for attribute in ('cmd', 'stdout', 'stderr', 'exit_code',
+                      'parsed_output', 'succeeded', 'error', 'terminated'):
+        if hasattr(result, attribute):
+            value = getattr(result, attribute)
+            if isinstance(value, bytes):
+                value = value.decode(errors='replace')
+            elif attribute == 'cmd' and value is not None:
+                # results answered in-process have no command
+                value = [arg.decode() if isinstance(arg, bytes) else arg
+                         for arg in value]
+            data[attribute] = value
+    return data
+
+
+def _result_object(data):
+    """Returns the result `_result_data` was called with"""
+    if 'exit_code' in data:
+        result = CommandResult(data['cmd'], data['stdout'].encode(),
+                               data['stderr'].encode(), data['exit_code'])
+    else:
+        result = ValidationObject()
+        result.failed = True
+    for attribute in ('parsed_output', 'succeeded', 'error', 'terminated'):
+        if attribute in data:
+            setattr(result, attribute, data[attribute])
+    return result
+
+
+class ResultCache(object):
+    """A content-addressed cache for `inspect`, `validate` and `fix` results
+
+    Results are keyed on a hash of the template, `vars`, the `var_file`'s
+    contents, `only`/`exc`, the command's options and Packer's version.
+    Up to `max_entries` results are kept in an in-memory LRU. If `path`
+    is given, results are also persisted under it and the least recently
+    used ones are evicted once they take up more than `max_bytes`.
+    Persisted results are pickled, so `path` must not be writable by
+    untrusted users.
+
+    The cache is thread-safe and may be shared between clients.
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES, path=None,
+                 max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        """
+        :param int max_entries: Number of results to keep in memory
+        :param string path: Directory to persist results in
+        :param int max_bytes: Size of persisted results to evict at
+        """
+        self.max_entries = max_entries
+        self.path = path
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+        if data is None and self.path:
+            data = self._read(key)
+            if data is not None:
+                self._remember(key, data)
+        return pickle.loads(data) if data is not None else None
+
+    def set(self, key, result):
+        if not isinstance(result, (CommandResult, ValidationObject)):
+            result = CommandResult.from_sh(result)
+        data = pickle.dumps(result)
+        self._remember(key, data)
+        if self.path:
+            self._write(key, data)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.path:
+            for name in os.listdir(self.path):
+                os.remove(os.path.join(self.path, name))
+
+    def _remember(self, key, data):
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _read(self, key):
+        path = os.path.join(self.path, key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # the file's mtime tracks its last use for eviction
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def _write(self, key, data):
+        _atomic_write(os.path.join(self.path, key), data)
+        _evict_lru(self.path, self.max_bytes)
+
+
+class BuildManifest(object):
+    """Records the fingerprint of the inputs and the artifacts of the last
+    successful build of every template, allowing unchanged builds to be
+    skipped (see `Packer.build`)
+
+    The manifest is a JSON file which is rewritten atomically, so it can
+    be shared between clients and processes. Concurrent updates of
+    different templates may race; the last one wins.
+    """
+
+    def __init__(self, path):
+        """
+        :param string path: Path to the manifest's JSON file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(packerfile, only=None, exc=None):
+        """Returns the manifest's key for builds of `packerfile` restricted
+        to `only`/`exc` builders
+        """
+        return json.dumps([os.path.abspath(packerfile), sorted(only or []),
+                           sorted(exc or [])])
+
+    def get(self, key):
+        """Returns the entry for `key`, a dict with the build's
+        `fingerprint`, `artifacts` and `built` time, or None
+        """
+        with self._lock:
+            return self._load().get(key)
+
+    def record(self, key, fingerprint, artifacts):
+        with self._lock:
+            entries = self._load()
+            entries[key] = {'fingerprint': fingerprint,
+                            'artifacts': artifacts, 'built': time.time()}
+            self._save(entries)
+
+    def forget(self, key):
+        """Removes `key`, forcing its next build"""
+        with self._lock:
+            entries = self._load()
+            if entries.pop(key, None) is not None:
+                self._save(entries)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        _atomic_write(self.path, json.dumps(entries, indent=2,
+                                            sort_keys=True).encode())
+
+
+class TemplateIndex(object):
+    """An index of the templates found under a directory and of the files
+    and user variables each of them depends on, answering which templates
+    are affected by a change (e.g. the paths changed by a commit)
+
+    The index is persisted as a JSON file. `update` parses again only the
+    templates whose file (or var-file) changed; a file whose mtime or size
+    changed but whose contents didn't (e.g. in a fresh checkout) isn't
+    parsed again. Paths under `root` are stored relative to it, so the
+    index can be shared between checkouts.
+
+    Dependencies are the template itself, its var-file and the local files
+    reported by `Template.local_files`, expanded with the template's
+    variable defaults (overridden by its var-file). Templates referencing
+    a file which can't be resolved without Packer are reported as
+    affected by any change.
+    """
+
+    def __init__(self, path, root, pattern='*.json', var_files=None):
+        """
+        :param string path: Path to the index's JSON file
+        :param string root: Directory scanned for templates
+        :param string pattern: Shell pattern matching template file names
+        :param dict var_files: Maps template paths to the var-file they're
+            built with
+        """
+        self.path = path
+        self.root = os.path.abspath(root)
+        self.pattern = pattern
+        self.var_files = dict(
+            (self._relative(os.path.abspath(template)),
+             self._relative(os.path.abspath(var_file)))
+            for template, var_file in (var_files or {}).items())
+        self._entries = None
+        self._dependents = None
+        self._lock = threading.Lock()
+
+    @property
+    def templates(self):
+        """The paths of the indexed templates"""
+        with self._lock:
+            return sorted(self._absolute(name) for name, entry in
+                          self._load().items() if entry['template'])
+
+    def update(self):
+        """Scans `root` and updates the index with the templates which
+        changed since the last update
+
+        Returns the paths of the templates which were (re)indexed or
+        removed.
+        """
+        import fnmatch
+
+        with self._lock:
+            entries = self._load()
+            index_path = os.path.abspath(self.path)
+            updated = {}
+            changed = set()
+            for directory, directories, files in os.walk(self.root):
+                directories[:] = sorted(name for name in directories
+                                        if not name.startswith('.'))
+                for name in sorted(fnmatch.filter(files, self.pattern)):
+                    path = os.path.join(directory, name)
+                    if path == index_path:
+                        continue
+                    relative = self._relative(path)
+                    entry, reindexed = self._refresh(
+                        relative, entries.get(relative))
+                    if reindexed:
+                        changed.add(relative)
+                    updated[relative] = entry
+            changed.update(set(entries) - set(updated))
+            changed = [name for name in changed if name in updated and
+                       updated[name]['template'] or name in entries and
+                       entries[name]['template']]
+            # entries whose files were only touched are saved too, so they
+            # aren't hashed again
+            if updated != entries:
+                self._save(updated)
+                self._entries = updated
+                self._dependents = None
+            return sorted(self._absolute(name) for name in changed)
+
+    def dependents(self, paths=(), variables=()):
+        """Returns the paths of the templates affected by changes to
+        `paths` (files or directories, relative to the working directory)
+        or to the values of the user `variables`
+
+        Changes to a directory a template depends on affect it, as do
+        changes to files inside a directory it depends on.
+        """
+        with self._lock:
+            entries = self._load()
+            if self._dependents is None:
+                self._dependents = self._reverse(entries)
+            files, names, unresolved = self._dependents
+            affected = set(unresolved) if paths else set()
+            for path in paths:
+                relative = self._relative(os.path.abspath(path))
+                affected.update(files.get(relative, ()))
+                # a changed (or removed) directory affects templates
+                # depending on the files inside of it
+                if not os.path.isfile(path):
+                    prefix = relative + '/'
+                    affected.update(
+                        name for dependency, dependents in files.items()
+                        if dependency.startswith(prefix)
+                        for name in dependents)
+                while True:
+                    parent = os.path.dirname(relative)
+                    if parent == relative:
+                        break
+                    relative = parent
+                    affected.update(files.get(relative, ()))
+            for variable in variables:
+                affected.update(names.get(variable, ()))
+            return sorted(self._absolute(name) for name in affected)
+
+    def _refresh(self, relative, entry):
+        """Returns the template's entry and whether it was parsed again,
+        which happens only if the contents of the template or of its
+        var-file changed
+        """
+        var_file = self.var_files.get(relative)
+        inputs = [relative] + ([var_file] if var_file else [])
+        if entry is None or entry['var_file'] != var_file:
+            return self._parse(relative, var_file, inputs), True
+        signatures = [self._signature(name, previous)
+                      for name, previous in zip(inputs, entry['inputs'])]
+        if [signature and signature[2] for signature in signatures] != \
+                [previous and previous[2] for previous in entry['inputs']]:
+            return self._parse(relative, var_file, inputs), True
+        if signatures != entry['inputs']:
+            entry = dict(entry, inputs=signatures)
+        return entry, False
+
+    def _parse(self, relative, var_file, inputs):
+        entry = {'template': False, 'var_file': var_file, 'files': [],
+                 'variables': [], 'unresolved': False,
+                 'inputs': [self._signature(name) for name in inputs]}
+        path = self._absolute(relative)
+        try:
+            template = Template.load(path)
+        except (IOError, OSError):
+            return entry
+        except ValueError:
+            # a template which isn't valid JSON is still affected by its
+            # own changes
+            entry.update(template=True, files=[relative])
+            return entry
+        # JSON files without builders, e.g. var-files, aren't templates
+        if 'builders' not in template.data:
+            return entry
+        variables = dict(template.variables)
+        files = [relative]
+        if var_file:
+            files.append(var_file)
+            try:
+                with open(self._absolute(var_file)) as f:
+                    variables.update(json.load(f))
+            except (IOError, OSError, ValueError):
+                pass
+        expand = _template_expander(path, variables)
+        for file_path in template.local_files():
+            file_path = expand(file_path)
+            if file_path is None:
+                entry['unresolved'] = True
+                continue
+            # relative paths are resolved against the working directory,
+            # like Packer does
+            files.append(self._relative(os.path.abspath(file_path)))
+        entry.update(template=True, files=sorted(set(files)),
+                     variables=sorted(template.user_variable_references()))
+        return entry
+
+    def _signature(self, name, previous=None):
+        """Returns the mtime, size and hash of the file `name` (or None
+        if it's missing), hashing it only if its mtime or size differ from
+        the `previous` signature
+        """
+        path = self._absolute(name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if previous and previous[:2] == [stat.st_mtime_ns, stat.st_size]:
+            return previous
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return [stat.st_mtime_ns, stat.st_size, digest.hexdigest()]
+
+    @staticmethod
+    def _reverse(entries):
+        files = collections.defaultdict(set)
+        names = collections.defaultdict(set)
+        unresolved = set()
+        for name, entry in entries.items():
+            if not entry['template']:
+                continue
+            for dependency in entry['files']:
+                files[dependency].add(name)
+            for variable in entry['variables']:
+                names[variable].add(name)
+            if entry['unresolved']:
+                unresolved.add(name)
+        return files, names, unresolved
+
+    def _relative(self, path):
+        relative = os.path.relpath(path, self.root)
+        if relative == os.curdir:
+            return ''
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            return path
+        return relative.replace(os.sep, '/')
+
+    def _absolute(self, name):
+        return os.path.normpath(os.path.join(self.root, name))
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (IOError, OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self, entries):
+        _atomic_write(self.path, json.dumps(entries, sort_keys=True).encode())
+
+
+class IsoCache(object):
+    """A local cache of ISOs (or any other source images) addressed by
+    their checksum (see `Packer.build`)
+
+    Downloads resume from where an interrupted download stopped if the
+    server supports range requests, and are verified against their
+    checksum before being cached. The least recently used files are
+    evicted once the cache takes up more than `max_bytes`. The cache may
+    be shared between threads and processes.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_ISO_CACHE_MAX_BYTES,
+                 max_workers=DEFAULT_DOWNLOAD_WORKERS):
+        """
+        :param string path: Directory to cache files in
+        :param int max_bytes: Size of cached files to evict at
+        :param int max_workers: Number of concurrent downloads
+        """
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.max_workers = max_workers
+        self._locks = collections.defaultdict(threading.Lock)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def fetch(self, urls, checksum, checksum_type=None):
+        """Returns the path to the cached file with `checksum`, downloading
+        it from the first of `urls` which works if it isn't cached, or None
+        if the checksum doesn't identify the file (e.g. `none` or `file:`
+        checksums)
+
+        :param list urls: URLs to download the file from
+        :param string checksum: The checksum, as `type:value` or as a value
+         of `checksum_type` like in Packer templates
+        """
+        key = self._key(checksum, checksum_type)
+        if key is None:
+            return None
+        path = os.path.join(self.path, key)
+        with self._locks[key]:
+            if os.path.isfile(path):
+                # the file's mtime tracks its last use for eviction
+                os.utime(path, None)
+                return path
+            error = None
+            for url in urls:
+                try:
+                    self._download(url, key)
+                    break
+                except (IOError, OSError, ValueError, PackerException) as ex:
+                    error = ex
+            else:
+                raise PackerException('could not download {0}: {1}'.format(
+                    ', '.join(urls), error))
+        self._evict()
+        return path
+
+    def fetch_many(self, downloads, ignore_errors=False):
+        """Fetches `(urls, checksum, checksum_type)` downloads concurrently,
+        returning the paths in order. See `fetch`.
+
+        :param bool ignore_errors: Return None for the downloads which
+         failed instead of raising a `PackerException`
+        """
+        import concurrent.futures
+
+        def fetch(download):
+            try:
+                return self.fetch(*download)
+            except PackerException:
+                if not ignore_errors:
+                    raise
+                return None
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers) as executor:
+            return list(executor.map(fetch, downloads))
+
+    def _key(self, checksum, checksum_type):
+        if ':' in checksum:
+            checksum_type, checksum = checksum.split(':', 1)
+        checksum_type = (checksum_type or '').lower()
+        checksum = checksum.lower()
+        if checksum_type not in ISO_CHECKSUM_TYPES or \
+                not CHECKSUM_REGEX.match(checksum):
+            return None
+        return '{0}-{1}'.format(checksum_type, checksum)
+
+    def _download(self, url, key):
+        import urllib.error
+        import urllib.request
+
+        checksum_type, checksum = key.split('-', 1)
+        partial = os.path.join(self.path, '.{0}.part'.format(key))
+        with open(partial, 'ab') as f:
+            _lock_file(f)
+            if os.path.isfile(os.path.join(self.path, key)):
+                # another process downloaded it while we waited for the lock
+                return
+            offset = f.seek(0, os.SEEK_END)
+            request = urllib.request.Request(url)
+            if offset:
+                request.add_header('Range', 'bytes={0}-'.format(offset))
+            try:
+                with urllib.request.urlopen(request) as response:
+                    if offset and response.status != 206:
+                        # the server ignored the range, start over
+                        f.seek(0)
+                        f.truncate()
+                    for chunk in iter(
+                            lambda: response.read(DOWNLOAD_CHUNK_SIZE), b''):
+                        f.write(chunk)
+            except urllib.error.HTTPError as ex:
+                # 416: the partial download is complete already
+                if ex.code != 416 or not offset:
+                    raise
+            f.flush()
+            digest = hashlib.new(checksum_type)
+            with open(partial, 'rb') as downloaded:
+                for chunk in iter(
+                        lambda: downloaded.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            if digest.hexdigest() != checksum:
+                os.remove(partial)
+                raise PackerException(
+                    '{0} checksum mismatch for {1}: got {2}'.format(
+                        checksum_type, url, digest.hexdigest()))
+            os.replace(partial, os.path.join(self.path, key))
+
+    def _evict(self):
+        # the most recently used file is kept even if it's too large
+        _evict_lru(self.path, self.max_bytes, keep_latest=True)
+
+
+def _lock_file(f):
+    """Takes an exclusive lock on an open file where supported, so that
+    processes sharing a cache don't download the same file concurrently
+    (or don't update a `RateLimiter`'s state concurrently)
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+class RateLimiter(object):
+    """Admits builds once the cloud API quotas they share allow it (see
+    `Packer.build`)
+
+    Every builder of a build takes a token from the bucket of its key
+    (its type by default) when Packer starts, and a slot of the key's
+    concurrency until Packer exits. Buckets hold up to `burst` tokens and
+    are refilled with `rate` tokens per second. A build waits until all
+    its keys have enough tokens and free slots. A build needing more than
+    a key's `burst` starts once the bucket is full and one needing more
+    slots than a key's concurrency starts once no other build holds any.
+
+    The limiter's state is a JSON file locked with `flock`, so the threads
+    and processes of a host using the same `path` share the limits. Slots
+    held by processes which died are freed.
+    """
+
+    def __init__(self, path, rates=None, concurrency=None, key=None,
+                 poll_interval=DEFAULT_ADMISSION_POLL_INTERVAL):
+        """
+        :param string path: Path to the limiter's state file
+        :param dict rates: (rate, burst) per key: tokens added per second
+         and maximum tokens
+        :param dict concurrency: Maximum number of builders per key running
+         at once
+        :param key: Callable returning the key of a builder definition,
+         e.g. its type and account. Must be picklable to be used with
+         `build_many(processes=True)`.
+        :param float poll_interval: Maximum seconds between attempts to be
+         admitted
+        """
+        self.path = path
+        self.rates = rates or {}
+        self.concurrency = concurrency or {}
+        self.key = key
+        self.poll_interval = poll_interval
+
+    def weights(self, builders):
+        """Returns the number of `builders` (template builder definitions)
+        per key
+        """
+        return dict(collections.Counter(
+            self.key(builder) if self.key else builder.get('type')
+            for builder in builders))
+
+    @contextlib.contextmanager
+    def admit(self, builders):
+        """Waits until `builders` may start, holding their slots until the
+        block exits
+        """
+        lease = self.acquire(self.weights(builders))
+        try:
+            yield
+        finally:
+            self.release(lease)
+
+    def acquire(self, weights):
+        """Waits until the tokens and slots of the limited keys of
+        `weights` (see `weights`) are available and takes them
+
+        Returns a lease to pass to `release`, or None if no key is limited.
+        """
+        weights = dict((key, weight) for key, weight in weights.items()
+                       if key in self.rates or key in self.concurrency)
+        if not weights:
+            return None
+        lease = '{0}-{1}'.format(os.getpid(), os.urandom(8).hex())
+        while True:
+            with self._state() as state:
+                wait = self._take(state, lease, weights, time.time())
+            if wait is None:
+                return lease
+            time.sleep(min(wait, self.poll_interval))
+
+    def release(self, lease):
+        """Frees the slots of `lease`"""
+        if lease is None:
+            return
+        with self._state() as state:
+            state['leases'].pop(lease, None)
+
+    @contextlib.contextmanager
+    def _state(self):
+        """Yields the limiter's state while holding its lock, and saves it
+        unless an exception is raised
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+') as f:
+            _lock_file(f)
+            try:
+                state = json.loads(f.read() or '{}')
+            except ValueError:
+                state = {}
+            state.setdefault('buckets', {})
+            state.setdefault('leases', {})
+            yield state
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+
+    def _take(self, state, lease, weights, now):
+        """Takes `weights` for `lease` if they're available, returning
+        None, or returns the seconds to wait before they may be
+        """
+        leases = state['leases']
+        for id, held in list(leases.items()):
+            if not _process_alive(held['pid']):
+                del leases[id]
+        running = collections.Counter()
+        for held in leases.values():
+            running.update(held['weights'])
+        wait = 0
+        tokens = {}
+        for key, weight in weights.items():
+            if key in self.concurrency and running[key] and \
+                    running[key] + weight > self.concurrency[key]:
+                wait = max(wait, self.poll_interval)
+            if key in self.rates:
+                rate, burst = self.rates[key]
+                available, updated = state['buckets'].get(key, (burst, now))
+                tokens[key] = min(burst, available + (now - updated) * rate)
+                if tokens[key] < min(weight, burst):
+                    wait = max(wait, (min(weight, burst) - tokens[key]) /
+                               rate)
+        if wait:
+            return wait
+        # a build taking more than `burst` leaves the bucket in debt
+        for key, available in tokens.items():
+            state['buckets'][key] = [available - weights[key], now]
+        leases[lease] = {'pid': os.getpid(), 'weights': weights}
+        return None
+
+
+def _process_alive(pid):
+    """Returns whether the local process `pid` is running"""
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class OutputLog(object):
+    """A bounded-memory sink for the output of long running builds
+
+    Only the last `tail_lines` lines are kept in memory while the full
+    output is streamed to `path`. Once the log grows beyond `max_bytes`
+    it is rotated to `path.1`, `path.2`, etc. keeping up to
+    `backup_count` rotated logs, which are gzip compressed (as
+    `path.1.gz`, ...) if `compress` is set.
+
+    Writing is thread-safe, so stdout and stderr may share a log.
+    """
+
+    def __init__(self, path, tail_lines=DEFAULT_TAIL_LINES,
+                 max_bytes=DEFAULT_LOG_MAX_BYTES,
+                 backup_count=DEFAULT_LOG_BACKUP_COUNT, compress=True):
+        """
+        :param string path: Path to write the log to
+        :param int tail_lines: Number of lines to keep in memory
+        :param int max_bytes: Size at which the log is rotated
+        :param int backup_count: Number of rotated logs to keep
+        :param bool compress: Whether to compress rotated logs
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self._tail = collections.deque(maxlen=tail_lines)
+        self._lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self._mode = 'w'
+
+    @property
+    def tail(self):
+        """The last lines of output written to the log"""
+        with self._lock:
+            return ''.join(self._tail)
+
+    def write(self, line):
+        if isinstance(line, bytes):
+            line = line.decode(errors='replace')
+        with self._lock:
+            self._tail.append(line)
+            if self._file is None:
+                self._file = open(self.path, self._mode)
+                self._size = self._file.tell()
+                self._mode = 'a'
+            self._file.write(line)
+            self._size += len(line.encode())
+            if self._size >= self.max_bytes:
+                self._rotate()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        if self.backup_count > 0:
+            suffix = '.gz' if self.compress else ''
+            for index in range(self.backup_count - 1, 0, -1):
+                source = '{0}.{1}{2}'.format(self.path, index, suffix)
+                if os.path.exists(source):
+                    os.replace(source, '{0}.{1}{2}'.format(
+                        self.path, index + 1, suffix))
+            if self.compress:
+                with open(self.path, 'rb') as source, \
+                        gzip.open(self.path + '.1.gz', 'wb') as target:
+                    shutil.copyfileobj(source, target)
+            else:
+                os.replace(self.path, self.path + '.1')
+        self._mode = 'w'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MachineReadableEvent(object):
+    """A single line of Packer's `-machine-readable` output
+
+    :ivar int timestamp: Unix timestamp at which the line was written
+    :ivar string target: Name of the builder the line refers to, if any
+    :ivar string type: The line's type (e.g. `ui`, `artifact`)
+    :ivar list data: The line's unescaped data fields
+    """
+
+    def __init__(self, timestamp, target, type, data):
+        self.timestamp = timestamp
+        self.target = target
+        self.type = type
+        self.data = data
+
+    def __repr__(self):
+        return '{0}(timestamp={1}, target={2!r}, type={3!r}, data={4!r})'\
+            .format(self.__class__.__name__, self.timestamp, self.target,
+                    self.type, self.data)
+
+
+class UiEvent(MachineReadableEvent):
+    """A `ui` line. `level` is one of `say`, `message` or `error`"""
+
+    def __init__(self, *args):
+        super(UiEvent, self).__init__(*args)
+        self.level = self.data[0] if self.data else None
+        self.message = self.data[1] if len(self.data) > 1 else ''
+
+
+class ArtifactCountEvent(MachineReadableEvent):
+    """An `artifact-count` line, emitted once per builder"""
+
+    def __init__(self, *args):
+        super(ArtifactCountEvent, self).__init__(*args)
+        self.count = int(self.data[0])
+
+
+class ArtifactEvent(MachineReadableEvent):
+    """An `artifact` line describing a single key of an artifact
+
+    e.g. `index=0, key='id', value='eu-west-1:ami-1234'`
+    """
+
+    def __init__(self, *args):
+        super(ArtifactEvent, self).__init__(*args)
+        self.index = int(self.data[0])
+        self.key = self.data[1] if len(self.data) > 1 else None
+        self.value = ','.join(self.data[2:]) if len(self.data) > 2 else None
+
+
+class ErrorCountEvent(MachineReadableEvent):
+    """An `error-count` line summarizing the number of failed builders"""
+
+    def __init__(self, *args):
+        super(ErrorCountEvent, self).__init__(*args)
+        self.count = int(self.data[0])
+
+
+class ErrorEvent(MachineReadableEvent):
+    """An `error` line"""
+
+    def __init__(self, *args):
+        super(ErrorEvent, self).__init__(*args)
+        self.message = self.data[0] if self.data else ''
+
+
+class BuilderStartEvent(MachineReadableEvent):
+    """Emitted before the first line referring to a builder"""
+
+
+class BuilderFinishEvent(MachineReadableEvent):
+    """Emitted when Packer reports that a builder finished or errored
+
+    `errored` is True if the builder failed, in which case `message`
+    holds Packer's description of the failure.
+    """
+
+    def __init__(self, *args):
+        super(BuilderFinishEvent, self).__init__(*args)
+        self.errored = self.data[0] == 'errored'
+        self.message = self.data[1] if len(self.data) > 1 else ''
+
+
+EVENT_TYPES = {
+    'ui': UiEvent,
+    'artifact-count': ArtifactCountEvent,
+    'artifact': ArtifactEvent,
+    'error-count': ErrorCountEvent,
+    'error': ErrorEvent,
+}
+
+
+class MachineReadableParser(object):
+    """An incremental parser for Packer's `-machine-readable` output
+
+    Lines are fed one at a time so that arbitrarily large outputs can be
+    parsed in constant memory. Lines which aren't machine-readable (e.g.
+    interleaved debug logs, or a line cut off when Packer was killed) are
+    skipped.
+    """
+
+    def __init__(self):
+        self.builders = set()
+
+    def feed(self, line):
+        """Parses a single line of output, returning a list of events
+
+        :param line: A line of output, either `str` or `bytes`
+        """
+        if isinstance(line, bytes):
+            line = line.decode(errors='replace')
+        fields = line.rstrip('\r\n').split(',')
+        if len(fields) < 3 or not fields[0].isdigit():
+            return []
+        timestamp = int(fields[0])
+        target = fields[1] or None
+        data = [self._unescape(field) for field in fields[3:]]
+        try:
+            event = EVENT_TYPES.get(fields[2], MachineReadableEvent)(
+                timestamp, target, fields[2], data)
+        except (IndexError, ValueError):
+            # a truncated line, e.g. `artifact` without its index
+            return []
+
+        events = []
+        if target and target not in self.builders:
+            self.builders.add(target)
+            events.append(BuilderStartEvent(
+                timestamp, target, 'builder-start', []))
+        events.append(event)
+        if isinstance(event, UiEvent):
+            match = BUILD_RESULT_REGEX.match(event.message)
+            if match:
+                message = event.message[match.end():].lstrip(': ') \
+                    if match.group('state') == 'errored' else ''
+                events.append(BuilderFinishEvent(
+                    timestamp, match.group('builder'), 'builder-finish',
+                    [match.group('state'), message]))
+        return events
+
+    @staticmethod
+    def _unescape(field):
+        for escaped, char in MACHINE_READABLE_ESCAPES:
+            field = field.replace(escaped, char)
+        return field
+
+
+def parse_machine_readable(lines):
+    """Lazily parses Packer's `-machine-readable` output
+
+    Yields a `MachineReadableEvent` (or one of its subclasses) for every
+    line of output, as well as a `BuilderStartEvent` and a
+    `BuilderFinishEvent` when a builder starts and finishes.
+
+    :param lines: An iterable of output lines, e.g. an open log file or
+     the output of `Packer.build`
+    """
+    parser = MachineReadableParser()
+    for line in lines:
+        for event in parser.feed(line):
+            yield event
+
+
+class EventLog(object):
+    """A store of the events of Packer's `-machine-readable` output,
+    indexed by builder, type and timestamp
+
+    An `EventLog` can be passed as the `output_log` of builds (like an
+    `OutputLog`), whose events are appended to the store; lines which
+    aren't machine-readable are only kept in `tail`. Querying the store
+    with `events` reads it through `mmap`. Queries by builder or type
+    only read the postings of that builder or type (the positions of its
+    events in the index) and the index records and data of those events.
+    The timestamp range is found by a binary search.
+
+    Events are stored in `path` as their JSON encoded `data`, in `path.idx`
+    as an `EVENT_INDEX_RECORD` (a fixed-size record per event), the names
+    of targets and types in `path.names` and the postings of every name in
+    `path.<id>.pos` as `EVENT_POSTING`s. Writing is thread-safe, but a
+    store must only be written by one process at a time.
+    """
+
+    _EVENT_TYPES = dict(EVENT_TYPES, **{'builder-start': BuilderStartEvent,
+                                        'builder-finish': BuilderFinishEvent})
+
+    def __init__(self, path, tail_lines=DEFAULT_TAIL_LINES):
+        """
+        :param string path: Path to write the events to
+        :param int tail_lines: Number of lines to keep in memory
+        """
+        self.path = path
+        self._tail = collections.deque(maxlen=tail_lines)
+        self._lock = threading.Lock()
+        self._parser = MachineReadableParser()
+        self._data = None
+        self._index = None
+        self._postings = {}
+        self._size = 0
+        self._records = 0
+        self._names = None
+        self._ids = None
+        self._last_timestamp = None
+
+    @property
+    def tail(self):
+        """The last lines of output written to the log"""
+        with self._lock:
+            return ''.join(self._tail)
+
+    def write(self, line):
+        if isinstance(line, bytes):
+            line = line.decode(errors='replace')
+        with self._lock:
+            self._tail.append(line)
+            events = self._parser.feed(line)
+            if events and self._data is None:
+                self._open()
+            for event in events:
+                self._append(event)
+
+    def close(self):
+        """Flushes the store. The parser is reset, so that the next build
+        written to the store starts its builders again.
+        """
+        with self._lock:
+            if self._data is not None:
+                self._data.close()
+                self._index.close()
+                self._data = self._index = None
+            for postings in self._postings.values():
+                postings.close()
+            self._postings.clear()
+            self._parser = MachineReadableParser()
+
+    def events(self, target=None, type=None, since=None, until=None):
+        """Yields the stored events matching all the given criteria, in
+        the order they were written
+
+        :param string target: Name of the builder the events refer to
+        :param string type: The events' type, e.g. `error` or
+         `builder-finish`
+        :param int since: Minimum Unix timestamp of the events
+        :param int until: Maximum Unix timestamp of the events
+        """
+        with self._lock:
+            if self._data is not None:
+                self._data.flush()
+                self._index.flush()
+                for postings in self._postings.values():
+                    postings.flush()
+            if self._data is None:
+                # another process may have written to the store
+                self._names = None
+            names = list(self._load_names()['names'])
+            sorted_timestamps = self._names['sorted']
+        ids = dict((name, id) for id, name in enumerate(names))
+        target_id = ids.get(target or '') if target is not None else None
+        type_id = ids.get(type) if type is not None else None
+        if target is not None and target_id is None or \
+                type is not None and type_id is None:
+            return
+        with contextlib.ExitStack() as stack:
+            index = self._map(stack, self.path + '.idx')
+            data = self._map(stack, self.path)
+            if index is None:
+                return
+            count = len(index) // EVENT_INDEX_RECORD.size
+            postings = [self._map(stack, self._postings_path(id))
+                        for id in set((target_id, type_id)) - {None}]
+            if None in postings:
+                return
+            # the rarest builder or type gives the candidate events
+            postings = min(postings, key=len) if postings else None
+            position = self._position(postings)
+            start = 0
+            end = len(postings) // EVENT_POSTING.size if postings \
+                else count
+            if sorted_timestamps:
+                if since is not None:
+                    start = self._search(index, position, 0, end, since)
+                if until is not None:
+                    end = self._search(index, position, start, end,
+                                       until + 1)
+            if postings is None:
+                view = memoryview(index)[start * EVENT_INDEX_RECORD.size:
+                                         end * EVENT_INDEX_RECORD.size]
+                records = EVENT_INDEX_RECORD.iter_unpack(view)
+            else:
+                view = memoryview(postings)[start * EVENT_POSTING.size:
+                                            end * EVENT_POSTING.size]
+                # postings of records lost by a crashed writer are skipped
+                records = (EVENT_INDEX_RECORD.unpack_from(
+                    index, record * EVENT_INDEX_RECORD.size)
+                    for record, in EVENT_POSTING.iter_unpack(view)
+                    if record < count)
+            # the view must be released before the file is unmapped
+            stack.callback(view.release)
+            for timestamp, offset, length, event_target, event_type in \
+                    records:
+                if target_id is not None and event_target != target_id or \
+                        type_id is not None and event_type != type_id or \
+                        since is not None and timestamp < since or \
+                        until is not None and timestamp > until:
+                    continue
+                event_type = names[event_type]
+                yield self._EVENT_TYPES.get(
+                    event_type, MachineReadableEvent)(
+                        timestamp, names[event_target] or None, event_type,
+                        json.loads(data[offset:offset + length].decode()))
+
+    def _open(self):
+        self._load_names()
+        self._data = open(self.path, 'ab')
+        self._index = open(self.path + '.idx', 'ab')
+        self._size = self._data.tell()
+        # drop a record partially written by a crashed writer
+        records = self._index.tell() // EVENT_INDEX_RECORD.size
+        self._index.truncate(records * EVENT_INDEX_RECORD.size)
+        self._index.seek(0, os.SEEK_END)
+        self._records = records
+        if records and self._last_timestamp is None:
+            with open(self.path + '.idx', 'rb') as f:
+                f.seek((records - 1) * EVENT_INDEX_RECORD.size)
+                self._last_timestamp = EVENT_INDEX_RECORD.unpack(
+                    f.read(EVENT_INDEX_RECORD.size))[0]
+
+    def _append(self, event):
+        data = json.dumps(event.data, separators=(',', ':')).encode()
+        target_id = self._name_id(event.target or '')
+        type_id = self._name_id(event.type)
+        if self._last_timestamp is not None and \
+                event.timestamp < self._last_timestamp and \
+                self._names['sorted']:
+            self._names['sorted'] = False
+            self._save_names()
+        self._last_timestamp = max(event.timestamp,
+                                   self._last_timestamp or 0)
+        self._data.write(data)
+        self._index.write(EVENT_INDEX_RECORD.pack(
+            event.timestamp, self._size, len(data), target_id, type_id))
+        for id in set((target_id, type_id)):
+            self._open_postings(id).write(EVENT_POSTING.pack(self._records))
+        self._size += len(data)
+        self._records += 1
+
+    def _open_postings(self, id):
+        postings = self._postings.get(id)
+        if postings is None:
+            postings = open(self._postings_path(id), 'a+b')
+            # drop the postings of records lost by a crashed writer
+            entries = postings.tell() // EVENT_POSTING.size
+            while entries:
+                postings.seek((entries - 1) * EVENT_POSTING.size)
+                if EVENT_POSTING.unpack(postings.read(
+                        EVENT_POSTING.size))[0] < self._records:
+                    break
+                entries -= 1
+            postings.truncate(entries * EVENT_POSTING.size)
+            self._postings[id] = postings
+        return postings
+
+    def _postings_path(self, id):
+        return '{0}.{1}.pos'.format(self.path, id)
+
+    def _name_id(self, name):
+        if name not in self._ids:
+            self._ids[name] = len(self._names['names'])
+            self._names['names'].append(name)
+            # names are saved before the records referring to them
+            self._save_names()
+        return self._ids[name]
+
+    def _load_names(self):
+        if self._names is None:
+            try:
+                with open(self.path + '.names') as f:
+                    self._names = json.load(f)
+            except (IOError, OSError, ValueError):
+                self._names = {'names': [], 'sorted': True}
+            self._ids = dict((name, id) for id, name
+                             in enumerate(self._names['names']))
+        return self._names
+
+    def _save_names(self):
+        _atomic_write(self.path + '.names', json.dumps(self._names).encode())
+
+    @staticmethod
+    def _map(stack, path):
+        """Maps the file at `path` read-only, or returns None if it's
+        missing or empty
+        """
+        try:
+            f = stack.enter_context(open(path, 'rb'))
+        except (IOError, OSError):
+            return None
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return stack.enter_context(
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @staticmethod
+    def _position(postings):
+        """Returns a function returning the position in the index of the
+        n-th record of `postings`, or of the index itself if it's None
+        """
+        if postings is None:
+            return lambda n: n
+        return lambda n: EVENT_POSTING.unpack_from(
+            postings, n * EVENT_POSTING.size)[0]
+
+    @staticmethod
+    def _search(index, position, low, high, timestamp):
+        """Returns the first n between `low` and `high` such that the
+        `position(n)`-th record of `index` is at or after `timestamp`
+        """
+        count = len(index) // EVENT_INDEX_RECORD.size
+        while low < high:
+            middle = (low + high) // 2
+            record = position(middle)
+            # postings of records lost by a crashed writer come last
+            if record < count and EVENT_INDEX_RECORD.unpack_from(
+                    index, record * EVENT_INDEX_RECORD.size)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Backend(object):
+    """Executes Packer commands on behalf of the clients
+
+    `run` executes a command to completion and returns its result,
+    raising an exception if it fails. `iter_lines` yields the lines of a
+    command's stdout as they are produced and raises an exception once
+    they are exhausted if the command failed.
+    """
+
+    def run(self, exec_path, args, out_iter=None, err_iter=None,
+            keep_output=True, watchdog=None):
+        """
+        :param string exec_path: Path to Packer executable
+        :param tuple args: The command's arguments
+        :param out_iter: Called with every line of stdout
+        :param err_iter: Called with every line of stderr
+        :param bool keep_output: Whether to keep the output in the result.
+         Output is always kept if no callbacks are provided.
+        :param _Watchdog watchdog: Terminates Packer on timeouts and
+         cancellation. Packer must then run in its own process group.
+        """
+        raise NotImplementedError()
+
+    def iter_lines(self, exec_path, args, err_iter=None):
+        raise NotImplementedError()
+
+
+class SubprocessBackend(Backend):
+    """Executes Packer with `subprocess` (the default backend)
+
+    Executables are resolved to absolute paths once and file descriptors
+    are left to Python's non-inheritable default rather than being closed
+    explicitly, which lets CPython spawn Packer with `posix_spawn` instead
+    of `fork` and `exec`. Failures raise `PackerCommandError`.
+    """
+
+    def __init__(self):
+        self._paths = {}
+
+    def run(self, exec_path, args, out_iter=None, err_iter=None,
+            keep_output=True, watchdog=None):
+        keep_stdout = keep_output or out_iter is None
+        keep_stderr = keep_output or err_iter is None
+        if watchdog is not None and watchdog.inactivity_timeout is not None:
+            out_iter = watchdog.watch(out_iter)
+            err_iter = watchdog.watch(err_iter)
+        process, cmd, timings = self._spawn(
+            exec_path, args, new_session=watchdog is not None)
+        if watchdog is not None:
+            watchdog.start(process.pid)
+        try:
+            stderr = []
+            reader = threading.Thread(
+                target=_pump, args=(process.stderr, err_iter, keep_stderr,
+                                    stderr))
+            reader.daemon = True
+            reader.start()
+            stdout = []
+            _pump(process.stdout, out_iter, keep_stdout, stdout)
+            reader.join()
+            exit_code = self._wait(process, timings)
+        except BaseException:
+            # Packer isn't in our process group, so it doesn't get the
+            # caller's Ctrl-C: let it clean up rather than orphaning it
+            if watchdog is not None and process.returncode is None:
+                _signal_group(process.pid, signal.SIGINT)
+            raise
+        finally:
+            if watchdog is not None:
+                watchdog.stop()
+        result = CommandResult(cmd, b''.join(stdout), b''.join(stderr),
+                               exit_code)
+        result.timings = timings
+        if watchdog is not None:
+            result.terminated = watchdog.reason
+            if result.terminated:
+                raise PackerCommandError(result)
+        if result.exit_code != 0:
+            raise PackerCommandError(result)
+        return result
+
+    def iter_lines(self, exec_path, args, err_iter=None):
+        process, cmd, timings = self._spawn(exec_path, args)
+        stderr = []
+        reader = threading.Thread(
+            target=_pump, args=(process.stderr, err_iter, True, stderr))
+        reader.daemon = True
+        reader.start()
+        completed = False
+        try:
+            for line in iter(process.stdout.readline, b''):
+                yield line.decode(errors='replace')
+            completed = True
+        finally:
+            # the consumer stopped iterating before the command finished
+            if not completed and process.poll() is None:
+                process.kill()
+            process.stdout.close()
+            exit_code = self._wait(process, timings)
+            reader.join()
+        if exit_code != 0:
+            raise PackerCommandError(
+                CommandResult(cmd, b'', b''.join(stderr), exit_code))
+
+    def _spawn(self, exec_path, args, new_session=False):
+        path = self._paths.get(exec_path)
+        if path is None:
+            path = shutil.which(exec_path) or exec_path
+            self._paths[exec_path] = path
+        cmd = [path] + list(args)
+        clock = time.perf_counter()
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, close_fds=False,
+                                   start_new_session=new_session)
+        timings = Timings(spawn_latency=time.perf_counter() - clock)
+        return process, cmd, timings
+
+    def _wait(self, process, timings):
+        """Waits for the process to exit, recording its resource usage in
+        `timings` where `wait4` is available
+        """
+        if not hasattr(os, 'wait4'):
+            return process.wait()
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+        except ChildProcessError:
+            return process.wait()
+        # os.waitstatus_to_exitcode() is only available from Python 3.9
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        timings.set_rusage(rusage)
+        return process.returncode
+
+
+class ShBackend(Backend):
+    """Executes Packer with the `sh` module, which is only imported once
+    the backend is first used.
+
+    Results are `sh` execution objects and failures raise `sh`
+    exceptions, as in previous versions of python-packer.
+    """
+
+    def __init__(self):
+        self._commands = {}
+
+    def run(self, exec_path, args, out_iter=None, err_iter=None,
+            keep_output=True, watchdog=None):
+        kwargs = dict()
+        if out_iter is not None:
+            kwargs["_out"] = out_iter
+            kwargs["_out_bufsize"] = 1
+        if err_iter is not None:
+            kwargs["_err"] = err_iter
+            kwargs["_err_bufsize"] = 1
+        if watchdog is None:
+            return self._command(exec_path)(*args, **kwargs)
+        if watchdog.inactivity_timeout is not None:
+            raise PackerException(
+                'inactivity timeouts are not supported by ShBackend')
+        process = self._command(exec_path)(
+            *args, _bg=True, _new_session=True, **kwargs)
+        watchdog.start(process.pid)
+        try:
+            process.wait()
+        except BaseException:
+            # see SubprocessBackend.run
+            if process.process.exit_code is None:
+                _signal_group(process.pid, signal.SIGINT)
+            raise
+        finally:
+            watchdog.stop()
+        if watchdog.reason:
+            process.terminated = watchdog.reason
+            raise PackerCommandError(CommandResult.from_sh(process))
+        return process
+
+    def iter_lines(self, exec_path, args, err_iter=None):
+        kwargs = dict(_iter=True)
+        if err_iter is not None:
+            kwargs["_err"] = err_iter
+        for line in self._command(exec_path)(*args, **kwargs):
+            yield line
+
+    def _command(self, exec_path):
+        if exec_path not in self._commands:
+            import sh
+            self._commands[exec_path] = sh.Command(exec_path)
+        return self._commands[exec_path]
+
+
+class FakeBackend(Backend):
+    """A backend which doesn't execute anything, for testing code that
+    uses the clients without Packer being installed.
+
+    Every execution is recorded in `calls` as an `(exec_path, args)`
+    tuple. The output and exit code of each subcommand are set using
+    `set_response` and default to no output and a zero exit code.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.responses = {}
+        self._lock = threading.Lock()
+
+    def set_response(self, command, stdout=b'', stderr=b'', exit_code=0):
+        """
+        :param string command: The subcommand, e.g. `build`
+        :param stdout: Output to emit on stdout, either `str` or `bytes`
+        :param stderr: Output to emit on stderr, either `str` or `bytes`
+        :param int exit_code: Exit code to fail with if not 0
+        """
+        if isinstance(stdout, str):
+            stdout = stdout.encode()
+        if isinstance(stderr, str):
+            stderr = stderr.encode()
+        self.responses[command] = (stdout, stderr, exit_code)
+
+    def run(self, exec_path, args, out_iter=None, err_iter=None,
+            keep_output=True, watchdog=None):
+        stdout, stderr, exit_code = self._respond(exec_path, args)
+        for output, callback in ((stdout, out_iter), (stderr, err_iter)):
+            if callback is not None:
+                for line in output.splitlines(True):
+                    callback(line.decode(errors='replace'))
+        if not keep_output and (out_iter or err_iter):
+            stdout, stderr = b'', b''
+        result = CommandResult([exec_path] + list(args), stdout, stderr,
+                               exit_code)
+        result.timings = Timings(spawn_latency=0.0)
+        if watchdog is not None and watchdog.reason:
+            # cancelled before it "ran"
+            result.terminated = watchdog.reason
+            raise PackerCommandError(result)
+        if exit_code != 0:
+            raise PackerCommandError(result)
+        return result
+
+    def iter_lines(self, exec_path, args, err_iter=None):
+        stdout, stderr, exit_code = self._respond(exec_path, args)
+        if err_iter is not None:
+            for line in stderr.splitlines(True):
+                err_iter(line.decode(errors='replace'))
+        for line in stdout.splitlines(True):
+            yield line.decode(errors='replace')
+        if exit_code != 0:
+            raise PackerCommandError(CommandResult(
+                [exec_path] + list(args), b'', stderr, exit_code))
+
+    def _respond(self, exec_path, args):
+        with self._lock:
+            self.calls.append((exec_path, tuple(args)))
+        return self.responses.get(args[0], (b'', b'', 0))
+
+
+class _Watchdog(object):
+    """Terminates a command's Packer processes once it times out, stops
+    producing output or is cancelled
+
+    The watchdog is created once per command and started for every Packer
+    process the command runs, so that `timeout` covers all of them (e.g.
+    retries). `timeout` runs from when the first process starts, so that
+    what happens before (e.g. waiting for a `RateLimiter`) doesn't count.
+    Packer is interrupted with SIGINT, which lets it clean up, then killed
+    if it's still running `kill_timeout` seconds later.
+    Signals are sent to Packer's process group, so Packer must be its
+    group's leader. `reason` tells why it was terminated, if it was.
+    """
+
+    def __init__(self, timeout=None, inactivity_timeout=None,
+                 kill_timeout=DEFAULT_KILL_TIMEOUT):
+        self.timeout = timeout
+        self.inactivity_timeout = inactivity_timeout
+        self.kill_timeout = kill_timeout
+        self.reason = None
+        self._deadline = None
+        self._last_output = time.monotonic()
+        self._pid = None
+        self._condition = threading.Condition()
+
+    def watch(self, callback):
+        """Returns an output callback recording activity before calling
+        `callback`, if any
+        """
+        def watched(line):
+            self._last_output = time.monotonic()
+            if callback is not None:
+                callback(line)
+        return watched
+
+    def start(self, pid):
+        """Starts watching the process group led by `pid`"""
+        with self._condition:
+            self._pid = pid
+            self._last_output = time.monotonic()
+            if self._deadline is None and self.timeout is not None:
+                self._deadline = self._last_output + self.timeout
+            if self.reason is not None:
+                # cancelled or timed out before the process started
+                self._interrupt()
+                return
+        if self._deadline is not None or \
+                self.inactivity_timeout is not None:
+            thread = threading.Thread(target=self._watch, args=(pid,))
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stops watching once the process exited"""
+        with self._condition:
+            self._pid = None
+            self._condition.notify_all()
+
+    def wait(self, seconds):
+        """Waits `seconds` while no process runs (e.g. before a retry),
+        returning early if the command is cancelled or times out. Returns
+        `reason`.
+        """
+        with self._condition:
+            end = time.monotonic() + seconds
+            while self.reason is None:
+                now = time.monotonic()
+                if self._deadline is not None and now >= self._deadline:
+                    self.reason = 'timeout'
+                    break
+                if now >= end:
+                    break
+                until = end if self._deadline is None \
+                    else min(end, self._deadline)
+                self._condition.wait(until - now)
+            return self.reason
+
+    def cancel(self):
+        self._expire('cancelled')
+
+    def _watch(self, pid):
+        with self._condition:
+            while self._pid == pid and self.reason is None:
+                now = time.monotonic()
+                deadlines = []
+                if self._deadline is not None:
+                    deadlines.append((self._deadline, 'timeout'))
+                if self.inactivity_timeout is not None:
+                    deadlines.append((self._last_output +
+                                      self.inactivity_timeout, 'inactivity'))
+                deadline, reason = min(deadlines)
+                if now >= deadline:
+                    self.reason = reason
+                    self._interrupt()
+                    break
+                self._condition.wait(deadline - now)
+
+    def _expire(self, reason):
+        with self._condition:
+            if self.reason is None:
+                self.reason = reason
+                self._interrupt()
+                self._condition.notify_all()
+
+    def _interrupt(self):
+        """Interrupts the watched process group, killing it if it's still
+        running after `kill_timeout`. Requires the lock.
+        """
+        if self._pid is None:
+            return
+        pid = self._pid
+        _signal_group(pid, signal.SIGINT)
+        timer = threading.Timer(self.kill_timeout, self._kill, args=(pid,))
+        timer.daemon = True
+        timer.start()
+
+    def _kill(self, pid):
+        with self._condition:
+            # the process exited and its pid may have been reused since
+            if self._pid == pid:
+                _signal_group(pid, getattr(signal, 'SIGKILL',
+                                           signal.SIGTERM))
+
+
+def _signal_group(pid, signum):
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(pid, signum)
+        else:
+            os.kill(pid, signum)
+    except OSError:
+        # the process group is already gone
+        pass
+
+
+def _pump(stream, callback, keep, chunks):
+    """Reads a stream line by line, passing each line to `callback` and
+    collecting it in `chunks` if `keep` is set.
+    """
+    if callback is None:
+        if keep:
+            chunks.append(stream.read())
+        else:
+            while stream.read(65536):
+                pass
+        stream.close()
+        return
+    for line in iter(stream.readline, b''):
+        if keep:
+            chunks.append(line)
+        if callback is not None:
+            callback(line.decode(errors='replace'))
+    stream.close()
+
+
+class Installer(object):
+    """Installs Packer from a release archive
+
+    Only the `packer` executable is extracted from the archive. If
+    `checksums_path` is given, the archive is first verified against the
+    `SHA256SUMS` file published with it.
+
+    If `cache_dir` is given, every version is extracted once into it and
+    hardlinked into `packer_path`, so that many installations (e.g. one
+    per worker) share a single copy and installing a cached version only
+    takes a link. The version is read from the archive's name unless
+    `version` is given.
+    """
+
+    def __init__(self, packer_path, installer_path, checksums_path=None,
+                 cache_dir=None, version=None):
+        """
+        :param string packer_path: Directory to install Packer to
+        :param string installer_path: Path to the release's zip archive
+        :param string checksums_path: Path to the release's SHA256SUMS file
+        :param string cache_dir: Directory holding installed versions,
+         possibly shared between installers
+        :param string version: The archive's version and platform, e.g.
+         `1.2.3_linux_amd64`. Defaults to the one in the archive's name.
+        """
+        self.packer_path = packer_path
+        self.installer_path = installer_path
+        self.checksums_path = checksums_path
+        self.cache_dir = cache_dir
+        self.version = version
+        if version is None:
+            match = RELEASE_ARCHIVE_REGEX.match(
+                os.path.basename(installer_path))
+            if match:
+                self.version = '{0}_{1}'.format(match.group('version'),
+                                                match.group('platform'))
+
+    def install(self):
+        """Installs Packer, returning the path to the executable"""
+        exec_path = os.path.join(self.packer_path, 'packer')
+        if self.cache_dir and self.version:
+            cached = os.path.join(self.cache_dir, self.version, 'packer')
+            if not os.path.isfile(cached):
+                self._extract(os.path.dirname(cached))
+            _link(cached, exec_path)
+        else:
+            self._extract(self.packer_path)
+        if not self._verify_packer_installed(exec_path):
+            raise PackerException('packer installation failed. '
+                                  'Executable could not be found under: '
+                                  '{0}'.format(exec_path))
+        else:
+            return exec_path
+
+    def verify(self):
+        """Raises a `PackerException` unless the archive's SHA256 matches
+        the one listed for it in `checksums_path`
+        """
+        name = os.path.basename(self.installer_path)
+        expected = None
+        with open(self.checksums_path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and parts[1].lstrip('*') == name:
+                    expected = parts[0].lower()
+        if expected is None:
+            raise PackerException('{0} is not listed in {1}'.format(
+                name, self.checksums_path))
+        digest = hashlib.sha256()
+        with open(self.installer_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        if digest.hexdigest() != expected:
+            raise PackerException('checksum mismatch for {0}: expected {1}, '
+                                  'got {2}'.format(name, expected,
+                                                   digest.hexdigest()))
+
+    def _extract(self, directory):
+        """Verifies the archive and atomically extracts the executable into
+        `directory`
+        """
+        import zipfile
+
+        if self.checksums_path:
+            self.verify()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with zipfile.ZipFile(self.installer_path) as archive:
+            names = [name for name in archive.namelist()
+                     if os.path.basename(name) in ('packer', 'packer.exe')]
+            if not names:
+                raise PackerException('packer installation failed. {0} '
+                                      'holds no packer executable'.format(
+                                          self.installer_path))
+            with archive.open(names[0]) as src:
+                _atomic_write(os.path.join(directory, 'packer'), src,
+                              mode=0o755)
+
+    def _verify_packer_installed(self, packer_path):
+        return os.path.isfile(packer_path)
+
+
+def _link(source, destination):
+    """Atomically replaces `destination` with a hardlink to `source`, or
+    with a copy of it if they're on different filesystems
+    """
+    try:
+        if os.path.samefile(source, destination):
+            return
+    except OSError:
+        pass
+    directory = os.path.dirname(os.path.abspath(destination))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp_path = os.path.join(directory, '.{0}.{1}.{2}'.format(
+        os.path.basename(destination), os.getpid(), threading.get_ident()))
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        shutil.copy2(source, temp_path)
+    os.replace(temp_path, destination)
+
+
+def _atomic_write(path, data, mode=None):
+    """Atomically replaces the file at `path` with `data`, going through a
+    hidden temporary file in the same directory which is removed if
+    writing fails
+
+    :param data: The content, as bytes or a binary file to copy
+    :param int mode: Permissions to give the file
+    """
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix='.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if isinstance(data, bytes):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f, DOWNLOAD_CHUNK_SIZE)
+        if mode is not None:
+            os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def _evict_lru(directory, max_bytes, keep_latest=False):
+    """Removes the least recently used files of `directory`, by mtime,
+    until they take at most `max_bytes`. Hidden files (e.g. temporary
+    files being written) are ignored.
+
+    :param bool keep_latest: Keep the most recently used file even if it
+     alone takes more than `max_bytes`
+    """
+    entries = []
+    for name in os.listdir(directory):
+        if name.startswith('.'):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    size = sum(entry[1] for entry in entries)
+    entries.sort()
+    if keep_latest:
+        entries = entries[:-1]
+    for _, entry_size, path in entries:
+        if size <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        size -= entry_size
+
+
+class ValidationObject():
+    pass
+
+
+class CommandResult(object):
+    """The outcome of a Packer execution
+
+    Exposes the same `cmd`, `stdout`, `stderr` and `exit_code` attributes
+    an `sh` execution object does.
+    """
+
+    def __init__(self, cmd, stdout, stderr, exit_code):
+        self.cmd = cmd
+        self.stdout = stdout
+        self.stderr = stderr
+        self.exit_code = exit_code
+
+    @classmethod
+    def from_sh(cls, execution):
+        """Creates a `CommandResult` from an `sh` execution object,
+        keeping any attributes the clients set on it.
+        """
+        result = cls(
+            [arg.decode() if isinstance(arg, bytes) else arg
+             for arg in execution.cmd],
+            execution.stdout, execution.stderr, execution.exit_code)
+        for attribute in RESULT_ATTRIBUTES:
+            if hasattr(execution, attribute):
+                setattr(result, attribute, getattr(execution, attribute))
+        return result
+
+
+class PackerException(Exception):
+    pass
+
+
+class PackerCommandError(PackerException):
+    """Raised when a Packer execution exits with a non-zero exit code
+
+    The failed execution's `CommandResult` is available as `result`.
+    """
+
+    def __init__(self, result):
+        self.result = result
+        super(PackerCommandError, self).__init__(
+            '`{0}` failed with exit code {1}\n\nSTDOUT:\n{2}\n'
+            'STDERR:\n{3}'.format(
+                ' '.join(result.cmd), result.exit_code,
+                result.stdout.decode(errors='replace'),
+                result.stderr.decode(errors='replace')))
+
+    def __reduce__(self):
+        return self.__class__, (self.result,)
@@ -20,7 +20,7 @@ setup(
     description='A Python interface for Hashicorp\'s Packer',
     long_description=read('README.rst'),
     py_modules=['packer'],
-    install_requires=["sh"],
+    extras_require={'sh': ['sh']},
     classifiers=[
         'Programming Language :: Python',
         'Natural Language :: English',
@@ -1,24 +1,170 @@
 import packer
 
+import asyncio
 import testtools
+import concurrent.futures
+import functools
+import gzip
+import hashlib
+import http.server
+import json
 import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import zipfile
 
 PACKER_PATH = '/usr/bin/packer'
 TEST_RESOURCES_DIR = 'tests/resources'
 TEST_PACKERFILE = os.path.join(TEST_RESOURCES_DIR, 'simple-test.json')
 TEST_BAD_PACKERFILE = os.path.join(TEST_RESOURCES_DIR, 'badpackerfile.json')
+TEST_FULL_PACKERFILE = os.path.join(TEST_RESOURCES_DIR, 'packerfile.json')
 
 
-class TestBase(testtools.TestCase):
+class TestCase(testtools.TestCase):
+
+    def mkdtemp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        return path
+
+
+class TestBase(TestCase):
 
     def test_build(self):
         p = packer.Packer(TEST_PACKERFILE)
         p.build()
 
+    def test_build_events(self):
+        p = packer.Packer(TEST_PACKERFILE)
+        types = [event.type for event in p.build_events()]
+        self.assertIn('builder-start', types)
+
+    def test_build_output_log(self):
+        log_path = os.path.join(self.mkdtemp(), 'build.log')
+        p = packer.Packer(TEST_PACKERFILE)
+        result = p.build(output_log=packer.OutputLog(log_path, tail_lines=1))
+        self.assertEqual(1, len(result.tail.splitlines()))
+        self.assertEqual(log_path, result.log_path)
+        with open(log_path) as f:
+            self.assertTrue(f.read().endswith(result.tail))
+
+    def test_build_timings(self):
+        calls = []
+        p = packer.Packer(TEST_PACKERFILE,
+                          hooks=[lambda *args: calls.append(args)])
+        result = p.build(machine_readable=True)
+        timings = result.timings
+        self.assertEqual('build', timings.command)
+        self.assertGreaterEqual(timings.wall_time, timings.spawn_latency)
+        if hasattr(os, 'wait4'):
+            self.assertGreater(timings.max_rss, 0)
+        self.assertEqual(['null'], list(timings.builders))
+        self.assertFalse(timings.builders['null']['errored'])
+        self.assertEqual([(timings, result, None)], calls)
+
+    def test_build_many(self):
+        jobs = [packer.PackerJob(TEST_PACKERFILE, name=str(i))
+                for i in range(4)]
+        batch = packer.Packer.build_many(jobs, max_workers=2)
+        self.assertTrue(batch.succeeded)
+        self.assertEqual(['0', '1', '2', '3'],
+                         [result.job.name for result in batch.results])
+
+    def test_validate_many_in_processes(self):
+        jobs = [packer.PackerJob(TEST_PACKERFILE) for _ in range(2)]
+        batch = packer.Packer.validate_many(jobs, processes=True)
+        self.assertTrue(batch.succeeded)
+        self.assertIsInstance(batch.results[0].result, packer.CommandResult)
+
+    def test_build_arguments(self):
+        p = packer.Packer(TEST_PACKERFILE, only=['a', 'b'],
+                          vars={'key': 'value'}, var_file='vars.json')
+        self.assertEqual(
+            ('build', '-parallel=true', '-force', '-only=a,b', '-var',
+             'key=value', '-var-file=vars.json', TEST_PACKERFILE),
+            p._build_arguments(True, False, True, False))
+
+    def test_var_file_spill(self):
+        vars = dict(('var{0}'.format(i), i) for i in range(3))
+        p = packer.Packer(TEST_PACKERFILE, vars=vars, var_file='vars.json',
+                          var_file_threshold=2)
+        args = p._validate_arguments(False)
+        self.assertNotIn('-var', args)
+        self.assertEqual('-var-file=vars.json', args[-2])
+        spilled = args[-3].split('=', 1)[1]
+        with open(spilled) as f:
+            self.assertEqual({'var0': '0', 'var1': '1', 'var2': '2'},
+                             json.load(f))
+        self.assertEqual(args, p._validate_arguments(False))
+        # removed by a temporary files cleaner
+        shutil.rmtree(os.path.dirname(spilled))
+        self.assertEqual(args, p._validate_arguments(False))
+        self.assertTrue(os.path.isfile(spilled))
+
+    def test_concurrent_commands(self):
+        p = packer.Packer(TEST_PACKERFILE)
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            inspections = executor.map(lambda _: p.inspect(), range(4))
+            validations = executor.map(lambda _: p.validate(), range(4))
+            for inspection, validation in zip(inspections, validations):
+                self.assertIn('builders', inspection.parsed_output)
+                self.assertTrue(validation.succeeded)
+
+    def test_sh_backend(self):
+        p = packer.Packer(TEST_PACKERFILE, backend=packer.ShBackend())
+        self.assertEqual(0, p.validate().exit_code)
+
     def test_fix(self):
         p = packer.Packer(TEST_PACKERFILE)
         p.fix()
 
+    def test_fix_many(self):
+        directory = self.mkdtemp()
+        os.makedirs(os.path.join(directory, 'nested'))
+        templates = {
+            'old.json': {'builders': [{'type': 'null',
+                                       'ssh_wait_timeout': '1m'}]},
+            'nested/new.json': {'builders': [{'type': 'null',
+                                              'ssh_timeout': '1m'}]},
+            'vars.json': {'region': 'eu-west-1'},
+        }
+        for name, template in templates.items():
+            with open(os.path.join(directory, name), 'w') as f:
+                json.dump(template, f)
+        os.chmod(os.path.join(directory, 'old.json'), 0o640)
+        backend = packer.FakeBackend()
+        backend.set_response('fix', json.dumps(
+            templates['nested/new.json'], indent=2))
+        batch = packer.Packer.fix_many([directory], backend=backend)
+        self.assertTrue(batch.succeeded)
+        results = dict((os.path.relpath(result.job.packerfile, directory),
+                        result.result) for result in batch.results)
+        self.assertEqual(['nested/new.json', 'old.json'], sorted(results))
+        self.assertFalse(results['nested/new.json'].changed)
+        self.assertEqual(['+ builders[0].ssh_timeout',
+                          '- builders[0].ssh_wait_timeout'],
+                         results['old.json'].changes)
+        path = os.path.join(directory, 'old.json')
+        with open(path) as f:
+            self.assertEqual(templates['nested/new.json'], json.load(f))
+        self.assertEqual(0o640, os.stat(path).st_mode & 0o777)
+
+    def test_atomic_write_failure(self):
+        directory = self.mkdtemp()
+        path = os.path.join(directory, 'manifest.json')
+        packer._atomic_write(path, b'old')
+
+        class Broken(object):
+            def read(self, size):
+                raise IOError('disk full')
+        self.assertRaises(IOError, packer._atomic_write, path, Broken())
+        with open(path, 'rb') as f:
+            self.assertEqual(b'old', f.read())
+        self.assertEqual(['manifest.json'], os.listdir(directory))
+
     def test_inspect(self):
         p = packer.Packer(TEST_PACKERFILE)
         p.inspect()
@@ -30,3 +176,1062 @@ class TestBase(testtools.TestCase):
     def test_version(self):
         p = packer.Packer(TEST_PACKERFILE)
         p.version()
+
+
+class TestAsyncPacker(TestCase):
+
+    def test_build(self):
+        p = packer.AsyncPacker(TEST_PACKERFILE)
+        asyncio.run(p.build())
+
+    def test_validate_timings(self):
+        calls = []
+        p = packer.AsyncPacker(TEST_PACKERFILE,
+                               hooks=[lambda *args: calls.append(args)])
+        result = asyncio.run(p.validate())
+        self.assertEqual('validate', result.timings.command)
+        self.assertIsNotNone(result.timings.spawn_latency)
+        self.assertEqual(1, len(calls))
+
+    def test_build_streams_output(self):
+        lines = []
+        p = packer.AsyncPacker(TEST_PACKERFILE, out_iter=lines.append)
+        result = asyncio.run(p.build())
+        self.assertEqual(''.join(lines), result.stdout.decode())
+
+    def test_failed_callback_kills_packer(self):
+        directory = self.mkdtemp()
+        exec_path = os.path.join(directory, 'packer')
+        pid_path = os.path.join(directory, 'pid')
+        with open(exec_path, 'w') as f:
+            f.write('#!/bin/sh\necho $$ > {0}\necho started\nexec sleep 30\n'
+                    .format(pid_path))
+        os.chmod(exec_path, 0o755)
+
+        def fail(line):
+            raise RuntimeError(line)
+        p = packer.AsyncPacker(TEST_PACKERFILE, exec_path=exec_path,
+                               out_iter=fail)
+        self.assertRaises(RuntimeError, asyncio.run, p.build())
+        with open(pid_path) as f:
+            pid = int(f.read())
+        # the process was killed and reaped
+        self.assertRaises(ProcessLookupError, os.kill, pid, 0)
+
+    def test_build_events(self):
+        async def collect():
+            p = packer.AsyncPacker(TEST_PACKERFILE)
+            return [event async for event in p.build_events()]
+
+        events = asyncio.run(collect())
+        self.assertIn('builder-finish', [event.type for event in events])
+
+    def test_concurrent_validate(self):
+        async def validate_many():
+            semaphore = asyncio.Semaphore(2)
+            clients = [packer.AsyncPacker(TEST_PACKERFILE, semaphore=semaphore)
+                       for _ in range(5)]
+            return await asyncio.gather(*[c.validate() for c in clients])
+
+        for validation in asyncio.run(validate_many()):
+            self.assertTrue(validation.succeeded)
+
+    def test_fix(self):
+        p = packer.AsyncPacker(TEST_PACKERFILE)
+        self.assertIsInstance(asyncio.run(p.fix()).fixed, dict)
+
+    def test_inspect(self):
+        p = packer.AsyncPacker(TEST_PACKERFILE)
+        result = asyncio.run(p.inspect())
+        self.assertIn('builders', result.parsed_output)
+
+    def test_version(self):
+        p = packer.AsyncPacker(TEST_PACKERFILE)
+        asyncio.run(p.version())
+
+
+class TestMachineReadableParser(TestCase):
+
+    def test_parse_unescapes_data(self):
+        events = list(packer.parse_machine_readable([
+            '1500000000,,ui,say,a%!(PACKER_COMMA) b\\nc\n']))
+        self.assertEqual(1, len(events))
+        self.assertIsInstance(events[0], packer.UiEvent)
+        self.assertEqual('say', events[0].level)
+        self.assertEqual('a, b\nc', events[0].message)
+
+    def test_parse_builder_lifecycle(self):
+        events = list(packer.parse_machine_readable([
+            b'1500000000,amazon,ui,say,==> amazon: Creating instance',
+            b'1500000001,amazon,artifact-count,1',
+            b'1500000001,amazon,artifact,0,id,eu-west-1:ami-1234',
+            b"1500000002,,ui,say,Build 'amazon' finished.",
+            b"1500000003,,ui,error,Build 'qemu' errored: boom",
+            b'1500000003,,error-count,1',
+        ]))
+        types = [event.type for event in events]
+        self.assertEqual(
+            ['builder-start', 'ui', 'artifact-count', 'artifact', 'ui',
+             'builder-finish', 'ui', 'builder-finish', 'error-count'],
+            types)
+        self.assertEqual('eu-west-1:ami-1234', events[3].value)
+        self.assertEqual('amazon', events[5].target)
+        self.assertFalse(events[5].errored)
+        self.assertTrue(events[7].errored)
+        self.assertEqual('boom', events[7].message)
+        self.assertEqual(1, events[8].count)
+
+    def test_parse_skips_non_machine_readable_lines(self):
+        events = list(packer.parse_machine_readable([
+            '2017/01/01 12:00:00 ui: ==> amazon: Creating instance',
+            '']))
+        self.assertEqual([], events)
+
+    def test_parse_skips_truncated_lines(self):
+        events = list(packer.parse_machine_readable([
+            '1500000000,amazon,artifact',
+            '1500000000,amazon,artifact-count,',
+            '1500000000,,error-count,x',
+            '1500000001,amazon,ui,say']))
+        self.assertEqual(['builder-start', 'ui'],
+                         [event.type for event in events])
+
+
+class TestOutputLog(TestCase):
+
+    def test_rotate(self):
+        log_path = os.path.join(self.mkdtemp(), 'build.log')
+        with packer.OutputLog(log_path, tail_lines=2, max_bytes=10,
+                              backup_count=2) as log:
+            for line in ['first line\n', 'second line\n', 'third line\n']:
+                log.write(line)
+        self.assertEqual('second line\nthird line\n', log.tail)
+        with gzip.open(log_path + '.1.gz', 'rt') as f:
+            self.assertEqual('third line\n', f.read())
+        with gzip.open(log_path + '.2.gz', 'rt') as f:
+            self.assertEqual('second line\n', f.read())
+        self.assertFalse(os.path.exists(log_path + '.3.gz'))
+
+
+class TestEventLog(TestCase):
+
+    def test_query(self):
+        path = os.path.join(self.mkdtemp(), 'events')
+        with packer.EventLog(path) as log:
+            for line in [
+                    '100,,ui,say,starting\n',
+                    'not machine-readable\n',
+                    '110,web,ui,error,disk full%!(PACKER_COMMA) retrying\n',
+                    '120,db,artifact,0,id,ami-1\n',
+                    "130,,ui,error,Build 'web' errored: disk full\n"]:
+                log.write(line)
+        self.assertIn('not machine-readable', log.tail)
+        log = packer.EventLog(path)
+        self.assertEqual(7, len(list(log.events())))
+        events = list(log.events(target='web', type='ui'))
+        self.assertEqual(['disk full, retrying'],
+                         [event.message for event in events])
+        finished = list(log.events(type='builder-finish'))
+        self.assertTrue(finished[0].errored)
+        self.assertEqual('web', finished[0].target)
+        self.assertEqual([110, 110, 120, 120], [
+            event.timestamp for event in log.events(since=105, until=120)])
+        self.assertEqual([], list(log.events(target='missing')))
+
+    def test_postings(self):
+        path = os.path.join(self.mkdtemp(), 'events')
+        with packer.EventLog(path) as log:
+            for timestamp in range(100, 109):
+                log.write('{0},{1},ui,say,hello\n'.format(
+                    timestamp, 'web' if timestamp % 3 else 'db'))
+        log = packer.EventLog(path)
+        self.assertEqual([102, 105], [event.timestamp for event in log.events(
+            target='db', type='ui', since=101, until=107)])
+        # a crashed writer lost the last record but not its postings
+        with open(path + '.idx', 'r+b') as index:
+            index.truncate(8 * packer.EVENT_INDEX_RECORD.size)
+        self.assertEqual([102, 105], [
+            event.timestamp for event in log.events(target='db', type='ui')])
+        log.write('110,db,ui,say,hello\n')
+        log.close()
+        self.assertEqual([102, 105, 110], [
+            event.timestamp for event in log.events(target='db', type='ui',
+                                                    since=0)])
+
+    def test_build(self):
+        path = os.path.join(self.mkdtemp(), 'events')
+        p = packer.Packer(TEST_PACKERFILE)
+        for _ in range(2):
+            result = p.build(machine_readable=True,
+                             output_log=packer.EventLog(path))
+        self.assertEqual(path, result.log_path)
+        artifacts = list(packer.EventLog(path).events(type='artifact'))
+        self.assertEqual(2, len(artifacts))
+        self.assertEqual(2, len(list(packer.EventLog(path).events(
+            type='builder-start'))))
+
+
+class TestValidationServer(TestCase):
+
+    def setUp(self):
+        super(TestValidationServer, self).setUp()
+        self.backend = packer.FakeBackend()
+        self.path = os.path.join(self.mkdtemp(), 'packer.sock')
+        self.server = packer.ValidationServer(
+            self.path, backend=self.backend, max_workers=2).start()
+        self.addCleanup(self.server.close)
+        self.client = packer.ValidationClient(self.path, timeout=10)
+
+    def test_probe(self):
+        self.assertEqual(('version',), self.backend.calls[0][1])
+
+    def test_in_process(self):
+        path = os.path.join(self.mkdtemp(), 'packer.sock')
+        with packer.ValidationServer(path, backend=self.backend,
+                                     in_process=True):
+            client = packer.ValidationClient(path)
+            result = client.inspect(TEST_FULL_PACKERFILE)
+            self.assertIsNone(result.cmd)
+            self.assertEqual(3, len(result.parsed_output['builders']))
+            self.assertTrue(client.validate(TEST_FULL_PACKERFILE,
+                                            syntax_only=True).succeeded)
+        self.assertEqual({'version'}, set(call[1][0]
+                                          for call in self.backend.calls))
+
+    def test_validate(self):
+        self.backend.set_response('validate', 'Template validated\n')
+        for _ in range(2):
+            result = self.client.validate(TEST_PACKERFILE,
+                                          vars={'a': 'b'})
+        self.assertTrue(result.succeeded)
+        self.assertEqual(b'Template validated\n', result.stdout)
+        # the second validation came from the server's cache
+        self.assertEqual(1, len([call for call in self.backend.calls
+                                 if call[1][0] == 'validate']))
+        self.backend.set_response('validate', exit_code=1)
+        result = self.client.validate(TEST_FULL_PACKERFILE)
+        self.assertFalse(result.succeeded)
+        self.assertIn('exit code 1', result.error)
+
+    def test_inspect_many(self):
+        self.backend.set_response(
+            'inspect', '1500000000,,template-builder,a,null\n')
+        batch = self.client.inspect_many([
+            packer.PackerJob(TEST_PACKERFILE),
+            packer.PackerJob('missing.json')])
+        self.assertEqual([{'name': 'a', 'type': 'null'}],
+                         batch.results[0].result.parsed_output['builders'])
+        self.assertIn('not found', str(batch.results[1].error))
+        self.backend.set_response('inspect', exit_code=1)
+        self.assertRaises(packer.PackerCommandError, self.client.inspect,
+                          TEST_FULL_PACKERFILE)
+
+    def test_socket_in_use(self):
+        self.assertRaises(OSError, packer.ValidationServer(
+            self.path, backend=self.backend).start)
+        # only sockets are replaced
+        path = os.path.join(self.mkdtemp(), 'file')
+        open(path, 'w').close()
+        self.assertRaises(OSError, packer.ValidationServer(
+            path, backend=self.backend).start)
+        self.assertTrue(os.path.isfile(path))
+        # the socket of a server which died is replaced
+        path = os.path.join(self.mkdtemp(), 'stale.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.close()
+        with packer.ValidationServer(path, backend=self.backend):
+            self.assertTrue(packer.ValidationClient(path).validate(
+                TEST_PACKERFILE).succeeded)
+
+
+class TestResultCache(TestCase):
+
+    def test_persist_and_evict(self):
+        path = self.mkdtemp()
+        cache = packer.ResultCache(max_entries=1, path=path, max_bytes=1500)
+        for mtime, key in enumerate(('a', 'b')):
+            cache.set(key, packer.CommandResult(
+                ['packer', 'inspect'], b'x' * 400, b'', 0))
+            os.utime(os.path.join(path, key), (mtime, mtime))
+        self.assertEqual(b'x' * 400, cache.get('a').stdout)
+        cache.set('c', packer.CommandResult(
+            ['packer', 'inspect'], b'x' * 400, b'', 0))
+        self.assertEqual(['a', 'c'], sorted(os.listdir(path)))
+        self.assertIsNone(packer.ResultCache(path=path).get('b'))
+
+
+class TestTemplate(TestCase):
+
+    def test_inspect(self):
+        template = packer.Template({
+            'variables': {'b': 'x', 'a': None, 'c': 1},
+            'builders': [{'type': 'qemu'}, {'type': 'null', 'name': 'a'}],
+            'provisioners': [{'type': 'shell'}],
+        })
+        self.assertEqual({
+            'variables': [{'name': 'a', 'value': ''},
+                          {'name': 'b', 'value': 'x'},
+                          {'name': 'c', 'value': '1'}],
+            'builders': [{'name': 'a', 'type': 'null'},
+                         {'name': 'qemu', 'type': 'qemu'}],
+            'provisioners': [{'type': 'shell'}],
+        }, template.inspect())
+
+    def test_syntax_errors(self):
+        template = packer.Template({
+            'builders': [{'type': 'null'}, {'type': 'null'}],
+            'provisioners': [{'type': 'shell', 'only': ['missing']}],
+            'unknown': True,
+        })
+        self.assertEqual(3, len(template.syntax_errors()))
+        self.assertEqual([], packer.Template.load(
+            TEST_FULL_PACKERFILE).syntax_errors())
+
+    def test_user_variable_references(self):
+        template = packer.Template.load(TEST_FULL_PACKERFILE)
+        self.assertIn('aws_source_ami', template.user_variable_references())
+        self.assertEqual(set(), template.undeclared_variables())
+
+    def test_local_files(self):
+        template = packer.Template({'provisioners': [
+            {'type': 'shell', 'scripts': ['a.sh', 'b.sh']},
+            {'type': 'file', 'source': 'files/', 'destination': '/tmp'},
+            {'type': 'file', 'source': '/etc/motd', 'destination': 'motd',
+             'direction': 'download'},
+        ]})
+        self.assertEqual(['a.sh', 'b.sh', 'files/'], template.local_files())
+
+    def test_in_process_client(self):
+        # executing /bin/false would fail, so the results must come from
+        # the analyzer
+        p = packer.Packer(TEST_FULL_PACKERFILE, exec_path='/bin/false',
+                          in_process=True)
+        self.assertEqual(3, len(p.inspect().parsed_output['builders']))
+        self.assertTrue(p.validate(syntax_only=True).succeeded)
+
+
+class TestTemplateIndex(TestCase):
+
+    def setUp(self):
+        super(TestTemplateIndex, self).setUp()
+        self.root = self.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'scripts', 'common'))
+        self.write('scripts/base.sh', 'true')
+        self.write('scripts/common/setup.sh', 'true')
+        self.write('web.json', {
+            'variables': {'dir': 'common'},
+            'builders': [{'type': 'null'}],
+            'provisioners': [
+                {'type': 'shell',
+                 'script': '{{template_dir}}/scripts/base.sh'},
+                {'type': 'shell', 'scripts': [
+                    "{{template_dir}}/scripts/{{user `dir`}}/setup.sh"]}],
+        })
+        self.write('db.json', {
+            'builders': [{'type': 'null', 'ami': "{{user `ami`}}"}],
+            'provisioners': [{'type': 'file', 'destination': '/tmp',
+                              'source': '{{template_dir}}/scripts/common'}],
+        })
+        self.write('vars.json', {'ami': 'ami-1'})
+        self.index = packer.TemplateIndex(
+            os.path.join(self.root, '.index.json'), self.root,
+            var_files={os.path.join(self.root, 'db.json'):
+                       os.path.join(self.root, 'vars.json')})
+
+    def write(self, name, contents):
+        with open(os.path.join(self.root, name), 'w') as f:
+            if isinstance(contents, dict):
+                json.dump(contents, f)
+            else:
+                f.write(contents)
+
+    def path(self, *names):
+        return [os.path.join(self.root, name) for name in names]
+
+    def test_dependents(self):
+        self.assertEqual(self.path('db.json', 'web.json'),
+                         self.index.update())
+        self.assertEqual(self.path('db.json', 'web.json'),
+                         self.index.templates)
+        self.assertEqual(self.path('web.json'), self.index.dependents(
+            self.path('scripts/base.sh')))
+        self.assertEqual(self.path('db.json', 'web.json'),
+                         self.index.dependents(
+                             self.path('scripts/common/setup.sh')))
+        self.assertEqual(self.path('db.json', 'web.json'),
+                         self.index.dependents(self.path('scripts')))
+        self.assertEqual(self.path('db.json'), self.index.dependents(
+            self.path('vars.json'), variables=['ami']))
+        self.assertEqual([], self.index.dependents(self.path('README')))
+
+    def test_incremental_update(self):
+        self.index.update()
+        self.assertEqual([], self.index.update())
+        # touching a file without changing it doesn't parse it again
+        os.utime(os.path.join(self.root, 'web.json'), (0, 0))
+        self.assertEqual([], self.index.update())
+        self.write('db.json', {'builders': [{'type': 'null'}]})
+        os.remove(os.path.join(self.root, 'web.json'))
+        self.assertEqual(self.path('db.json', 'web.json'),
+                         self.index.update())
+        # the index is persisted
+        index = packer.TemplateIndex(self.index.path, self.root)
+        self.assertEqual(self.path('db.json'), index.templates)
+        self.assertEqual([], index.dependents(self.path('scripts')))
+
+    def test_unresolved_files(self):
+        self.write('web.json', {
+            'builders': [{'type': 'null'}],
+            'provisioners': [{'type': 'shell',
+                              'script': '{{env `SCRIPT`}}'}],
+        })
+        self.index.update()
+        self.assertEqual(self.path('web.json'), self.index.dependents(
+            self.path('README')))
+
+
+class TestBuildQueue(TestCase):
+
+    def setUp(self):
+        super(TestBuildQueue, self).setUp()
+        self.directory = self.mkdtemp()
+        self.path = os.path.join(self.directory, 'queue.db')
+        self.queue = packer.BuildQueue(self.path, lease_seconds=60)
+
+    def test_worker(self):
+        backend = packer.FakeBackend()
+        backend.set_response('build', '1,null,artifact,0,id,image-1\n')
+        ids = [self.queue.put(packer.PackerJob(TEST_PACKERFILE, name=str(i),
+                                               vars={'index': i}),
+                              machine_readable=True)
+               for i in range(3)]
+        log_dir = os.path.join(self.directory, 'logs')
+        worker = packer.BuildWorker(self.queue, name='w1', backend=backend,
+                                    log_dir=log_dir)
+        self.assertEqual(3, worker.run(wait=False))
+        self.assertEqual({'succeeded': 3}, self.queue.counts())
+        queued = self.queue.get(ids[0])
+        self.assertEqual('w1', queued.worker)
+        self.assertEqual(0, queued.exit_code)
+        self.assertEqual([{'builder': 'null', 'id': 'image-1'}],
+                         queued.artifacts)
+        self.assertEqual(os.path.join(log_dir, '{0}.log'.format(ids[0])),
+                         queued.log_path)
+        self.assertIn('-var', backend.calls[0][1])
+
+    def test_failed_build(self):
+        backend = packer.FakeBackend()
+        backend.set_response('build', stderr='boom\n', exit_code=1)
+        job_id = self.queue.put(packer.PackerJob(TEST_PACKERFILE))
+        packer.BuildWorker(self.queue, backend=backend).run(wait=False)
+        queued = self.queue.get(job_id)
+        self.assertEqual('failed', queued.state)
+        self.assertEqual(1, queued.exit_code)
+        self.assertTrue(self.queue.requeue(job_id))
+        self.assertEqual('pending', self.queue.get(job_id).state)
+
+    def test_lost_lease(self):
+        exec_path = os.path.join(self.directory, 'packer')
+        with open(exec_path, 'w') as f:
+            f.write('#!/bin/sh\ntrap "exit 1" INT\nsleep 30\n')
+        os.chmod(exec_path, 0o755)
+        queue = packer.BuildQueue(self.path, lease_seconds=0.3)
+        job_id = queue.put(packer.PackerJob(TEST_PACKERFILE))
+        queue.heartbeat = lambda job_id, worker: False
+        started = time.monotonic()
+        packer.BuildWorker(queue, exec_path=exec_path).run(wait=False)
+        self.assertLess(time.monotonic() - started, 10)
+        queued = queue.get(job_id)
+        self.assertEqual('failed', queued.state)
+        self.assertEqual(1, queued.exit_code)
+
+    def test_expired_lease(self):
+        queue = packer.BuildQueue(self.path, lease_seconds=-1,
+                                  max_attempts=2)
+        job_id = queue.put(packer.PackerJob(TEST_PACKERFILE))
+        self.assertEqual(job_id, queue.lease('crashed').id)
+        self.assertEqual(2, queue.lease('w2').attempts)
+        self.assertFalse(queue.complete(job_id, 'crashed'))
+        self.assertFalse(queue.heartbeat(job_id, 'crashed'))
+        self.assertIsNone(queue.lease('w3'))
+        self.assertEqual('failed', queue.get(job_id).state)
+
+    def test_run_workers(self):
+        for i in range(4):
+            self.queue.put(packer.PackerJob(TEST_PACKERFILE))
+        packer.run_workers(self.path, processes=2)
+        self.assertEqual({'succeeded': 4}, self.queue.counts())
+
+
+class TestIsoCache(TestCase):
+
+    def setUp(self):
+        super(TestIsoCache, self).setUp()
+        self.directory = self.mkdtemp()
+        self.iso = b'iso' * 1000
+        with open(os.path.join(self.directory, 'x.iso'), 'wb') as f:
+            f.write(self.iso)
+        self.requests = []
+
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            def log_message(handler, *args):
+                self.requests.append(handler.path)
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), (
+            functools.partial(Handler, directory=self.directory)))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = 'http://127.0.0.1:{0}'.format(server.server_port)
+
+    def test_build_uses_cached_iso(self):
+        packerfile = os.path.join(self.directory, 'template.json')
+        with open(packerfile, 'w') as f:
+            json.dump({'builders': [{
+                'type': 'qemu', 'iso_url': '{{user `mirror`}}/x.iso',
+                'iso_checksum': 'sha256:' + hashlib.sha256(
+                    self.iso).hexdigest()}]}, f)
+        backend = packer.FakeBackend()
+        templates = []
+        run = backend.run
+
+        def read_template(exec_path, args, **kwargs):
+            with open(args[-1]) as f:
+                templates.append(json.load(f))
+            return run(exec_path, args, **kwargs)
+
+        backend.run = read_template
+        cache = packer.IsoCache(os.path.join(self.directory, 'cache'))
+        p = packer.Packer(packerfile, vars={'mirror': self.url},
+                          backend=backend, iso_cache=cache)
+        p.build()
+        p.build()
+        iso_url = templates[0]['builders'][0]['iso_url']
+        self.assertTrue(iso_url.startswith('file://' + cache.path))
+        with open(iso_url[len('file://'):], 'rb') as f:
+            self.assertEqual(self.iso, f.read())
+        self.assertEqual(templates[0], templates[1])
+        self.assertEqual(1, len(self.requests))
+        self.assertEqual([packerfile], [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory) if name.endswith('json')])
+
+    def test_uncacheable_isos(self):
+        packerfile = os.path.join(self.directory, 'template.json')
+        checksum = 'sha256:' + hashlib.sha256(self.iso).hexdigest()
+        with open(packerfile, 'w') as f:
+            json.dump({'builders': [
+                {'type': 'qemu', 'iso_url': 'x.iso',
+                 'iso_checksum': checksum},
+                {'type': 'qemu', 'iso_url': 's3://bucket/x.iso',
+                 'iso_checksum': checksum},
+                {'type': 'qemu', 'iso_url': self.url + '/missing.iso',
+                 'iso_checksum': 'md5:' + hashlib.md5(b'').hexdigest()}]},
+                f)
+        backend = packer.FakeBackend()
+        cache = packer.IsoCache(os.path.join(self.directory, 'cache'))
+        p = packer.Packer(packerfile, backend=backend, iso_cache=cache)
+        p.build()
+        # Packer got the template as is
+        self.assertEqual(packerfile, backend.calls[-1][1][-1])
+        self.assertEqual({'/missing.iso'}, set(self.requests))
+        self.assertRaises(packer.PackerException, cache.fetch_many,
+                          [(['x.iso'], checksum, None)])
+
+    def test_resume_and_verify(self):
+        cache = packer.IsoCache(self.mkdtemp())
+        checksum = hashlib.md5(self.iso).hexdigest()
+        with open(os.path.join(cache.path, '.md5-{0}.part'.format(checksum)),
+                  'wb') as f:
+            f.write(b'garbage')
+        path = cache.fetch([self.url + '/missing.iso', self.url + '/x.iso'],
+                           checksum, 'MD5')
+        with open(path, 'rb') as f:
+            self.assertEqual(self.iso, f.read())
+        self.assertRaises(packer.PackerException, cache.fetch,
+                          [self.url + '/x.iso'], 'sha1:' + checksum[:40])
+        self.assertIsNone(cache.fetch([self.url + '/x.iso'], 'none'))
+
+
+class TestInstaller(TestCase):
+
+    def setUp(self):
+        super(TestInstaller, self).setUp()
+        self.directory = self.mkdtemp()
+        self.archive = os.path.join(self.directory,
+                                    'packer_1.2.3_linux_amd64.zip')
+        with zipfile.ZipFile(self.archive, 'w') as archive:
+            archive.writestr('packer', '#!/bin/sh\necho Packer v1.2.3\n')
+            archive.writestr('LICENSE', 'license')
+        with open(self.archive, 'rb') as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        self.checksums = os.path.join(self.directory, 'SHA256SUMS')
+        with open(self.checksums, 'w') as f:
+            f.write('{0}  packer_1.2.3_linux_amd64.zip\n'.format(checksum))
+
+    def test_install_from_cache(self):
+        cache_dir = os.path.join(self.directory, 'cache')
+        paths = [packer.Installer(
+            os.path.join(self.directory, name), self.archive,
+            checksums_path=self.checksums, cache_dir=cache_dir).install()
+            for name in ('a', 'b')]
+        self.assertTrue(os.path.samefile(*paths))
+        self.assertTrue(os.access(paths[0], os.X_OK))
+        self.assertEqual(['packer'], os.listdir(
+            os.path.join(cache_dir, '1.2.3_linux_amd64')))
+        self.assertEqual(['packer'], os.listdir(os.path.dirname(paths[1])))
+
+    def test_checksum_mismatch(self):
+        with open(self.checksums, 'w') as f:
+            f.write('{0}  packer_1.2.3_linux_amd64.zip\n'.format('0' * 64))
+        installer = packer.Installer(self.directory, self.archive,
+                                     checksums_path=self.checksums)
+        self.assertRaises(packer.PackerException, installer.install)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, 'packer')))
+
+
+class TestExecutableInfo(TestCase):
+
+    SCRIPT = """#!/bin/sh
+echo probe >> "$0.calls"
+case "$1" in
+version) printf 'Packer v{0}\\n\\nYour version of Packer is out of date!\\n';;
+-help) printf 'Usage: packer [--version] [--help] <command> [<args>]\\n\\n\\
+Available commands are:\\n    build       build image(s)\\n\\
+    validate    check that a template is valid\\n' >&2; exit 0;;
+build) printf 'Options:\\n\\n  -force    Force a build\\n\\
+  -parallel-builds=1    Number of builds to run in parallel\\n' >&2; exit 1;;
+esac
+"""
+
+    def setUp(self):
+        super(TestExecutableInfo, self).setUp()
+        self.exec_path = os.path.join(self.mkdtemp(), 'packer')
+        self.write('1.2.3')
+        self.addCleanup(packer.ExecutableInfo.clear)
+
+    def write(self, version):
+        with open(self.exec_path, 'w') as f:
+            f.write(self.SCRIPT.format(version))
+        os.chmod(self.exec_path, 0o755)
+
+    def probes(self):
+        with open(self.exec_path + '.calls') as f:
+            return len(f.readlines())
+
+    def test_version(self):
+        clients = [packer.Packer(TEST_PACKERFILE, exec_path=self.exec_path)
+                   for _ in range(2)]
+        self.assertEqual(['1.2.3', '1.2.3'],
+                         [client.version() for client in clients])
+        self.assertEqual(1, self.probes())
+        self.assertEqual('1.2.3', asyncio.run(packer.AsyncPacker(
+            TEST_PACKERFILE, exec_path=self.exec_path).version()))
+        self.assertEqual(1, self.probes())
+
+        self.write('1.10.0')
+        stat = os.stat(self.exec_path)
+        os.utime(self.exec_path, ns=(stat.st_atime_ns,
+                                     stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual('1.10.0', clients[0].version())
+        self.assertEqual(2, self.probes())
+
+    def test_supports(self):
+        p = packer.Packer(TEST_PACKERFILE, exec_path=self.exec_path)
+        self.assertTrue(p.supports('build'))
+        self.assertTrue(p.supports('build', '-parallel-builds=2'))
+        self.assertFalse(p.supports('build', '-timestamp-ui'))
+        self.assertFalse(p.supports('push'))
+        self.assertTrue(p.supports('validate'))
+        self.assertEqual(2, self.probes())
+
+
+class TestRateLimiter(TestCase):
+
+    def test_rate(self):
+        limiter = packer.RateLimiter(
+            os.path.join(self.mkdtemp(), 'limiter'), rates={'null': (20, 2)})
+        started = time.time()
+        for _ in range(2):
+            limiter.release(limiter.acquire({'null': 1}))
+        self.assertLess(time.time() - started, 0.05)
+        limiter.release(limiter.acquire({'null': 2}))
+        self.assertGreater(time.time() - started, 0.09)
+        self.assertIsNone(limiter.acquire({'qemu': 1}))
+
+    def test_concurrency(self):
+        path = os.path.join(self.mkdtemp(), 'limiter')
+        limiter = packer.RateLimiter(path, concurrency={'null': 1},
+                                     poll_interval=0.01)
+        lease = limiter.acquire({'null': 1})
+        acquired = threading.Event()
+        thread = threading.Thread(target=lambda: (
+            limiter.acquire({'null': 1}), acquired.set()))
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        limiter.release(lease)
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        # slots held by processes which died are freed
+        with open(path) as f:
+            state = json.load(f)
+        for held in state['leases'].values():
+            held['pid'] = 2 ** 22 + 1
+        with open(path, 'w') as f:
+            json.dump(state, f)
+        limiter.release(limiter.acquire({'null': 1}))
+
+    def test_build(self):
+        limiter = packer.RateLimiter(os.path.join(self.mkdtemp(), 'limiter'),
+                                     concurrency={'amazon-ebs': 1})
+        weights = []
+        acquire = limiter.acquire
+        limiter.acquire = lambda w: weights.append(w) or acquire(w)
+        p = packer.Packer(TEST_FULL_PACKERFILE, exc=['amazon'],
+                          backend=packer.FakeBackend())
+        p.build(rate_limiter=limiter)
+        self.assertEqual([{'amazon-ebs': 1, 'virtualbox-ovf': 1}], weights)
+        with open(limiter.path) as f:
+            self.assertEqual({}, json.load(f)['leases'])
+
+    def test_admission_outside_timeout(self):
+        limiter = packer.RateLimiter(os.path.join(self.mkdtemp(), 'limiter'),
+                                     concurrency={'null': 1},
+                                     poll_interval=0.05)
+        timer = threading.Timer(1.5, limiter.release,
+                                [limiter.acquire({'null': 1})])
+        timer.start()
+        self.addCleanup(timer.cancel)
+        exec_path = os.path.join(self.mkdtemp(), 'packer')
+        with open(exec_path, 'w') as f:
+            f.write('#!/bin/sh\nsleep 1\n')
+        os.chmod(exec_path, 0o755)
+        p = packer.Packer(TEST_PACKERFILE, exec_path=exec_path)
+        result = p.build(timeout=2, rate_limiter=limiter)
+        self.assertIsNone(result.terminated)
+
+
+class TestWatchdog(TestCase):
+
+    def packer(self, trap, **kwargs):
+        exec_path = os.path.join(self.mkdtemp(), 'packer')
+        with open(exec_path, 'w') as f:
+            f.write('#!/bin/sh\ntrap {0} INT\necho started\nsleep 30\n'
+                    .format(trap))
+        os.chmod(exec_path, 0o755)
+        return packer.Packer(TEST_PACKERFILE, exec_path=exec_path, **kwargs)
+
+    def test_no_watchdog_without_timeouts(self):
+        watchdogs = []
+        backend = packer.FakeBackend()
+        run = backend.run
+        backend.run = lambda *args, **kwargs: (
+            watchdogs.append(kwargs.get('watchdog')) or run(*args, **kwargs))
+        packer.Packer(TEST_PACKERFILE, backend=backend).build()
+        self.assertEqual([None], watchdogs)
+
+    def test_interrupt_forwarded(self):
+        marker = os.path.join(self.mkdtemp(), 'interrupted')
+        p = self.packer("'touch {0}; exit 1'".format(marker))
+
+        def interrupt(line):
+            # once the script waits for `sleep`, which gets SIGINT too
+            time.sleep(0.5)
+            raise KeyboardInterrupt()
+        p.out_iter = interrupt
+        self.assertRaises(KeyboardInterrupt, p.build, timeout=60)
+        for _ in range(100):
+            if os.path.exists(marker):
+                break
+            time.sleep(0.05)
+        self.assertTrue(os.path.exists(marker))
+
+    def test_inactivity_timeout(self):
+        p = self.packer("'echo cleaned up; exit 1'")
+        started = time.monotonic()
+        ex = self.assertRaises(packer.PackerCommandError, p.build,
+                               inactivity_timeout=0.2, retries=2,
+                               retry_backoff=0)
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual('inactivity', ex.result.terminated)
+        self.assertEqual(1, ex.result.attempts)
+        self.assertIn(b'cleaned up', ex.result.stdout)
+
+    def test_kill_after_timeout(self):
+        p = self.packer("''")
+        ex = self.assertRaises(packer.PackerCommandError, p.build,
+                               timeout=0.2, kill_timeout=0.2)
+        self.assertEqual('timeout', ex.result.terminated)
+        self.assertNotEqual(0, ex.result.exit_code)
+
+    def failing_packer(self, **kwargs):
+        exec_path = os.path.join(self.mkdtemp(), 'packer')
+        with open(exec_path, 'w') as f:
+            f.write('#!/bin/sh\necho "1,,ui,error,Build \'null\' errored: '
+                    'boom"\nexit 1\n')
+        os.chmod(exec_path, 0o755)
+        return packer.Packer(TEST_PACKERFILE, exec_path=exec_path, **kwargs)
+
+    def test_cancel_during_backoff(self):
+        p = self.failing_packer(cancellable=True)
+        timer = threading.Timer(0.5, p.cancel)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        started = time.monotonic()
+        ex = self.assertRaises(packer.PackerCommandError, p.build,
+                               retries=1, retry_backoff=30)
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual('cancelled', ex.result.terminated)
+        self.assertEqual(1, ex.result.attempts)
+
+    def test_timeout_during_backoff(self):
+        started = time.monotonic()
+        ex = self.assertRaises(packer.PackerCommandError,
+                               self.failing_packer().build, timeout=0.5,
+                               retries=1, retry_backoff=30)
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual('timeout', ex.result.terminated)
+        self.assertEqual(1, ex.result.attempts)
+
+    def test_cancel(self):
+        p = self.packer("'exit 1'", cancellable=True)
+        timer = threading.Timer(0.2, p.cancel)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        validation = p.validate()
+        self.assertFalse(validation.succeeded)
+        self.assertEqual('cancelled', validation.terminated)
+        self.assertEqual(0, p.cancel())
+
+
+class TestFakeBackend(TestCase):
+
+    def setUp(self):
+        super(TestFakeBackend, self).setUp()
+        self.backend = packer.FakeBackend()
+        self.backend.set_response('version', 'Packer v1.2.3\n')
+
+    def test_version(self):
+        p = packer.Packer(TEST_PACKERFILE, backend=self.backend)
+        self.assertEqual('1.2.3', p.version())
+        self.assertEqual([('packer', ('version',))], self.backend.calls)
+
+    def test_failed_build(self):
+        self.backend.set_response('build', stderr='boom\n', exit_code=1)
+        p = packer.Packer(TEST_PACKERFILE, backend=self.backend)
+        ex = self.assertRaises(packer.PackerCommandError, p.build)
+        self.assertEqual(b'boom\n', ex.result.stderr)
+
+    def test_hooks(self):
+        self.backend.set_response('build', stderr='boom\n', exit_code=1)
+        calls = []
+        p = packer.Packer(TEST_PACKERFILE, backend=self.backend,
+                          hooks=[lambda *args: calls.append(args)])
+        ex = self.assertRaises(packer.PackerCommandError, p.build)
+        timings, result, error = calls[0]
+        self.assertEqual('build', timings.command)
+        self.assertIs(ex, error)
+        self.assertIs(ex.result, result)
+        self.assertIs(timings, ex.result.timings)
+
+    def test_build_events(self):
+        self.backend.set_response(
+            'build', "1,,ui,say,Build 'null' finished.\n")
+        p = packer.Packer(TEST_PACKERFILE, backend=self.backend)
+        events = list(p.build_events())
+        self.assertEqual('builder-finish', events[-1].type)
+
+    def test_retry_failed_builders(self):
+        attempts = [
+            "1,a,artifact,0,id,a-1\n1,,ui,say,Build 'a' finished.\n"
+            "1,,ui,error,Build 'b' errored: boom\n",
+            "2,,ui,error,Build 'b' errored: boom\n",
+            "3,b,artifact,0,id,b-1\n3,,ui,say,Build 'b' finished.\n",
+        ]
+
+        def respond(exec_path, args):
+            self.backend.calls.append((exec_path, tuple(args)))
+            stdout = attempts.pop(0)
+            return stdout.encode(), b'', 1 if 'errored' in stdout else 0
+
+        self.backend._respond = respond
+        p = packer.Packer(TEST_PACKERFILE, backend=self.backend)
+        result = p.build(retries=2, retry_backoff=0)
+        self.assertEqual(3, result.attempts)
+        self.assertEqual([{'builder': 'a', 'id': 'a-1'},
+                          {'builder': 'b', 'id': 'b-1'}], result.artifacts)
+        self.assertIn('-machine-readable', self.backend.calls[0][1])
+        self.assertIn('-only=b', self.backend.calls[1][1])
+        self.assertFalse(result.timings.builders['b']['errored'])
+
+    def test_retries_exhausted(self):
+        self.backend.set_response(
+            'build', "1,,ui,error,Build 'null' errored: boom\n", exit_code=1)
+        p = packer.Packer(TEST_PACKERFILE, backend=self.backend)
+        ex = self.assertRaises(packer.PackerCommandError, p.build,
+                               retries=1, retry_backoff=0)
+        self.assertEqual(2, ex.result.attempts)
+        self.assertEqual(2, len(self.backend.calls))
+
+    def test_build_per_builder(self):
+        self.backend.set_response('inspect', ''.join(
+            '1,,template-builder,{0},{1}\n'.format(name, type)
+            for name, type in (('vm1', 'qemu'), ('vm2', 'qemu'),
+                               ('ami1', 'amazon-ebs'),
+                               ('ami2', 'amazon-ebs'),
+                               ('ami3', 'amazon-ebs'))))
+        running = []
+        peaks = {}
+        lock = threading.Lock()
+        run = self.backend.run
+
+        def slow_run(exec_path, args, **kwargs):
+            if args[0] == 'build':
+                name = args[-2].split('=')[1]
+                with lock:
+                    running.append(name)
+                    kind = name[:2]
+                    peaks[kind] = max(peaks.get(kind, 0), len(
+                        [other for other in running
+                         if other.startswith(kind)]))
+                time.sleep(0.05)
+                with lock:
+                    running.remove(name)
+            return run(exec_path, args, **kwargs)
+
+        self.backend.run = slow_run
+        p = packer.Packer(TEST_PACKERFILE, backend=self.backend,
+                          exc=['ami3'])
+        batch = p.build_per_builder(max_cpus=2, max_memory=8192,
+                                    weights={'amazon-ebs': (0, 0)})
+        self.assertTrue(batch.succeeded)
+        self.assertEqual(['vm1', 'vm2', 'ami1', 'ami2'],
+                         [result.job.name for result in batch.results])
+        self.assertEqual({'-only=vm1', '-only=vm2', '-only=ami1',
+                          '-only=ami2'}, set(
+            args[-2] for _, args in self.backend.calls if args[0] == 'build'))
+        # the qemu builders take both CPUs, so they run one at a time
+        self.assertEqual({'vm': 1, 'am': 2}, peaks)
+
+    def test_build_per_builder_options(self):
+        self.backend.set_response('inspect', ''.join(
+            '1,,template-builder,{0},null\n'.format(name)
+            for name in ('a', 'b')))
+        self.backend.set_response('build', 'output\n')
+        lines = []
+        hooks = []
+        p = packer.Packer(TEST_PACKERFILE, backend=self.backend,
+                          out_iter=lines.append,
+                          hooks=[lambda *args: hooks.append(args)])
+        self.assertTrue(p.build_per_builder().succeeded)
+        self.assertEqual(2, lines.count('output\n'))
+        # the per-builder builds and the inspection
+        self.assertEqual(['build', 'build', 'inspect'], sorted(
+            timings.command for timings, _, _ in hooks))
+
+    def test_build_matrix(self):
+        packerfile = os.path.join(self.mkdtemp(), 'template.json')
+        with open(packerfile, 'w') as f:
+            json.dump({'variables': {'region': None, 'label': ''},
+                       'builders': [{'type': 'amazon-ebs',
+                                     'region': '{{user `region`}}'}]}, f)
+        batch = packer.Packer.build_matrix(
+            packerfile, {'region': ['eu-west-1', 'us-east-1'],
+                         'label': ['a', 'b', 'c']},
+            vars={'owner': 'me'}, backend=self.backend, inspect=True)
+        self.assertTrue(batch.succeeded)
+        self.assertEqual(6, len(batch.results))
+        commands = [args[0] for _, args in self.backend.calls]
+        self.assertEqual(2, commands.count('validate'))
+        self.assertEqual(1, commands.count('inspect'))
+        self.assertEqual(6, commands.count('build'))
+        self.assertEqual(2, len(set(map(id, batch.validations))))
+        result = batch.get({'region': 'us-east-1', 'label': 'b'})
+        self.assertEqual('region=us-east-1,label=b', result.job.name)
+        self.assertEqual({'owner': 'me', 'region': 'us-east-1',
+                          'label': 'b'}, result.job.vars)
+
+    def test_build_matrix_invalid(self):
+        self.backend.set_response('validate', stderr='bad\n', exit_code=1)
+        batch = packer.Packer.build_matrix(
+            TEST_PACKERFILE, {'region': ['a', 'b']}, backend=self.backend,
+            fail_fast=True)
+        self.assertFalse(batch.succeeded)
+        # region isn't declared by the template, so it affects validation
+        self.assertEqual(['validate', 'validate'],
+                         [args[0] for _, args in self.backend.calls])
+        self.assertIn('validation failed', str(batch.results[0].error))
+
+    def test_incremental_build(self):
+        directory = self.mkdtemp()
+        script = os.path.join(directory, 'setup.sh')
+        with open(script, 'w') as f:
+            f.write('true\n')
+        packerfile = os.path.join(directory, 'template.json')
+        with open(packerfile, 'w') as f:
+            json.dump({'builders': [{'type': 'null'}], 'provisioners': [
+                {'type': 'shell',
+                 'script': '{{template_dir}}/{{user `script`}}'}]}, f)
+        self.backend.set_response(
+            'build', '1,null,artifact,0,id,image-1\n')
+        manifest = packer.BuildManifest(os.path.join(directory, 'm.json'))
+        p = packer.Packer(packerfile, vars={'script': 'setup.sh'},
+                          backend=self.backend, manifest=manifest)
+
+        # the manifest makes the output machine-readable to record the
+        # artifacts
+        first = p.build()
+        self.assertFalse(first.skipped)
+        self.assertEqual([{'builder': 'null', 'id': 'image-1'}],
+                         first.artifacts)
+        second = p.build(machine_readable=True)
+        self.assertTrue(second.skipped)
+        self.assertEqual(first.artifacts, second.artifacts)
+        self.assertEqual(1, len(self.backend.calls))
+
+        with open(script, 'a') as f:
+            f.write('false\n')
+        self.assertFalse(p.build(machine_readable=True).skipped)
+        self.assertFalse(p.build(force=True).skipped)
+        self.assertEqual(3, len(self.backend.calls))
+
+    def test_cached_inspect(self):
+        self.backend.set_response('inspect', '1,,template-builder,a,null\n')
+        p = packer.Packer(TEST_PACKERFILE, backend=self.backend,
+                          cache=packer.ResultCache())
+        first = p.inspect()
+        second = p.inspect()
+        self.assertEqual(first.parsed_output, second.parsed_output)
+        inspections = [call for call in self.backend.calls
+                       if call[1][0] == 'inspect']
+        self.assertEqual(1, len(inspections))
+        p.vars = {'variable1': 'changed'}
+        p.inspect()
+        self.assertEqual(2, len([call for call in self.backend.calls
+                                 if call[1][0] == 'inspect']))
+
+    def test_cache_invalidated_by_upgrade(self):
+        directory = self.mkdtemp()
+        exec_path = os.path.join(directory, 'packer')
+        calls = os.path.join(directory, 'calls')
+
+        def install(version):
+            with open(exec_path, 'w') as f:
+                f.write('#!/bin/sh\necho "$1" >> {0}\n'
+                        'echo "Packer v{1}"\n'.format(calls, version))
+            os.chmod(exec_path, 0o755)
+        install('1.0.0')
+        p = packer.Packer(TEST_PACKERFILE, exec_path=exec_path,
+                          cache=packer.ResultCache())
+        p.inspect()
+        p.inspect()
+        install('2.0.10')
+        p.inspect()
+        self.assertEqual('2.0.10', p.version())
+        with open(calls) as f:
+            self.assertEqual(['version', 'inspect', 'version', 'inspect'],
+                             f.read().split())